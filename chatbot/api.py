@@ -1,4 +1,4 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponseNotAllowed
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
@@ -7,50 +7,50 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from django.core.paginator import Paginator
 from rest_framework.authtoken.models import Token
-from rest_framework.decorators import api_view, authentication_classes, permission_classes
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, renderer_classes
+from rest_framework.authentication import TokenAuthentication, SessionAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from asgiref.sync import sync_to_async
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 import json
 import logging
 
-from .models import SesionChat, MensajeChat, PreguntaBloqueada, ContextoPrompt, TerminoExcluido, DatosFuenteMensaje
-from .services import ChatService, ValidationService
+from .models import SesionChat, MensajeChat, PreguntaBloqueada, ContextoPrompt, TerminoExcluido
+from .services import ChatService, ValidationService, SQLCacheService, IntentService, LLMBackend, LLMOverloadedError, CoalescingService, SQLParser, ExclusionService, QueryGuard, AnalyticsDB, AnalyticsPoolTimeout, SourceDataService, PGPool, PGPoolTimeout, SessionCounters, SessionListService, MessagePageService
 from .bot import guardar_mensaje
 
 
+class EventStreamRenderer(BaseRenderer):
+    """Permite negociar Accept: text/event-stream en los endpoints de streaming"""
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
 # ==================== CHAT APIs ====================
 
 @api_view(['GET'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def api_sessions_list(request):
-    """Lista las sesiones del usuario"""
+    """
+    Lista las sesiones del usuario. Con `limit` o `cursor` responde una página keyset
+    ({"sessions", "next_cursor", "has_more"}); sin ellos, el arreglo completo que usa el sidebar.
+    """
     try:
-        page = int(request.GET.get('page', 1))
-        per_page = int(request.GET.get('per_page', 10))
-        
-        sesiones = SesionChat.objects.filter(
-            usuario=request.user
-        ).order_by('-fecha_inicio')
-        
-        paginator = Paginator(sesiones, per_page)
-        page_obj = paginator.get_page(page)
-        
-        # Return sessions directly as array for frontend compatibility
-        sessions_data = [
-            {
-                "id": s.id_sesion,
-                "nombre": s.nombre_sesion or "(sin nombre)",
-                "fecha_creacion": s.fecha_inicio.isoformat() if s.fecha_inicio else None,
-                "finalizada": s.estado == 'finalizada',
-                "tiene_pregunta_bloqueada": PreguntaBloqueada.objects.filter(sesion=s).exists()
-            }
-            for s in sesiones
-        ]
-        
-        return JsonResponse(sessions_data, safe=False)
+        campos = SessionListService.parse_fields(request.GET.get('fields'))
+        if 'limit' not in request.GET and 'cursor' not in request.GET:
+            return JsonResponse(SessionListService.all(request.user, campos), safe=False)
+        pagina = SessionListService.page(
+            request.user, request.GET.get('cursor'), request.GET.get('limit'), campos
+        )
+        return JsonResponse(pagina)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
     except Exception as e:
         logging.error(f"Error in api_sessions_list: {e}")
         return JsonResponse({"error": "Error obteniendo sesiones"}, status=500)
@@ -76,56 +76,93 @@ def api_session_create(request):
         }, status=500)
 
 
+def _session_summary(sesion):
+    return {
+        "id": sesion.id_sesion,
+        "name": sesion.nombre_sesion,
+        "status": sesion.estado,
+        "created_at": sesion.fecha_inicio.isoformat() if sesion.fecha_inicio else None,
+        "finished_at": sesion.fecha_termino.isoformat() if sesion.fecha_termino else None,
+        "readonly": sesion.estado == 'finalizada',
+        "has_blocked_questions": sesion.total_bloqueadas > 0,
+        "message_count": sesion.total_mensajes_usuario + sesion.total_mensajes_ia,
+        "last_activity_at": sesion.ultima_actividad.isoformat() if sesion.ultima_actividad else None
+    }
+
+
 @api_view(['GET'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
 def api_session_detail(request, session_id):
-    """Obtiene detalles de una sesión y sus mensajes"""
+    """Obtiene detalles de una sesión y sus mensajes más recientes (o todos con ?messages=all)"""
     try:
-        sesion = get_object_or_404(SesionChat, id_sesion=session_id, usuario=request.user)
-        mensajes = MensajeChat.objects.filter(sesion=sesion).order_by('fecha')
-        bloqueadas = PreguntaBloqueada.objects.filter(sesion=sesion).exists()
+        sesion = SesionChat.objects.filter(id_sesion=session_id, usuario=request.user).first()
+        if sesion is None:
+            return JsonResponse({"error": "Sesión no encontrada"}, status=404)
+        # Solo se marca si hay datos fuente; se cargan bajo demanda en /messages/{id}/source-data/
+        if request.GET.get('messages') == 'all':
+            mensajes = MessagePageService.all(sesion)
+            pagina = {"has_more": False}
+        else:
+            pagina = MessagePageService.page(sesion, limite=request.GET.get('limit'))
+            mensajes = pagina.pop("messages")
         contexto_activo = ContextoPrompt.objects.filter(activo=True).first()
         
-        # Agregar datos fuente a mensajes de IA
-        for msg in mensajes:
-            if msg.tipo_emisor == "ia":
-                try:
-                    msg.datos_fuente = msg.datos_fuente  # Force access
-                except DatosFuenteMensaje.DoesNotExist:
-                    msg.datos_fuente = None
-        
         data = {
-            "session": {
-                "id": sesion.id_sesion,
-                "name": sesion.nombre_sesion,
-                "status": sesion.estado,
-                "created_at": sesion.fecha_inicio.isoformat() if sesion.fecha_inicio else None,
-                "finished_at": sesion.fecha_termino.isoformat() if sesion.fecha_termino else None,
-                "readonly": sesion.estado == 'finalizada',
-                "has_blocked_questions": bloqueadas
+            "session": _session_summary(sesion),
+            "messages": [MessagePageService.serialize(m) for m in mensajes],
+            "messages_page": {
+                "has_more_before": pagina["has_more"],
+                "oldest_id": mensajes[0].id_mensaje if mensajes else None,
+                "newest_id": mensajes[-1].id_mensaje if mensajes else None
             },
-            "messages": [
-                {
-                    "id": m.id_mensaje,
-                    "sender": m.tipo_emisor,
-                    "content": m.contenido,
-                    "timestamp": m.fecha.isoformat() if m.fecha else None,
-                    "has_source_data": hasattr(m, 'datos_fuente') and m.datos_fuente is not None,
-                    "metadata": m.metadata if hasattr(m, 'metadata') and m.metadata else None
-                }
-                for m in mensajes
-            ],
             "context": {
                 "active_context": contexto_activo.nombre if contexto_activo else None
             }
         }
         return JsonResponse(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
     except Exception as e:
         logging.error(f"Error in api_session_detail: {e}")
         return JsonResponse({"error": "Error obteniendo sesión"}, status=500)
 
 
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def api_session_messages(request, session_id):
+    """
+    Página de mensajes de una sesión: los más recientes, los anteriores a `before`
+    o solo los posteriores a `after` (para traer lo nuevo tras enviar)
+    """
+    try:
+        sesion = SesionChat.objects.filter(id_sesion=session_id, usuario=request.user).first()
+        if sesion is None:
+            return JsonResponse({"error": "Sesión no encontrada"}, status=404)
+        pagina = MessagePageService.page(
+            sesion, request.GET.get('before'), request.GET.get('after'), request.GET.get('limit')
+        )
+        pagina["messages"] = [MessagePageService.serialize(m) for m in pagina["messages"]]
+        return JsonResponse({**pagina, "session": _session_summary(sesion)})
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except Exception as e:
+        logging.error(f"Error in api_session_messages: {e}")
+        return JsonResponse({"error": "Error obteniendo mensajes"}, status=500)
+
+
+def _overloaded_response(error):
+    """503 con Retry-After cuando LLMGovernor o algún pool de conexiones rechazan por saturación"""
+    response = JsonResponse({
+        "success": False,
+        "error": "El asistente está con alta demanda, intenta nuevamente en unos segundos",
+        "retry_after": error.retry_after
+    }, status=503)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
 @api_view(['POST'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
@@ -177,6 +214,8 @@ def api_send_message(request, session_id):
             "success": False,
             "error": "Formato JSON inválido"
         }, status=400)
+    except (LLMOverloadedError, AnalyticsPoolTimeout, PGPoolTimeout) as e:
+        return _overloaded_response(e)
     except Exception as e:
         logging.error(f"Error in api_send_message: {e}")
         return JsonResponse({
@@ -185,6 +224,164 @@ def api_send_message(request, session_id):
         }, status=500)
 
 
+async def api_send_message_async(request, session_id):
+    """
+    Versión asíncrona de api_send_message. Debe servirse vía ASGI (chatbot_web/asgi.py)
+    para no bloquear un worker durante las llamadas a Claude. DRF no soporta vistas
+    asíncronas, por lo que la autenticación por token se hace aquí.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    
+    try:
+        autenticacion = await sync_to_async(TokenAuthentication().authenticate)(request)
+    except AuthenticationFailed as e:
+        return JsonResponse({"detail": str(e.detail)}, status=401)
+    if autenticacion is None:
+        return JsonResponse({"detail": "Las credenciales de autenticación no se proveyeron."}, status=401)
+    user = autenticacion[0]
+    
+    try:
+        sesion = await SesionChat.objects.filter(id_sesion=session_id, usuario=user).afirst()
+        if sesion is None:
+            return JsonResponse({"error": "Sesión no encontrada"}, status=404)
+        
+        if sesion.estado == 'finalizada':
+            return JsonResponse({
+                "success": False,
+                "error": "La sesión está finalizada"
+            }, status=400)
+        
+        data = json.loads(request.body)
+        pregunta = data.get('message', '').strip()
+        
+        if not pregunta:
+            return JsonResponse({
+                "success": False,
+                "error": "El mensaje no puede estar vacío"
+            }, status=400)
+        
+        # Sanitizar entrada
+        pregunta = ValidationService.sanitize_input(pregunta)
+        
+        # Guardar mensaje del usuario
+        await sync_to_async(guardar_mensaje)(sesion.id_sesion, "usuario", pregunta)
+        
+        # Procesar mensaje usando el servicio
+        result = await ChatService.aprocess_message(sesion, pregunta, user)
+        
+        if not result["success"]:
+            return JsonResponse({
+                "success": False,
+                "error": result["message"]
+            })
+        
+        return JsonResponse({
+            "success": True,
+            "message": "Mensaje procesado exitosamente",
+            "response": result["message"],
+            "has_source_data": bool(result.get("datos_fuente")),
+            "metadata": result.get("ids_extra")
+        })
+        
+    except json.JSONDecodeError:
+        return JsonResponse({
+            "success": False,
+            "error": "Formato JSON inválido"
+        }, status=400)
+    except (LLMOverloadedError, AnalyticsPoolTimeout, PGPoolTimeout) as e:
+        return _overloaded_response(e)
+    except Exception as e:
+        logging.error(f"Error in api_send_message_async: {e}")
+        return JsonResponse({
+            "success": False,
+            "error": "Error procesando mensaje"
+        }, status=500)
+
+
+# Autenticación por token: no aplica CSRF (equivalente a @csrf_exempt para vistas async)
+api_send_message_async.csrf_exempt = True
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def api_send_message_stream(request, session_id):
+    """Envía un mensaje al chat y transmite la respuesta como Server-Sent Events"""
+    try:
+        sesion = get_object_or_404(SesionChat, id_sesion=session_id, usuario=request.user)
+        
+        if sesion.estado == 'finalizada':
+            return JsonResponse({
+                "success": False,
+                "error": "La sesión está finalizada"
+            }, status=400)
+        
+        data = json.loads(request.body)
+        pregunta = data.get('message', '').strip()
+        
+        if not pregunta:
+            return JsonResponse({
+                "success": False,
+                "error": "El mensaje no puede estar vacío"
+            }, status=400)
+        
+        # Sanitizar entrada
+        pregunta = ValidationService.sanitize_input(pregunta)
+        
+        # Guardar mensaje del usuario
+        guardar_mensaje(sesion.id_sesion, "usuario", pregunta)
+        
+        def eventos():
+            for evento, datos in ChatService.process_message_stream(sesion, pregunta, request.user):
+                yield f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+        
+        response = StreamingHttpResponse(eventos(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+        
+    except json.JSONDecodeError:
+        return JsonResponse({
+            "success": False,
+            "error": "Formato JSON inválido"
+        }, status=400)
+    except Exception as e:
+        logging.error(f"Error in api_send_message_stream: {e}")
+        return JsonResponse({
+            "success": False,
+            "error": "Error procesando mensaje"
+        }, status=500)
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication, SessionAuthentication])
+@permission_classes([IsAuthenticated])
+def api_message_source_data(request, message_id):
+    """Datos fuente de un mensaje, paginados por cursor y con proyección de columnas"""
+    try:
+        if not MensajeChat.objects.filter(id_mensaje=message_id, sesion__usuario=request.user).exists():
+            return JsonResponse({"error": "Mensaje no encontrado"}, status=404)
+        
+        columnas = [c.strip() for c in request.GET.get('columns', '').split(',') if c.strip()]
+        pagina = SourceDataService.page(
+            message_id,
+            cursor=request.GET.get('cursor') or None,
+            limite=request.GET.get('limit'),
+            columnas=columnas or None
+        )
+        if pagina is None:
+            return JsonResponse({"error": "El mensaje no tiene datos fuente"}, status=404)
+        return JsonResponse(pagina)
+        
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except Exception as e:
+        logging.error(f"Error in api_message_source_data: {e}")
+        return JsonResponse({"error": "Error obteniendo datos fuente"}, status=500)
+
+
 @api_view(['POST'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
@@ -270,10 +467,11 @@ def api_admin_dashboard(request):
         # Estadísticas generales
         total_usuarios = User.objects.count()
         usuarios_activos = User.objects.filter(last_login__gte=timezone.now() - timedelta(days=30)).count()
-        total_sesiones = SesionChat.objects.count()
-        sesiones_activas = SesionChat.objects.filter(estado='activa').count()
-        total_mensajes = MensajeChat.objects.count()
-        preguntas_bloqueadas = PreguntaBloqueada.objects.count()
+        totales = SessionCounters.totals()
+        total_sesiones = totales['total_sesiones']
+        sesiones_activas = totales['sesiones_activas']
+        total_mensajes = totales['total_mensajes']
+        preguntas_bloqueadas = totales['preguntas_bloqueadas']
         
         # Usuarios más activos (por número de sesiones)
         usuarios_activos_data = User.objects.annotate(
@@ -505,6 +703,87 @@ def api_context_delete(request, context_id):
         }, status=500)
 
 
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def api_sql_cache_stats(request):
+    """Estadísticas de la caché de SQL generado (solo admin)"""
+    if not request.user.is_staff:
+        return JsonResponse({"error": "No tienes permisos para acceder a esta función"}, status=403)
+    try:
+        return JsonResponse({**SQLCacheService.stats(), "parser": SQLParser.stats(), "exclusions": ExclusionService.stats()})
+    except Exception as e:
+        logging.error(f"Error in api_sql_cache_stats: {e}")
+        return JsonResponse({"error": "Error obteniendo estadísticas de caché"}, status=500)
+
+
+@api_view(['POST'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def api_sql_cache_purge(request):
+    """Vacía la caché de SQL generado (solo admin)"""
+    if not request.user.is_staff:
+        return JsonResponse({"error": "No tienes permisos para acceder a esta función"}, status=403)
+    try:
+        eliminadas = SQLCacheService.purge()
+        return JsonResponse({
+            "success": True,
+            "message": f"Caché SQL vaciada ({eliminadas} entradas eliminadas)",
+            "deleted": eliminadas
+        })
+    except Exception as e:
+        logging.error(f"Error in api_sql_cache_purge: {e}")
+        return JsonResponse({
+            "success": False,
+            "error": "Error vaciando caché SQL"
+        }, status=500)
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def api_intent_stats(request):
+    """Cobertura del camino rápido por intenciones (solo admin)"""
+    if not request.user.is_staff:
+        return JsonResponse({"error": "No tienes permisos para acceder a esta función"}, status=403)
+    try:
+        return JsonResponse(IntentService.stats())
+    except Exception as e:
+        logging.error(f"Error in api_intent_stats: {e}")
+        return JsonResponse({"error": "Error obteniendo estadísticas de intenciones"}, status=500)
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def api_llm_stats(request):
+    """Métricas del backend de LLM, su control de admisión y la coalescencia de preguntas (solo admin)"""
+    if not request.user.is_staff:
+        return JsonResponse({"error": "No tienes permisos para acceder a esta función"}, status=403)
+    try:
+        return JsonResponse({**LLMBackend.get().stats(), "coalescing": CoalescingService.stats()})
+    except Exception as e:
+        logging.error(f"Error in api_llm_stats: {e}")
+        return JsonResponse({"error": "Error obteniendo métricas del LLM"}, status=500)
+
+
+@api_view(['GET'])
+@authentication_classes([TokenAuthentication])
+@permission_classes([IsAuthenticated])
+def api_query_guard_stats(request):
+    """Decisiones del guardián de consultas, costos de plan registrados y uso del pool analítico (solo admin)"""
+    if not request.user.is_staff:
+        return JsonResponse({"error": "No tienes permisos para acceder a esta función"}, status=403)
+    try:
+        horas = int(request.GET.get('hours', 24))
+        return JsonResponse({**QueryGuard.stats(horas), "analytics_pool": AnalyticsDB.stats(), "bot_pool": PGPool.stats()})
+    except ValueError:
+        return JsonResponse({"error": "hours debe ser un entero"}, status=400)
+    except Exception as e:
+        logging.error(f"Error in api_query_guard_stats: {e}")
+        return JsonResponse({"error": "Error obteniendo estadísticas del guardián de consultas"}, status=500)
+
+
 # ==================== USER SETTINGS APIs ====================
 
 @api_view(['GET'])
@@ -551,6 +830,7 @@ def api_excluded_term_add(request):
             }, status=400)
         
         TerminoExcluido.objects.create(usuario=request.user, palabra=termino)
+        ExclusionService.refresh_user(request.user)
         
         return JsonResponse({
             "success": True,
@@ -579,6 +859,7 @@ def api_excluded_term_delete(request, term_id):
         termino = get_object_or_404(TerminoExcluido, id=term_id, usuario=request.user)
         palabra = termino.palabra
         termino.delete()
+        ExclusionService.refresh_user(request.user)
         
         return JsonResponse({
             "success": True,
@@ -4,7 +4,11 @@ from .api import (
     api_sessions_list,
     api_session_create,
     api_session_detail,
+    api_session_messages,
     api_send_message,
+    api_send_message_stream,
+    api_send_message_async,
+    api_message_source_data,
     api_session_finalize,
     api_session_delete,
     
@@ -15,6 +19,11 @@ from .api import (
     api_context_activate,
     api_context_deactivate,
     api_context_delete,
+    api_sql_cache_stats,
+    api_sql_cache_purge,
+    api_intent_stats,
+    api_llm_stats,
+    api_query_guard_stats,
     
     # User Settings APIs
     api_excluded_terms,
@@ -40,9 +49,13 @@ urlpatterns = [
     path('sessions/', api_sessions_list, name='api_sessions_list'),
     path('sessions/create/', api_session_create, name='api_session_create'),
     path('sessions/<int:session_id>/', api_session_detail, name='api_session_detail'),
+    path('sessions/<int:session_id>/messages/', api_session_messages, name='api_session_messages'),
     path('sessions/<int:session_id>/message/', api_send_message, name='api_send_message'),
+    path('sessions/<int:session_id>/message/stream/', api_send_message_stream, name='api_send_message_stream'),
+    path('sessions/<int:session_id>/message/async/', api_send_message_async, name='api_send_message_async'),
     path('sessions/<int:session_id>/finalize/', api_session_finalize, name='api_session_finalize'),
     path('sessions/<int:session_id>/delete/', api_session_delete, name='api_session_delete'),
+    path('messages/<int:message_id>/source-data/', api_message_source_data, name='api_message_source_data'),
     
     # ==================== ADMIN APIs ====================
     path('admin/dashboard/', api_admin_dashboard, name='api_admin_dashboard'),
@@ -51,6 +64,11 @@ urlpatterns = [
     path('admin/contexts/<int:context_id>/activate/', api_context_activate, name='api_context_activate'),
     path('admin/contexts/<int:context_id>/deactivate/', api_context_deactivate, name='api_context_deactivate'),
     path('admin/contexts/<int:context_id>/delete/', api_context_delete, name='api_context_delete'),
+    path('admin/sql-cache/', api_sql_cache_stats, name='api_sql_cache_stats'),
+    path('admin/sql-cache/purge/', api_sql_cache_purge, name='api_sql_cache_purge'),
+    path('admin/intents/', api_intent_stats, name='api_intent_stats'),
+    path('admin/llm/', api_llm_stats, name='api_llm_stats'),
+    path('admin/query-guard/', api_query_guard_stats, name='api_query_guard_stats'),
     
     # ==================== USER SETTINGS APIs ====================
     path('settings/excluded-terms/', api_excluded_terms, name='api_excluded_terms'),
@@ -1,12 +1,17 @@
 import psycopg2
 import psycopg2.extras
-import anthropic
 from datetime import datetime
 import logging
 import re, json
 from dotenv import load_dotenv
 import os
 from chatbot.models import ContextoPrompt
+from chatbot.services.llm_backend import LLMBackend
+from chatbot.services.question_classifier import QuestionClassifier
+from chatbot.services.sql_parser import SQLParser, InvalidSQLError
+from chatbot.services.pg_pool import PGPool
+from chatbot.services.exclusion_service import ExclusionService
+from chatbot.services.query_guard import QueryGuard
 
 # Configurar logging
 logging.basicConfig(
@@ -15,25 +20,19 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-# Configuración de la conexión a PostgreSQL
-db_config = {
-    "host": os.getenv("DB_HOST", "localhost"),
-    "user": os.getenv("DB_USER", "postgres"),
-    "password": os.getenv("DB_PASSWORD"),
-    "dbname": os.getenv("DB_NAME", "test"),
-    "port": int(os.getenv("DB_PORT", "5432"))
-}
-
+# Conexiones a PostgreSQL: pool compartido con los datos de DATABASES['default']
 def conectar_db():
-    """Crea y devuelve una conexión a la base de datos PostgreSQL."""
-    return psycopg2.connect(**db_config)
+    """
+    Presta una conexión del pool como context manager: confirma al salir del bloque
+    (o revierte si hubo error) y la devuelve al pool en vez de cerrarla.
+    """
+    return PGPool.connection()
 
 
 # ------------------- Configuración de Anthropic -------------------
 
-# Inicializamos el cliente de Anthropic con la clave correspondiente
+# El cliente de Anthropic se obtiene del registro compartido (pool keep-alive y múltiples keys)
 load_dotenv()
-client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
 
 
 # Estructura de tablas (adaptar al dataset real)
@@ -77,34 +76,26 @@ Relaciones:
 
 def crear_sesion(usuario_id=None):
     """Crea una nueva sesión y la almacena en la tabla sesion_chat."""
-    conn = conectar_db()
-    cur = conn.cursor()
-    if usuario_id:
-        cur.execute(
-            "INSERT INTO sesion_chat (fecha_inicio, estado, nombre_sesion, usuario_id) VALUES (NOW(), 'activa', %s, %s) RETURNING id_sesion",
-            ["Sesión de terminal", usuario_id]
-        )
-    else:
-        # Para compatibilidad con versión anterior (sin usuario)
-        cur.execute("INSERT INTO sesion_chat (fecha_inicio, estado, nombre_sesion) VALUES (NOW(), 'activa', %s) RETURNING id_sesion", ["Sesión de terminal"])
-    id_sesion = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
+    with conectar_db() as conn, conn.cursor() as cur:
+        if usuario_id:
+            cur.execute(
+                "INSERT INTO sesion_chat (fecha_inicio, ultima_actividad, estado, nombre_sesion, usuario_id) VALUES (NOW(), NOW(), 'activa', %s, %s) RETURNING id_sesion",
+                ["Sesión de terminal", usuario_id]
+            )
+        else:
+            # Para compatibilidad con versión anterior (sin usuario)
+            cur.execute("INSERT INTO sesion_chat (fecha_inicio, ultima_actividad, estado, nombre_sesion) VALUES (NOW(), NOW(), 'activa', %s) RETURNING id_sesion", ["Sesión de terminal"])
+        id_sesion = cur.fetchone()[0]
     logging.info(f"Sesión creada: ID {id_sesion}")
     return id_sesion
 
 def finalizar_sesion(id_sesion):
     """Marca la sesión como finalizada."""
-    conn = conectar_db()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE sesion_chat SET fecha_termino = NOW(), estado = 'finalizada' WHERE id_sesion = %s",
-        (id_sesion,)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with conectar_db() as conn, conn.cursor() as cur:
+        cur.execute(
+            "UPDATE sesion_chat SET fecha_termino = NOW(), estado = 'finalizada' WHERE id_sesion = %s",
+            (id_sesion,)
+        )
     logging.info(f"Sesión {id_sesion} finalizada.")
 
 def guardar_mensaje(id_sesion, tipo_emisor, contenido):
@@ -112,31 +103,35 @@ def guardar_mensaje(id_sesion, tipo_emisor, contenido):
     Guarda un mensaje (usuario o IA) en la tabla mensaje_chat.
     Usa la columna 'contenido' (no 'mensaje'), tal como en el script original. :contentReference[oaicite:1]{index=1}
     """
-    conn = conectar_db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO mensaje_chat (id_sesion, tipo_emisor, contenido) VALUES (%s, %s, %s)",
-        (id_sesion, tipo_emisor, contenido)
-    )
-
-    # Si es el primer mensaje del usuario, lo usamos como nombre de sesión
-    if tipo_emisor == "usuario":
+    with conectar_db() as conn, conn.cursor() as cur:
         cur.execute(
-            "SELECT COUNT(*) FROM mensaje_chat WHERE id_sesion = %s AND tipo_emisor = 'usuario'",
-            (id_sesion,)
+            "INSERT INTO mensaje_chat (id_sesion, tipo_emisor, contenido) VALUES (%s, %s, %s)",
+            (id_sesion, tipo_emisor, contenido)
         )
-        count = cur.fetchone()[0]
-        if count == 1:
+
+        # Contadores de la sesión en la misma transacción; si es el primer mensaje del usuario,
+        # se usa como nombre de sesión (en el SET, total_mensajes_usuario es el valor anterior)
+        if tipo_emisor == "usuario":
             resumen = contenido.strip()[:80]  # Nombre corto (primeros 80 caracteres)
             cur.execute(
-                "UPDATE sesion_chat SET nombre_sesion = %s WHERE id_sesion = %s",
+                """
+                UPDATE sesion_chat SET
+                    total_mensajes_usuario = total_mensajes_usuario + 1,
+                    ultima_actividad = NOW(),
+                    nombre_sesion = CASE WHEN total_mensajes_usuario = 0 THEN %s ELSE nombre_sesion END
+                WHERE id_sesion = %s
+                RETURNING total_mensajes_usuario
+                """,
                 (resumen, id_sesion)
             )
-            logging.info(f"Nombre de sesión {id_sesion} actualizado: {resumen}")
-
-    conn.commit()
-    cur.close()
-    conn.close()
+            fila = cur.fetchone()
+            if fila and fila[0] == 1:
+                logging.info(f"Nombre de sesión {id_sesion} actualizado: {resumen}")
+        else:
+            cur.execute(
+                "UPDATE sesion_chat SET total_mensajes_ia = total_mensajes_ia + 1, ultima_actividad = NOW() WHERE id_sesion = %s",
+                (id_sesion,)
+            )
 
 def obtener_historial(id_sesion):
     """
@@ -144,15 +139,12 @@ def obtener_historial(id_sesion):
     retornándolo como una lista de diccionarios con keys 'role' y 'content',
     usando 'contenido' en lugar de 'mensaje'. :contentReference[oaicite:2]{index=2}
     """
-    conn = conectar_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(
-        "SELECT tipo_emisor, contenido FROM mensaje_chat WHERE id_sesion = %s ORDER BY fecha ASC",
-        (id_sesion,)
-    )
-    filas = cur.fetchall()
-    cur.close()
-    conn.close()
+    with conectar_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            "SELECT tipo_emisor, contenido FROM mensaje_chat WHERE id_sesion = %s ORDER BY fecha ASC",
+            (id_sesion,)
+        )
+        filas = cur.fetchall()
     # Convertir cada fila a {"role": "...", "content": "..."}
     mensajes = []
     for m in filas:
@@ -160,15 +152,25 @@ def obtener_historial(id_sesion):
         mensajes.append({"role": role, "content": m["contenido"]})
     return mensajes
 
-def ejecutar_sql(query):
-    """Ejecuta una consulta SQL de solo lectura (SELECT) y devuelve los resultados."""
-    conn = conectar_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(query)
-    resultados = cur.fetchall()
-    cur.close()
-    conn.close()
-    return resultados
+def ejecutar_sql(query, terminos_excluidos=None):
+    """
+    Ejecuta una consulta SQL de solo lectura (SELECT) y devuelve los resultados.
+    Igual que en la API: las exclusiones las agrega ExclusionService y la consulta pasa por QueryGuard.
+    """
+    return QueryGuard.execute(ExclusionService.apply(query, terminos_excluidos)).rows()
+
+def obtener_terminos_excluidos(id_sesion):
+    """Términos excluidos configurados por el dueño de la sesión (los mismos que usa la API)."""
+    with conectar_db() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT t.palabra FROM terminos_excluidos t
+            JOIN sesion_chat s ON s.usuario_id = t.usuario_id
+            WHERE s.id_sesion = %s
+            """,
+            (id_sesion,)
+        )
+        return [fila[0] for fila in cur.fetchall()]
 
 # ------------------- GESTIÓN DE PREGUNTAS BLOQUEADAS -------------------
 
@@ -177,55 +179,33 @@ def es_pregunta_valida(pregunta):
     Valida semánticamente que la pregunta esté relacionada con el dominio de recursos humanos.
     Devuelve (True, None) si es válida o (False, razón) si no lo es.
     """
-    pregunta_lower = pregunta.lower().strip()
-
-    absurdos = [
-        "galaxia", "alien", "extraterrestre", "quien gano el mundial de quidditch",
-        "cocinar", "pastel de papas", "inflacion en saturno", "marciano", "dragones"
-    ]
-    if any(p in pregunta_lower for p in absurdos):
-        return False, "Pregunta absurda o fuera de contexto"
-
-    claves_validas = [
-        "honorario", "contrato", "persona", "nombre", "apellido", "funcion", "calificacion",
-        "región", "mes", "año", "pagado", "liquido", "bruto", "tipo de pago", "profesion",
-        "psicólogo", "sueldo", "remuneración", "trabajador", "gasto", "top", "más ganaron", "ganó"
-    ]
-    if any(p in pregunta_lower for p in claves_validas):
-        return True, None
-
-    if len(pregunta_lower.split()) >= 4 and re.search(r"(cu[aá]nto|cu[aá]les|d[aá]me|muestra|qu[ée]|qu[íi]en)", pregunta_lower):
-        return True, None
-
-    return False, "No contiene términos relacionados ni estructura válida"
+    clasificacion = QuestionClassifier.classify(pregunta)
+    return clasificacion.valida, clasificacion.razon
 
 def registrar_pregunta_bloqueada(id_sesion, pregunta, razon):
     """Inserta en la tabla preguntas_bloqueadas las preguntas no válidas."""
-    conn = conectar_db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO preguntas_bloqueadas (id_sesion, pregunta, razon) VALUES (%s, %s, %s)",
-        (id_sesion, pregunta, razon)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with conectar_db() as conn, conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO preguntas_bloqueadas (id_sesion, pregunta, razon) VALUES (%s, %s, %s)",
+            (id_sesion, pregunta, razon)
+        )
+        cur.execute(
+            "UPDATE sesion_chat SET total_bloqueadas = total_bloqueadas + 1, ultima_actividad = NOW() WHERE id_sesion = %s",
+            (id_sesion,)
+        )
     logging.warning(f"Pregunta bloqueada registrada: {pregunta} - Razón: {razon}")
 
 def hay_preguntas_bloqueadas_en_sesion(id_sesion):
     """
     Retorna True si existe al menos una pregunta bloqueada asociada a la sesión dada.
     """
-    conn = conectar_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT COUNT(*) FROM preguntas_bloqueadas WHERE id_sesion = %s",
-        (id_sesion,)
-    )
-    count = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return count > 0
+    # Protege el borrado: se consulta la tabla y no el contador total_bloqueadas
+    with conectar_db() as conn, conn.cursor() as cur:
+        cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM preguntas_bloqueadas WHERE id_sesion = %s)",
+            (id_sesion,)
+        )
+        return cur.fetchone()[0]
 
 def eliminar_sesion_si_valida(id_borrar):
     """
@@ -237,13 +217,9 @@ def eliminar_sesion_si_valida(id_borrar):
         print("❌ No se puede eliminar: la sesión contiene preguntas bloqueadas que deben conservarse como evidencia.")
         return
 
-    conn = conectar_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM mensaje_chat WHERE id_sesion = %s", (id_borrar,))
-    cur.execute("DELETE FROM sesion_chat WHERE id_sesion = %s", (id_borrar,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with conectar_db() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM mensaje_chat WHERE id_sesion = %s", (id_borrar,))
+        cur.execute("DELETE FROM sesion_chat WHERE id_sesion = %s", (id_borrar,))
     print(f"✅ Sesión {id_borrar} eliminada correctamente.")
     logging.info(f"Sesión {id_borrar} eliminada.")
 
@@ -251,50 +227,14 @@ def eliminar_sesion_si_valida(id_borrar):
 
 def limpiar_sql(sql_raw):
     """
-    Limpia el SQL generado por la IA eliminando comentarios y texto extra.
-    Solo mantiene la consulta SQL válida.
+    Extrae del texto generado por la IA la consulta SELECT en forma canónica (con LIMIT forzado).
+    Devuelve "" si no hay una consulta permitida.
     """
-    # Remover comentarios de línea (-- comentario)
-    lineas = sql_raw.split('\n')
-    lineas_limpias = []
-    
-    for linea in lineas:
-        # Encontrar posición del comentario de línea
-        pos_comentario = linea.find('--')
-        if pos_comentario != -1:
-            linea = linea[:pos_comentario]
-        lineas_limpias.append(linea.strip())
-    
-    sql_sin_comentarios = ' '.join(lineas_limpias).strip()
-    
-    # Buscar la primera aparición de SELECT y tomar solo hasta el punto y coma o final
-    inicio_select = sql_sin_comentarios.upper().find('SELECT')
-    if inicio_select == -1:
-        return sql_sin_comentarios
-    
-    sql_desde_select = sql_sin_comentarios[inicio_select:]
-    
-    # Encontrar el final de la consulta (punto y coma o palabras clave no-SQL)
-    palabras_no_sql = ['ES INCREIBLE', '¡', 'EXCELENTE', 'PERFECTO', 'GENIAL', 'INCREÍBLE', 'MARAVILLOSO', 'FANTÁSTICO']
-    
-    sql_final = sql_desde_select
-    for palabra in palabras_no_sql:
-        pos = sql_final.upper().find(palabra)
-        if pos != -1:
-            sql_final = sql_final[:pos].strip()
-    
-    # También limpiar cualquier texto después de LIMIT si contiene no-números
-    import re
-    # Buscar LIMIT seguido de número y después texto
-    match = re.search(r'(LIMIT\s+\d+)\s+[A-Z]', sql_final, re.IGNORECASE)
-    if match:
-        sql_final = sql_final[:match.start() + len(match.group(1))]
-    
-    # Asegurar que termina con punto y coma
-    if not sql_final.endswith(';'):
-        sql_final += ';'
-        
-    return sql_final
+    try:
+        return SQLParser.extract(sql_raw).sql
+    except InvalidSQLError as e:
+        logging.warning(f"SQL generado rechazado: {e}")
+        return ""
 
 def obtener_consulta_sql(pregunta, historial, terminos_excluidos=None):
     """
@@ -306,7 +246,9 @@ def obtener_consulta_sql(pregunta, historial, terminos_excluidos=None):
     prompt_base = "Eres un asistente experto en análisis de datos para RRHH universitarios. Responde preguntas basadas en las siguientes tablas relacionales:\n" + ESTRUCTURA_TABLA
     logging.info("USANDO PROMPT ESTÁNDAR PARA SQL - SIN CONTEXTO PERSONALIZADO")
     
-    # Agregar información sobre términos excluidos si existen
+    # Con el motor de exclusiones los filtros se agregan después (ejecutar_sql); si está
+    # desactivado, se le piden al modelo como antes
+    terminos_excluidos = ExclusionService.prompt_terms(terminos_excluidos)
     exclusiones_info = ""
     if terminos_excluidos:
         exclusiones_info = f"""
@@ -347,7 +289,7 @@ Genera una consulta SQL para el motor PostgreSQL que responda la pregunta del us
 Tu respuesta debe ser solo la consulta SQL, sin explicaciones adicionales.
 """
 
-    response = client.messages.create(
+    response = LLMBackend.get().create(
         model="claude-3-5-haiku-latest",
         max_tokens=1000,
         temperature=0,
@@ -390,7 +332,7 @@ Genera una respuesta clara para un usuario de RRHH universitario. Sigue estas pa
 - Si no hay datos, indica que no se encontró información y sugiere reformular la pregunta.{contexto_personalizado}
 """
 
-    response = client.messages.create(
+    response = LLMBackend.get().create(
         model="claude-3-5-haiku-latest",
         max_tokens=1000,
         temperature=0,
@@ -430,14 +372,11 @@ def mostrar_sesiones():
     Muestra todas las sesiones registradas. Si una sesión tiene preguntas bloqueadas,
     muestra una advertencia junto a su descripción.
     """
-    conn = conectar_db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(
-        "SELECT id_sesion, nombre_sesion, fecha_inicio, estado FROM sesion_chat ORDER BY fecha_inicio DESC"
-    )
-    sesiones = cur.fetchall()
-    cur.close()
-    conn.close()
+    with conectar_db() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            "SELECT id_sesion, nombre_sesion, fecha_inicio, estado, total_bloqueadas FROM sesion_chat ORDER BY fecha_inicio DESC"
+        )
+        sesiones = cur.fetchall()
 
     if not sesiones:
         print("📂 No hay sesiones registradas.")
@@ -448,7 +387,7 @@ def mostrar_sesiones():
         ses_id = sesion['id_sesion']
         estado = "🟢 Activa" if sesion['estado'] == 'activa' else "⚪ Finalizada"
         nombre = sesion['nombre_sesion'] or "Sin nombre"
-        advertencia = " ⚠️ Contiene preguntas bloqueadas" if hay_preguntas_bloqueadas_en_sesion(ses_id) else ""
+        advertencia = " ⚠️ Contiene preguntas bloqueadas" if sesion['total_bloqueadas'] else ""
         print(f"{estado} - ID {ses_id} – {nombre} – {sesion['fecha_inicio']}{advertencia}")
 
     return sesiones
@@ -578,18 +517,11 @@ def main():
             historial = obtener_historial(id_sesion)
 
             # Generar consulta SQL usando la función original
-            sql_query = obtener_consulta_sql(pregunta, historial)
+            terminos_excluidos = obtener_terminos_excluidos(id_sesion)
+            sql_query = obtener_consulta_sql(pregunta, historial, terminos_excluidos)
             logging.info(f"SQL generado: {sql_query}")
-            # Validación contra SELECT DISTINCT + ORDER BY CASE que puede fallar en PostgreSQL
-            sql_flat = sql_query.replace("\n", " ").lower()
-            if "select distinct" in sql_flat and "order by" in sql_flat and "case" in sql_flat:
-                advertencia = "⚠️ Se detectó una combinación de palabras incoherentes. Intenta reformular la pregunta."
-                print(advertencia)
-                guardar_mensaje(id_sesion, "ia", advertencia)
-                continue
-
-
-            if not sql_query.lower().strip().startswith("select"):
+            # limpiar_sql ya rechazó lo que no es un único SELECT permitido (incluye DISTINCT + ORDER BY inválidos)
+            if not sql_query:
                 logging.warning("Claude no generó una consulta SQL válida.")
                 advertencia = "⚠️ Se detectó una combinación de palabras incoherentes. Intenta reformular la pregunta."
                 print(advertencia)
@@ -597,7 +529,7 @@ def main():
                 continue
 
             # Ejecutamos la consulta y obtenemos resultados
-            resultados = ejecutar_sql(sql_query)
+            resultados = ejecutar_sql(sql_query, terminos_excluidos)
 
             # Generar respuesta final en lenguaje natural usando la función original
             respuesta = generar_respuesta_final(pregunta, resultados, historial)
@@ -0,0 +1,35 @@
+from django.conf import settings
+
+ALIAS_ANALITICO = "analytics"
+
+# Tablas de RRHH (no administradas por Django) que se leen desde el alias analítico
+MODELOS_ANALITICOS = {"persona", "funcion", "tiempocontrato", "contrato"}
+
+
+def analytics_alias():
+    """Alias de las consultas analíticas; 'default' si la configuración no define uno propio"""
+    return ALIAS_ANALITICO if ALIAS_ANALITICO in settings.DATABASES else "default"
+
+
+class AnalyticsRouter:
+    """
+    Envía las lecturas de las tablas de RRHH al alias `analytics` (opcionalmente una réplica).
+    Las escrituras y el resto de los modelos (sesiones, mensajes, cachés) quedan en `default`,
+    y las migraciones nunca se aplican sobre el alias analítico.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == "chatbot" and model._meta.model_name in MODELOS_ANALITICOS:
+            return analytics_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == ALIAS_ANALITICO:
+            return False
+        return None
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from chatbot.models import SesionChat
+from chatbot.services import SessionCounters
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcula los contadores de sesion_chat (mensajes por emisor, preguntas bloqueadas y "
+        "última actividad) desde mensaje_chat y preguntas_bloqueadas, en lotes por id."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Sesiones por transacción")
+
+    def handle(self, *args, **options):
+        maximo = SesionChat.objects.aggregate(maximo=Max("id_sesion"))["maximo"]
+        if maximo is None:
+            self.stdout.write(self.style.SUCCESS("No hay sesiones"))
+            return
+
+        actualizadas = 0
+        desde = 0
+        while desde <= maximo:
+            hasta = desde + options["batch_size"] - 1
+            with transaction.atomic():
+                actualizadas += SessionCounters.backfill(desde, hasta)
+            desde = hasta + 1
+            self.stdout.write(f"  {actualizadas} sesiones recalculadas (hasta id {min(hasta, maximo)})")
+
+        self.stdout.write(self.style.SUCCESS(f"Contadores recalculados en {actualizadas} sesiones"))
@@ -0,0 +1,68 @@
+import asyncio
+import statistics
+import time
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Compara el throughput concurrente de /message/ (síncrono) y /message/async/ (ASGI) "
+        "contra un servidor en ejecución."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://localhost:8000/api/v1", help="URL base de la API")
+        parser.add_argument("--token", required=True, help="Token de autenticación (Authorization: Token ...)")
+        parser.add_argument("--requests", type=int, default=50, help="Cantidad de mensajes por modo")
+        parser.add_argument("--concurrency", type=int, default=10, help="Mensajes simultáneos")
+        parser.add_argument("--message", default="dame el top 5 de honorarios más altos")
+        parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+        parser.add_argument("--timeout", type=float, default=120.0)
+
+    def handle(self, *args, **options):
+        modos = ["sync", "async"] if options["mode"] == "both" else [options["mode"]]
+        for modo in modos:
+            resultado = asyncio.run(self._run(modo, options))
+            self._report(modo, resultado, options)
+
+    async def _run(self, modo, options):
+        headers = {"Authorization": f"Token {options['token']}"}
+        sufijo = "message/" if modo == "sync" else "message/async/"
+        limite = asyncio.Semaphore(options["concurrency"])
+
+        async with httpx.AsyncClient(base_url=options["url"], headers=headers, timeout=options["timeout"]) as client:
+            # Una sesión por mensaje para no mezclar historiales (no se mide)
+            sesiones = []
+            for _ in range(options["requests"]):
+                r = await client.post("/sessions/create/")
+                if r.status_code != 200:
+                    raise CommandError(f"No se pudo crear sesión: HTTP {r.status_code}")
+                sesiones.append(r.json()["session_id"])
+
+            async def enviar(id_sesion):
+                async with limite:
+                    inicio = time.perf_counter()
+                    r = await client.post(f"/sessions/{id_sesion}/{sufijo}", json={"message": options["message"]})
+                    return time.perf_counter() - inicio, r.status_code
+
+            inicio = time.perf_counter()
+            respuestas = await asyncio.gather(*(enviar(s) for s in sesiones))
+            total = time.perf_counter() - inicio
+
+            for id_sesion in sesiones:
+                await client.delete(f"/sessions/{id_sesion}/delete/")
+
+        return total, respuestas
+
+    def _report(self, modo, resultado, options):
+        total, respuestas = resultado
+        latencias = sorted(lat for lat, _ in respuestas)
+        errores = sum(1 for _, status in respuestas if status != 200)
+        p95 = latencias[max(0, int(len(latencias) * 0.95) - 1)]
+        self.stdout.write(
+            f"[{modo}] {len(respuestas)} mensajes, concurrencia {options['concurrency']}: "
+            f"{len(respuestas) / total:.2f} req/s, p50 {statistics.median(latencias):.2f}s, "
+            f"p95 {p95:.2f}s, errores {errores}"
+        )
@@ -0,0 +1,71 @@
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot.services.question_classifier import QuestionClassifier
+
+
+PREGUNTAS = [
+    "dame el top 5 de honorarios más altos",
+    "cuáles son los honorarios de marzo",
+    "cuál es el promedio de honorarios por región",
+    "busca información de Juan Pérez",
+    "cuántas personas trabajan en Valparaíso",
+    "qué funciones están activas este mes",
+    "cuántos contratos están activos",
+    "estadísticas de contratos del mes actual",
+    "cuál es el total de viáticos pagados",
+    "cómo cocinar un pastel de papas",
+    "quién ganó el mundial de quidditch",
+    "hola, cómo estás",
+]
+
+
+def _legacy_is_valid_question(pregunta):
+    """Implementación anterior (listas recorridas con any y regex sin precompilar), solo para comparar"""
+    pregunta_lower = pregunta.lower().strip()
+    absurdos = [
+        "galaxia", "alien", "extraterrestre", "quien gano el mundial de quidditch",
+        "cocinar", "pastel de papas", "inflacion en saturno", "marciano", "dragones"
+    ]
+    if any(p in pregunta_lower for p in absurdos):
+        return False, "Pregunta absurda o fuera de contexto"
+    claves_validas = [
+        "honorario", "contrato", "persona", "nombre", "apellido", "funcion", "calificacion",
+        "región", "mes", "año", "pagado", "liquido", "bruto", "tipo de pago", "profesion",
+        "psicólogo", "sueldo", "remuneración", "trabajador", "gasto", "top", "más ganaron", "ganó"
+    ]
+    if any(p in pregunta_lower for p in claves_validas):
+        return True, None
+    if len(pregunta_lower.split()) >= 4 and re.search(r"(cu[aá]nto|cu[aá]les|d[aá]me|muestra|qu[ée]|qu[íi]en)", pregunta_lower):
+        return True, None
+    return False, "No contiene términos relacionados ni estructura válida"
+
+
+class Command(BaseCommand):
+    help = "Microbenchmark del clasificador de preguntas frente a la implementación anterior"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20000, help="Clasificaciones por implementación")
+
+    def handle(self, *args, **options):
+        iteraciones = options["iterations"]
+        preguntas = [PREGUNTAS[i % len(PREGUNTAS)] for i in range(iteraciones)]
+        QuestionClassifier.get_model()
+
+        resultados = {}
+        for nombre, funcion in (("anterior", _legacy_is_valid_question), ("compilado", QuestionClassifier.classify)):
+            inicio = time.perf_counter()
+            for pregunta in preguntas:
+                funcion(pregunta)
+            resultados[nombre] = (time.perf_counter() - inicio) / iteraciones * 1e6
+            self.stdout.write(f"{nombre:>10}: {resultados[nombre]:.2f} µs/pregunta")
+
+        modelo = "con modelo" if QuestionClassifier.get_model() else "sin modelo"
+        self.stdout.write(self.style.SUCCESS(
+            f"Aceleración {resultados['anterior'] / resultados['compilado']:.2f}x ({modelo}, {iteraciones} iteraciones)"
+        ))
+        for pregunta in PREGUNTAS:
+            clasificacion = QuestionClassifier.classify(pregunta)
+            self.stdout.write(f"  {clasificacion.valida!s:>5} {clasificacion.score:.2f}  {pregunta}")
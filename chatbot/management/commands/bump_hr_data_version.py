@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.services import ResultCacheService
+
+
+class Command(BaseCommand):
+    help = "Incrementa la versión de datos de RRHH e invalida los resultados SQL cacheados. Ejecutar tras recargar persona/funcion/tiempo_contrato/contrato."
+
+    def handle(self, *args, **options):
+        version = ResultCacheService.bump_data_version()
+        self.stdout.write(self.style.SUCCESS(f"Versión de datos RRHH: {version}"))
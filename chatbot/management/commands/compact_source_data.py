@@ -0,0 +1,70 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from chatbot.models import DatosFuenteMensaje
+from chatbot.services import SourceDataService
+
+
+class Command(BaseCommand):
+    help = (
+        "Mueve los datos fuente guardados por mensaje (JSON o comprimidos) a los resultados "
+        "compartidos por contenido, en lotes por id. Se puede interrumpir y volver a ejecutar."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200, help="Filas por transacción")
+        parser.add_argument("--limit", type=int, default=None, help="Máximo de filas a convertir")
+        parser.add_argument("--dry-run", action="store_true", help="Solo calcula los tamaños, no guarda")
+
+    def handle(self, *args, **options):
+        pendientes = DatosFuenteMensaje.objects.filter(resultado__isnull=True).filter(
+            Q(datos__isnull=False) | Q(datos_comprimidos__isnull=False)
+        )
+        ultimo_id = 0
+        convertidas = bytes_antes = bytes_despues = 0
+
+        while options["limit"] is None or convertidas < options["limit"]:
+            tamano = options["batch_size"]
+            if options["limit"] is not None:
+                tamano = min(tamano, options["limit"] - convertidas)
+            lote = list(
+                pendientes.filter(id__gt=ultimo_id).order_by("id")
+                .only("id", "datos", "datos_comprimidos")[:tamano]
+            )
+            if not lote:
+                break
+            ultimo_id = lote[-1].id
+
+            with transaction.atomic():
+                for fila in lote:
+                    if fila.datos_comprimidos is not None:
+                        bytes_antes += len(fila.datos_comprimidos)
+                    else:
+                        antes = fila.datos if isinstance(fila.datos, str) else json.dumps(fila.datos)
+                        bytes_antes += len(antes.encode("utf-8"))
+                    resultado = SourceDataService.decode(fila.datos_comprimidos, fila.datos)
+                    fila.resultado_id, nuevos = SourceDataService.intern(resultado)
+                    bytes_despues += nuevos
+                    fila.datos = fila.datos_comprimidos = None
+                DatosFuenteMensaje.objects.bulk_update(lote, ["resultado", "datos", "datos_comprimidos"])
+                if options["dry_run"]:
+                    transaction.set_rollback(True)
+            convertidas += len(lote)
+            self.stdout.write(f"  {convertidas} filas convertidas (hasta id {ultimo_id})")
+
+        if not convertidas:
+            self.stdout.write(self.style.SUCCESS("No hay datos fuente pendientes de convertir"))
+            return
+
+        ratio = bytes_antes / bytes_despues if bytes_despues else 0
+        accion = "Se convertirían" if options["dry_run"] else "Convertidas"
+        self.stdout.write(self.style.SUCCESS(
+            f"{accion} {convertidas} filas: {bytes_antes} → {bytes_despues} bytes en resultados nuevos ({ratio:.1f}x)"
+        ))
+        if not options["dry_run"]:
+            self.stdout.write(
+                "El espacio de las filas antiguas se recupera tras VACUUM (o VACUUM FULL) de chatbot_datosfuentemensaje."
+            )
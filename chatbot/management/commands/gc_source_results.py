@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from chatbot.models import DatosFuenteMensaje, ResultadoAlmacenado
+
+
+class Command(BaseCommand):
+    help = (
+        "Elimina en lotes los resultados almacenados que ya no apunta ningún mensaje. "
+        "Con --recount recalcula antes los conteos de referencias."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Resultados por transacción")
+        parser.add_argument(
+            "--recount", action="store_true",
+            help="Recalcula referencias desde datos fuente (tras eliminar mensajes sin ChatService.delete_session)",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Solo informa, no elimina")
+
+    def handle(self, *args, **options):
+        if options["recount"]:
+            corregidos = self._recount(options["batch_size"])
+            self.stdout.write(f"Referencias corregidas: {corregidos}")
+
+        referenciado = DatosFuenteMensaje.objects.filter(resultado_id=OuterRef("huella"))
+        huerfanos = ResultadoAlmacenado.objects.filter(referencias__lte=0).exclude(Exists(referenciado))
+        ultimo_id = 0
+        eliminados = bytes_liberados = 0
+
+        while True:
+            lote = list(
+                huerfanos.filter(id__gt=ultimo_id).order_by("id")
+                .values_list("id", flat=True)[:options["batch_size"]]
+            )
+            if not lote:
+                break
+            ultimo_id = lote[-1]
+            if options["dry_run"]:
+                eliminados += len(lote)
+                bytes_liberados += ResultadoAlmacenado.objects.filter(id__in=lote).aggregate(
+                    total=Coalesce(Sum("tamano"), 0)
+                )["total"]
+                continue
+            with transaction.atomic():
+                # Se vuelve a filtrar: un mensaje nuevo pudo sumar una referencia después de la lectura
+                borrables = huerfanos.filter(id__in=lote)
+                bytes_liberados += borrables.aggregate(total=Coalesce(Sum("tamano"), 0))["total"]
+                eliminados += borrables.delete()[0]
+
+        accion = "Se eliminarían" if options["dry_run"] else "Eliminados"
+        self.stdout.write(self.style.SUCCESS(
+            f"{accion} {eliminados} resultados sin referencias ({bytes_liberados} bytes)"
+        ))
+
+    def _recount(self, tamano_lote):
+        conteo = Coalesce(
+            Subquery(
+                DatosFuenteMensaje.objects.filter(resultado_id=OuterRef("huella"))
+                .values("resultado_id").annotate(total=Count("id")).values("total")
+            ),
+            Value(0),
+        )
+        ultimo_id = corregidos = 0
+        while True:
+            lote = list(
+                ResultadoAlmacenado.objects.filter(id__gt=ultimo_id).order_by("id")
+                .values_list("id", flat=True)[:tamano_lote]
+            )
+            if not lote:
+                return corregidos
+            ultimo_id = lote[-1]
+            # Un solo UPDATE por lote: el conteo se calcula en la misma sentencia que lo escribe
+            corregidos += ResultadoAlmacenado.objects.filter(id__in=lote).alias(real=conteo).exclude(
+                referencias=F("real")
+            ).update(referencias=conteo)
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.models import MensajeChat, PreguntaBloqueada
+from chatbot.services.question_classifier import QuestionClassifier
+
+
+class Command(BaseCommand):
+    help = (
+        "Entrena el clasificador de preguntas (TF-IDF + regresión logística) con las preguntas "
+        "aceptadas y bloqueadas registradas. Los procesos en ejecución recargan el modelo solos."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=None, help="Ruta del modelo (por defecto QUESTION_CLASSIFIER_MODEL)")
+        parser.add_argument("--epochs", type=int, default=200)
+        parser.add_argument("--threshold", type=float, default=0.5, help="Score mínimo para aceptar una pregunta")
+        parser.add_argument("--min-df", type=int, default=1, help="Frecuencia mínima de documento de un término")
+        parser.add_argument("--min-samples", type=int, default=5, help="Mínimo de ejemplos por clase")
+
+    def handle(self, *args, **options):
+        bloqueadas = set(PreguntaBloqueada.objects.values_list("pregunta", flat=True).distinct())
+        aceptadas = set(
+            MensajeChat.objects.filter(tipo_emisor="usuario").values_list("contenido", flat=True).distinct()
+        ) - bloqueadas
+
+        if len(aceptadas) < options["min_samples"] or len(bloqueadas) < options["min_samples"]:
+            raise CommandError(
+                f"Datos insuficientes: {len(aceptadas)} aceptadas y {len(bloqueadas)} bloqueadas "
+                f"(mínimo {options['min_samples']} por clase)"
+            )
+
+        modelo = QuestionClassifier.train(
+            sorted(aceptadas), sorted(bloqueadas),
+            epocas=options["epochs"], min_frecuencia=options["min_df"], threshold=options["threshold"],
+        )
+
+        normalizadas = [(QuestionClassifier.normalize(p), 1) for p in aceptadas] + \
+                       [(QuestionClassifier.normalize(p), 0) for p in bloqueadas]
+        aciertos = sum(
+            (QuestionClassifier._score(modelo, texto) >= modelo["threshold"]) == bool(etiqueta)
+            for texto, etiqueta in normalizadas
+        )
+
+        ruta = QuestionClassifier.save_model(modelo, options["output"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Modelo guardado en {ruta}: {len(aceptadas)} aceptadas, {len(bloqueadas)} bloqueadas, "
+            f"{len(modelo['weights'])} términos, exactitud en entrenamiento {aciertos / len(normalizadas):.1%}"
+        ))
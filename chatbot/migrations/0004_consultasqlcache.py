@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0003_datosfuentemensaje'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsultaSQLCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clave', models.CharField(max_length=64, unique=True)),
+                ('pregunta_normalizada', models.TextField()),
+                ('terminos_excluidos', models.TextField(blank=True, default='')),
+                ('version_esquema', models.CharField(max_length=16)),
+                ('sql', models.TextField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+                ('ultimo_uso', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'db_table': 'cache_consultas_sql',
+            },
+        ),
+    ]
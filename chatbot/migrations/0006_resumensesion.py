@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_versiondatos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResumenSesion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resumen', models.TextField(blank=True, default='')),
+                ('ultimo_mensaje', models.IntegerField(default=0)),
+                ('fecha_actualizacion', models.DateTimeField(auto_now=True)),
+                ('sesion', models.OneToOneField(db_column='id_sesion', db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='resumen', to='chatbot.sesionchat')),
+            ],
+            options={
+                'db_table': 'resumen_sesion',
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0006_resumensesion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SolicitudEnCurso',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clave', models.CharField(max_length=64, unique=True)),
+                ('estado', models.CharField(default='en_curso', max_length=10)),
+                ('resultado', models.TextField(blank=True, null=True)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'db_table': 'solicitudes_en_curso',
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0007_solicitudencurso'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EvaluacionConsulta',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('huella', models.CharField(db_index=True, max_length=64)),
+                ('sql', models.TextField()),
+                ('decision', models.CharField(db_index=True, max_length=12)),
+                ('motivo', models.CharField(blank=True, default='', max_length=200)),
+                ('costo_estimado', models.FloatField(null=True)),
+                ('filas_estimadas', models.FloatField(null=True)),
+                ('filas_intermedias', models.FloatField(null=True)),
+                ('duracion_ms', models.FloatField(null=True)),
+                ('fecha', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'db_table': 'evaluaciones_consulta',
+            },
+        ),
+    ]
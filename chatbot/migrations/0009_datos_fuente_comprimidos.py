@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0008_evaluacionconsulta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datosfuentemensaje',
+            name='datos_comprimidos',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='datosfuentemensaje',
+            name='datos',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
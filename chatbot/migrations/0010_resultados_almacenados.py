@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0009_datos_fuente_comprimidos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultadoAlmacenado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('huella', models.CharField(max_length=64, unique=True)),
+                ('contenido', models.BinaryField()),
+                ('tamano', models.PositiveIntegerField(default=0)),
+                ('referencias', models.IntegerField(db_index=True, default=0)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'resultados_almacenados',
+            },
+        ),
+        migrations.AddField(
+            model_name='datosfuentemensaje',
+            name='resultado',
+            field=models.ForeignKey(db_column='huella_resultado', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='mensajes', to='chatbot.resultadoalmacenado', to_field='huella'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+# sesion_chat no es administrada por Django (managed = False): las columnas se agregan
+# directamente. La migración 0014 las rellena para las sesiones existentes.
+COLUMNAS = [
+    ("total_mensajes_usuario", "integer NOT NULL DEFAULT 0"),
+    ("total_mensajes_ia", "integer NOT NULL DEFAULT 0"),
+    ("total_bloqueadas", "integer NOT NULL DEFAULT 0"),
+    ("ultima_actividad", "timestamp with time zone NULL"),
+]
+
+
+def agregar_contadores(apps, schema_editor):
+    conexion = schema_editor.connection
+    with conexion.cursor() as cur:
+        if "sesion_chat" not in conexion.introspection.table_names(cur):
+            return
+        existentes = {c.name for c in conexion.introspection.get_table_description(cur, "sesion_chat")}
+    for nombre, tipo in COLUMNAS:
+        if nombre not in existentes:
+            schema_editor.execute(f"ALTER TABLE sesion_chat ADD COLUMN {nombre} {tipo}")
+
+
+def quitar_contadores(apps, schema_editor):
+    conexion = schema_editor.connection
+    with conexion.cursor() as cur:
+        if "sesion_chat" not in conexion.introspection.table_names(cur):
+            return
+        existentes = {c.name for c in conexion.introspection.get_table_description(cur, "sesion_chat")}
+    for nombre, _ in COLUMNAS:
+        if nombre in existentes:
+            schema_editor.execute(f"ALTER TABLE sesion_chat DROP COLUMN {nombre}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0010_resultados_almacenados'),
+    ]
+
+    operations = [
+        migrations.RunPython(agregar_contadores, quitar_contadores),
+    ]
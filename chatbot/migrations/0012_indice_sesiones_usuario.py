@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# Índice para el listado keyset de sesiones (usuario_id, fecha_inicio DESC, id_sesion DESC).
+# sesion_chat no es administrada por Django: el índice se crea directamente, en PostgreSQL
+# con CONCURRENTLY para no bloquear escrituras (por eso la migración no es atómica).
+INDICE = "idx_sesion_chat_usuario_fecha"
+
+
+def crear_indice(apps, schema_editor):
+    conexion = schema_editor.connection
+    with conexion.cursor() as cur:
+        if "sesion_chat" not in conexion.introspection.table_names(cur):
+            return
+    concurrente = "CONCURRENTLY " if conexion.vendor == "postgresql" else ""
+    schema_editor.execute(
+        f"CREATE INDEX {concurrente}IF NOT EXISTS {INDICE} "
+        "ON sesion_chat (usuario_id, fecha_inicio DESC, id_sesion DESC)"
+    )
+
+
+def eliminar_indice(apps, schema_editor):
+    schema_editor.execute(f"DROP INDEX IF EXISTS {INDICE}")
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chatbot', '0011_contadores_sesion'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_indice, eliminar_indice),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# Índice para la paginación por cursor de mensajes (id_sesion, fecha, id_mensaje).
+# mensaje_chat no es administrada por Django: el índice se crea directamente, en PostgreSQL
+# con CONCURRENTLY para no bloquear escrituras (por eso la migración no es atómica).
+INDICE = "idx_mensaje_chat_sesion_fecha"
+
+
+def crear_indice(apps, schema_editor):
+    conexion = schema_editor.connection
+    with conexion.cursor() as cur:
+        if "mensaje_chat" not in conexion.introspection.table_names(cur):
+            return
+    concurrente = "CONCURRENTLY " if conexion.vendor == "postgresql" else ""
+    schema_editor.execute(
+        f"CREATE INDEX {concurrente}IF NOT EXISTS {INDICE} "
+        "ON mensaje_chat (id_sesion, fecha, id_mensaje)"
+    )
+
+
+def eliminar_indice(apps, schema_editor):
+    schema_editor.execute(f"DROP INDEX IF EXISTS {INDICE}")
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chatbot', '0012_indice_sesiones_usuario'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_indice, eliminar_indice),
+    ]
@@ -0,0 +1,58 @@
+from django.db import migrations, transaction
+
+# Rellena los contadores agregados en 0011 para las sesiones existentes. Hasta entonces
+# quedaban en 0 y guardar_mensaje renombraba la sesión con el siguiente mensaje.
+# Se recorre sesion_chat por rangos de id, un lote por transacción (migración no atómica).
+LOTE = 1000
+
+RECALCULAR = """
+UPDATE sesion_chat SET
+    total_mensajes_usuario = (
+        SELECT COUNT(*) FROM mensaje_chat m
+        WHERE m.id_sesion = sesion_chat.id_sesion AND m.tipo_emisor = 'usuario'
+    ),
+    total_mensajes_ia = (
+        SELECT COUNT(*) FROM mensaje_chat m
+        WHERE m.id_sesion = sesion_chat.id_sesion AND m.tipo_emisor <> 'usuario'
+    ),
+    total_bloqueadas = (
+        SELECT COUNT(*) FROM preguntas_bloqueadas p WHERE p.id_sesion = sesion_chat.id_sesion
+    ),
+    ultima_actividad = COALESCE(
+        (SELECT MAX(m.fecha) FROM mensaje_chat m WHERE m.id_sesion = sesion_chat.id_sesion),
+        fecha_inicio
+    )
+WHERE id_sesion BETWEEN %s AND %s
+"""
+
+
+def rellenar_contadores(apps, schema_editor):
+    conexion = schema_editor.connection
+    with conexion.cursor() as cur:
+        tablas = conexion.introspection.table_names(cur)
+        if not {"sesion_chat", "mensaje_chat", "preguntas_bloqueadas"} <= set(tablas):
+            return
+        cur.execute("SELECT MAX(id_sesion) FROM sesion_chat")
+        maximo = cur.fetchone()[0]
+    if maximo is None:
+        return
+
+    desde = 0
+    while desde <= maximo:
+        hasta = desde + LOTE - 1
+        with transaction.atomic(using=conexion.alias), conexion.cursor() as cur:
+            cur.execute(RECALCULAR, [desde, hasta])
+        desde = hasta + 1
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('chatbot', '0013_indice_mensajes_sesion'),
+    ]
+
+    operations = [
+        migrations.RunPython(rellenar_contadores, migrations.RunPython.noop),
+    ]
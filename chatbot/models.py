@@ -54,6 +54,11 @@ class SesionChat(models.Model):
     fecha_termino = models.DateTimeField(null=True, blank=True)
     estado = models.CharField(max_length=20)
     nombre_sesion = models.TextField()
+    # Contadores desnormalizados (ver SessionCounters); columnas agregadas por la migración 0011
+    total_mensajes_usuario = models.IntegerField(default=0)
+    total_mensajes_ia = models.IntegerField(default=0)
+    total_bloqueadas = models.IntegerField(default=0)
+    ultima_actividad = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         managed = False
@@ -102,9 +107,98 @@ class ContextoPrompt(models.Model):
 
 class DatosFuenteMensaje(models.Model):
     mensaje = models.OneToOneField("MensajeChat", on_delete=models.CASCADE, related_name="datos_fuente")
-    datos = models.JSONField()
+    datos = models.JSONField(null=True, blank=True)  # formato anterior: lista de filas en JSON
+    datos_comprimidos = models.BinaryField(null=True)  # formato anterior: ResultadoColumnar.to_bytes propio del mensaje
+    resultado = models.ForeignKey(
+        "ResultadoAlmacenado", to_field="huella", db_column="huella_resultado",
+        on_delete=models.PROTECT, null=True, related_name="mensajes",
+    )
     
     def __str__(self):
         return f"Datos fuente para mensaje {self.mensaje.id_mensaje}"
 
 
+class ResultadoAlmacenado(models.Model):
+    """Resultado de consulta guardado una sola vez por contenido, compartido por los mensajes que lo muestran"""
+    huella = models.CharField(max_length=64, unique=True)  # sha256 de ResultadoColumnar.payload()
+    contenido = models.BinaryField()  # ResultadoColumnar.to_bytes
+    tamano = models.PositiveIntegerField(default=0)
+    referencias = models.IntegerField(default=0, db_index=True)  # DatosFuenteMensaje que lo apuntan
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'resultados_almacenados'
+
+    def __str__(self):
+        return f"{self.huella[:12]} ({self.referencias} refs)"
+
+
+class ConsultaSQLCache(models.Model):
+    clave = models.CharField(max_length=64, unique=True)
+    pregunta_normalizada = models.TextField()
+    terminos_excluidos = models.TextField(blank=True, default="")
+    version_esquema = models.CharField(max_length=16)
+    sql = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    ultimo_uso = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'cache_consultas_sql'
+
+    def __str__(self):
+        return self.pregunta_normalizada[:80]
+
+class VersionDatos(models.Model):
+    nombre = models.CharField(max_length=50, unique=True)
+    version = models.PositiveIntegerField(default=0)
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'version_datos'
+
+    def __str__(self):
+        return f"{self.nombre} v{self.version}"
+
+class ResumenSesion(models.Model):
+    sesion = models.OneToOneField(SesionChat, to_field='id_sesion', db_column='id_sesion', on_delete=models.CASCADE, db_constraint=False, related_name='resumen')
+    resumen = models.TextField(blank=True, default="")
+    ultimo_mensaje = models.IntegerField(default=0)  # id_mensaje del último mensaje incorporado al resumen
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'resumen_sesion'
+
+    def __str__(self):
+        return f"Resumen de sesión {self.sesion_id}"
+
+class SolicitudEnCurso(models.Model):
+    """Tabla de locks para coalescer preguntas idénticas entre workers"""
+    clave = models.CharField(max_length=64, unique=True)
+    estado = models.CharField(max_length=10, default="en_curso")  # en_curso | listo
+    resultado = models.TextField(null=True, blank=True)
+    fecha_creacion = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'solicitudes_en_curso'
+
+    def __str__(self):
+        return f"{self.clave[:12]} ({self.estado})"
+
+class EvaluacionConsulta(models.Model):
+    """Decisión del guardián de consultas con el costo estimado del plan, para calibrar umbrales"""
+    huella = models.CharField(max_length=64, db_index=True)
+    sql = models.TextField()
+    decision = models.CharField(max_length=12, db_index=True)  # aceptada | reescrita | rechazada | cancelada
+    motivo = models.CharField(max_length=200, blank=True, default="")
+    costo_estimado = models.FloatField(null=True)
+    filas_estimadas = models.FloatField(null=True)
+    filas_intermedias = models.FloatField(null=True)  # mayor estimación de filas entre los nodos del plan
+    duracion_ms = models.FloatField(null=True)
+    fecha = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'evaluaciones_consulta'
+
+    def __str__(self):
+        return f"{self.decision} ({self.costo_estimado})"
@@ -1,5 +1,25 @@
 from .chat_service import ChatService
 from .validation_service import ValidationService
 from .ai_service import AIService
+from .sql_cache_service import SQLCacheService
+from .result_cache_service import ResultCacheService
+from .anthropic_registry import AnthropicClientRegistry
+from .history_service import HistoryService
+from .result_encoder import ResultEncoder
+from .intent_service import IntentService
+from .answer_renderer import AnswerRenderer
+from .llm_backend import LLMBackend
+from .llm_governor import LLMGovernor, LLMOverloadedError
+from .coalescing_service import CoalescingService
+from .sql_parser import SQLParser, InvalidSQLError, ConsultaNormalizada
+from .exclusion_service import ExclusionService
+from .query_guard import QueryGuard, QueryRejectedError
+from .analytics_db import AnalyticsDB, AnalyticsPoolTimeout
+from .columnar_result import ResultadoColumnar
+from .source_data_service import SourceDataService
+from .pg_pool import PGPool, PGPoolTimeout
+from .session_counters import SessionCounters
+from .session_list_service import SessionListService
+from .message_page_service import MessagePageService
 
-__all__ = ['ChatService', 'ValidationService', 'AIService']
\ No newline at end of file
+__all__ = ['ChatService', 'ValidationService', 'AIService', 'SQLCacheService', 'ResultCacheService', 'AnthropicClientRegistry', 'HistoryService', 'ResultEncoder', 'IntentService', 'AnswerRenderer', 'LLMBackend', 'LLMGovernor', 'LLMOverloadedError', 'CoalescingService', 'SQLParser', 'InvalidSQLError', 'ConsultaNormalizada', 'ExclusionService', 'QueryGuard', 'QueryRejectedError', 'AnalyticsDB', 'AnalyticsPoolTimeout', 'ResultadoColumnar', 'SourceDataService', 'PGPool', 'PGPoolTimeout', 'SessionCounters', 'SessionListService', 'MessagePageService']
\ No newline at end of file
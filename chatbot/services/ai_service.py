@@ -1,20 +1,20 @@
 import json
 import re
 import logging
-import anthropic
-import os
-from dotenv import load_dotenv
+from asgiref.sync import sync_to_async
 
 from ..models import ContextoPrompt
-
-# Cargar variables de entorno
-load_dotenv()
+from .sql_cache_service import SQLCacheService
+from .sql_parser import SQLParser, InvalidSQLError
+from .llm_backend import LLMBackend
+from .result_encoder import ResultEncoder
+from .answer_renderer import AnswerRenderer
 
 class AIService:
     """Servicio para interacciones con la API de Anthropic Claude"""
     
     def __init__(self):
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        # Las llamadas al LLM pasan por LLMBackend (Anthropic compartido vía AnthropicClientRegistry)
         self.estructura_tabla = self._get_table_structure()
     
     @staticmethod
@@ -57,19 +57,16 @@ Relaciones:
 """
     
     @staticmethod
-    def generate_sql_query(pregunta, historial, terminos_excluidos=None):
-        """Genera una consulta SQL basada en la pregunta del usuario"""
-        try:
-            ai_service = AIService()
-            
-            # Para SQL siempre usamos el prompt estándar, NO el contexto personalizado
-            prompt_base = f"Eres un asistente experto en análisis de datos para RRHH universitarios. Responde preguntas basadas en las siguientes tablas relacionales:\n{ai_service.estructura_tabla}"
-            logging.info("USANDO PROMPT ESTÁNDAR PARA SQL - SIN CONTEXTO PERSONALIZADO")
-            
-            # Agregar información sobre términos excluidos
-            exclusiones_info = ""
-            if terminos_excluidos:
-                exclusiones_info = f"""
+    def _build_sql_prompt(pregunta, terminos_excluidos=None):
+        """Construye el prompt de generación de SQL, incluyendo las exclusiones del usuario"""
+        # Para SQL siempre usamos el prompt estándar, NO el contexto personalizado
+        prompt_base = f"Eres un asistente experto en análisis de datos para RRHH universitarios. Responde preguntas basadas en las siguientes tablas relacionales:\n{AIService._get_table_structure()}"
+        logging.info("USANDO PROMPT ESTÁNDAR PARA SQL - SIN CONTEXTO PERSONALIZADO")
+        
+        # Agregar información sobre términos excluidos
+        exclusiones_info = ""
+        if terminos_excluidos:
+            exclusiones_info = f"""
 
 IMPORTANTE - TÉRMINOS EXCLUIDOS: El usuario ha configurado los siguientes términos para EXCLUIR completamente de los resultados: {', '.join(terminos_excluidos)}.
 
@@ -82,8 +79,8 @@ Debes agregar condiciones WHERE para filtrar estos términos en TODAS las column
 
 Ejemplo: Si 'marzo' está excluido, la consulta debe incluir: AND LOWER(tiempo_contrato.mes) NOT LIKE '%marzo%'
 Los filtros de exclusión son OBLIGATORIOS y deben aplicarse siempre que haya términos excluidos."""
-            
-            system_prompt = f"""{prompt_base}{exclusiones_info}
+        
+        system_prompt = f"""{prompt_base}{exclusiones_info}
 
 Y la siguiente consulta en lenguaje natural:
 \"{pregunta}\"
@@ -106,8 +103,21 @@ Genera una consulta SQL para el motor PostgreSQL que responda la pregunta del us
 
 Tu respuesta debe ser solo la consulta SQL, sin explicaciones adicionales.
 """
+        return system_prompt
+    
+    @staticmethod
+    def generate_sql_query(pregunta, historial, terminos_excluidos=None):
+        """Genera una consulta SQL basada en la pregunta del usuario"""
+        try:
+            sql_cacheado = SQLCacheService.get(pregunta, terminos_excluidos)
+            if sql_cacheado:
+                return sql_cacheado
+            
+            ai_service = AIService()
+            
+            system_prompt = ai_service._build_sql_prompt(pregunta, terminos_excluidos)
             
-            response = ai_service.client.messages.create(
+            response = LLMBackend.get().create(
                 model="claude-3-5-haiku-latest",
                 max_tokens=1000,
                 temperature=0,
@@ -115,34 +125,66 @@ Tu respuesta debe ser solo la consulta SQL, sin explicaciones adicionales.
             )
             
             sql_query = response.content[0].text.strip()
-            
-            # Limpiar el SQL de comentarios extras y texto no SQL
-            sql_limpio = ai_service._clean_sql(sql_query)
-            logging.info(f"SQL original: {sql_query}")
-            logging.info(f"SQL limpio: {sql_limpio}")
-            
-            return sql_limpio
+            return ai_service._process_generated_sql(pregunta, terminos_excluidos, sql_query)
             
         except Exception as e:
             logging.error(f"Error generando consulta SQL: {e}")
             raise
     
     @staticmethod
-    def generate_final_response(pregunta, resultado_sql, historial):
-        """Genera la respuesta final en lenguaje natural"""
+    async def agenerate_sql_query(pregunta, historial, terminos_excluidos=None):
+        """Versión asíncrona de generate_sql_query (AsyncAnthropic)"""
         try:
+            sql_cacheado = await sync_to_async(SQLCacheService.get)(pregunta, terminos_excluidos)
+            if sql_cacheado:
+                return sql_cacheado
+            
             ai_service = AIService()
             
-            # Obtener contexto personalizado si existe
-            contexto = ContextoPrompt.objects.filter(activo=True).first()
-            contexto_personalizado = ""
-            if contexto:
-                contexto_personalizado = f"\n\nINSTRUCCIÓN ESPECIAL DEL USUARIO: {contexto.prompt_sistema}"
+            system_prompt = ai_service._build_sql_prompt(pregunta, terminos_excluidos)
+            
+            response = await LLMBackend.get().acreate(
+                model="claude-3-5-haiku-latest",
+                max_tokens=1000,
+                temperature=0,
+                messages=[{"role": "user", "content": system_prompt}] + historial
+            )
+            
+            sql_query = response.content[0].text.strip()
+            return await sync_to_async(ai_service._process_generated_sql)(pregunta, terminos_excluidos, sql_query)
             
-            prompt = f"""Dada la siguiente pregunta:
+        except Exception as e:
+            logging.error(f"Error generando consulta SQL (async): {e}")
+            raise
+    
+    @staticmethod
+    def _process_generated_sql(pregunta, terminos_excluidos, sql_query):
+        """Normaliza el SQL generado por la IA y lo guarda en caché si es válido (None si se rechaza)"""
+        # Extraer la consulta del texto generado y llevarla a su forma canónica
+        logging.info(f"SQL original: {sql_query}")
+        try:
+            sql_limpio = SQLParser.extract(sql_query).sql
+        except InvalidSQLError as e:
+            logging.warning(f"SQL generado rechazado: {e}")
+            return None
+        logging.info(f"SQL limpio: {sql_limpio}")
+        
+        SQLCacheService.set(pregunta, terminos_excluidos, sql_limpio)
+        return sql_limpio
+    
+    @staticmethod
+    def _build_final_prompt(pregunta, resultado_sql):
+        """Construye el prompt de la respuesta final, incluyendo el contexto personalizado activo"""
+        # Obtener contexto personalizado si existe
+        contexto = ContextoPrompt.objects.filter(activo=True).first()
+        contexto_personalizado = ""
+        if contexto:
+            contexto_personalizado = f"\n\nINSTRUCCIÓN ESPECIAL DEL USUARIO: {contexto.prompt_sistema}"
+        
+        return f"""Dada la siguiente pregunta:
 \"{pregunta}\"
 Y los siguientes resultados:
-{resultado_sql}
+{ResultEncoder.encode(resultado_sql)}
 
 Genera una respuesta clara para un usuario de RRHH universitario. Sigue estas pautas:
 - Usa lenguaje profesional y ordenado.
@@ -151,8 +193,19 @@ Genera una respuesta clara para un usuario de RRHH universitario. Sigue estas pa
 - Esa instrucción no debe ser explicada, solo insertada al final como dato estructurado, la instruccion que esta puesta arriba es solo un ejemplo no tomes ese dato para dar informacion, tienes que buscar el dato especifico de la informacion que se te pide o de la persona como tal o contrato de donde extrajiste la informacion.
 - Si no hay datos, indica que no se encontró información y sugiere reformular la pregunta.{contexto_personalizado}
 """
+    
+    @staticmethod
+    def generate_final_response(pregunta, resultado_sql, historial):
+        """Genera la respuesta final en lenguaje natural"""
+        try:
+            ai_service = AIService()
+            local = AnswerRenderer.render(resultado_sql, pregunta)
+            if local is not None:
+                return ai_service._extract_metadata_from_response(local)
+            
+            prompt = ai_service._build_final_prompt(pregunta, resultado_sql)
             
-            response = ai_service.client.messages.create(
+            response = LLMBackend.get().create(
                 model="claude-3-5-haiku-latest",
                 max_tokens=1000,
                 temperature=0,
@@ -168,6 +221,60 @@ Genera una respuesta clara para un usuario de RRHH universitario. Sigue estas pa
             logging.error(f"Error generando respuesta final: {e}")
             raise
     
+    @staticmethod
+    async def agenerate_final_response(pregunta, resultado_sql, historial):
+        """Versión asíncrona de generate_final_response (AsyncAnthropic)"""
+        try:
+            ai_service = AIService()
+            local = await sync_to_async(AnswerRenderer.render)(resultado_sql, pregunta)
+            if local is not None:
+                return ai_service._extract_metadata_from_response(local)
+            
+            prompt = await sync_to_async(ai_service._build_final_prompt)(pregunta, resultado_sql)
+            
+            response = await LLMBackend.get().acreate(
+                model="claude-3-5-haiku-latest",
+                max_tokens=1000,
+                temperature=0,
+                messages=[{"role": "user", "content": prompt}] + historial
+            )
+            
+            texto = response.content[0].text.strip()
+            
+            # Extraer JSON y metadatos
+            return ai_service._extract_metadata_from_response(texto)
+            
+        except Exception as e:
+            logging.error(f"Error generando respuesta final (async): {e}")
+            raise
+    
+    @staticmethod
+    def stream_final_response(pregunta, resultado_sql, historial):
+        """
+        Genera la respuesta final en streaming, entregando los fragmentos de texto
+        a medida que llegan desde la API. El texto completo debe pasarse luego por
+        _extract_metadata_from_response.
+        """
+        try:
+            local = AnswerRenderer.render(resultado_sql, pregunta)
+            if local is not None:
+                yield local
+                return
+            
+            ai_service = AIService()
+            prompt = ai_service._build_final_prompt(pregunta, resultado_sql)
+            
+            yield from LLMBackend.get().stream_text(
+                model="claude-3-5-haiku-latest",
+                max_tokens=1000,
+                temperature=0,
+                messages=[{"role": "user", "content": prompt}] + historial
+            )
+            
+        except Exception as e:
+            logging.error(f"Error generando respuesta final en streaming: {e}")
+            raise
+    
     @staticmethod
     def _extract_metadata_from_response(texto):
         """Extrae metadatos JSON de la respuesta de la IA"""
@@ -195,52 +302,3 @@ Genera una respuesta clara para un usuario de RRHH universitario. Sigue estas pa
                 logging.warning("Error parseando JSON en respuesta de IA")
         
         return texto, tipo, ids
-    
-    @staticmethod
-    def _clean_sql(sql_raw):
-        """
-        Limpia el SQL generado por la IA eliminando comentarios y texto extra.
-        Solo mantiene la consulta SQL válida.
-        """
-        import re
-        
-        # Remover comentarios de línea (-- comentario)
-        lineas = sql_raw.split('\n')
-        lineas_limpias = []
-        
-        for linea in lineas:
-            # Encontrar posición del comentario de línea
-            pos_comentario = linea.find('--')
-            if pos_comentario != -1:
-                linea = linea[:pos_comentario]
-            lineas_limpias.append(linea.strip())
-        
-        sql_sin_comentarios = ' '.join(lineas_limpias).strip()
-        
-        # Buscar la primera aparición de SELECT y tomar solo hasta el punto y coma o final
-        inicio_select = sql_sin_comentarios.upper().find('SELECT')
-        if inicio_select == -1:
-            return sql_sin_comentarios
-        
-        sql_desde_select = sql_sin_comentarios[inicio_select:]
-        
-        # Encontrar el final de la consulta (punto y coma o palabras clave no-SQL)
-        palabras_no_sql = ['ES INCREIBLE', '¡', 'EXCELENTE', 'PERFECTO', 'GENIAL', 'INCREÍBLE', 'MARAVILLOSO', 'FANTÁSTICO']
-        
-        sql_final = sql_desde_select
-        for palabra in palabras_no_sql:
-            pos = sql_final.upper().find(palabra)
-            if pos != -1:
-                sql_final = sql_final[:pos].strip()
-        
-        # También limpiar cualquier texto después de LIMIT si contiene no-números
-        # Buscar LIMIT seguido de número y después texto
-        match = re.search(r'(LIMIT\s+\d+)\s+[A-Z]', sql_final, re.IGNORECASE)
-        if match:
-            sql_final = sql_final[:match.start() + len(match.group(1))]
-        
-        # Asegurar que termina con punto y coma
-        if not sql_final.endswith(';'):
-            sql_final += ';'
-            
-        return sql_final
\ No newline at end of file
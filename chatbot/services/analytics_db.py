@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connections, OperationalError
+
+from ..db_router import analytics_alias
+
+
+class AnalyticsPoolTimeout(OperationalError):
+    """No se liberó ningún cupo del pool analítico dentro del plazo de espera"""
+
+    def __init__(self, mensaje, retry_after):
+        super().__init__(mensaje)
+        self.retry_after = retry_after
+
+
+class AnalyticsDB:
+    """
+    Acceso al alias `analytics` usado por el SQL generado y los endpoints de detalle.
+    Limita por proceso cuántas consultas analíticas usan conexión a la vez
+    (ANALYTICS_DB_POOL_SIZE): al agotarse los cupos se espera hasta
+    ANALYTICS_DB_POOL_TIMEOUT segundos y luego falla como un pool sin conexiones libres.
+    """
+
+    TAMANO_POOL = int(os.getenv("ANALYTICS_DB_POOL_SIZE", "4"))
+    ESPERA_POOL = float(os.getenv("ANALYTICS_DB_POOL_TIMEOUT", "10"))
+
+    _cupos = threading.BoundedSemaphore(TAMANO_POOL)
+    _lock = threading.Lock()
+    _stats = {"acquired": 0, "timeouts": 0, "in_use": 0, "max_in_use": 0, "wait_ms_total": 0.0}
+
+    @staticmethod
+    def alias():
+        return analytics_alias()
+
+    @staticmethod
+    def connection():
+        """Conexión del hilo actual al alias analítico"""
+        return connections[analytics_alias()]
+
+    @staticmethod
+    @contextmanager
+    def slot():
+        """Reserva un cupo del pool analítico mientras dura el bloque"""
+        inicio = time.perf_counter()
+        if not AnalyticsDB._cupos.acquire(timeout=AnalyticsDB.ESPERA_POOL):
+            with AnalyticsDB._lock:
+                AnalyticsDB._stats["timeouts"] += 1
+            logging.warning(f"Pool analítico sin cupos tras {AnalyticsDB.ESPERA_POOL}s de espera")
+            raise AnalyticsPoolTimeout(
+                f"Sin conexiones analíticas disponibles (pool de {AnalyticsDB.TAMANO_POOL})",
+                max(1, round(AnalyticsDB.ESPERA_POOL)),
+            )
+        with AnalyticsDB._lock:
+            stats = AnalyticsDB._stats
+            stats["acquired"] += 1
+            stats["in_use"] += 1
+            stats["max_in_use"] = max(stats["max_in_use"], stats["in_use"])
+            stats["wait_ms_total"] += (time.perf_counter() - inicio) * 1000
+        try:
+            yield AnalyticsDB.connection()
+        finally:
+            with AnalyticsDB._lock:
+                AnalyticsDB._stats["in_use"] -= 1
+            AnalyticsDB._cupos.release()
+
+    @staticmethod
+    def close_if_unusable_or_obsolete():
+        """Respeta CONN_MAX_AGE de ambos alias al terminar trabajo en un hilo del executor"""
+        for alias in {analytics_alias(), "default"}:
+            connections[alias].close_if_unusable_or_obsolete()
+
+    @staticmethod
+    def stats():
+        with AnalyticsDB._lock:
+            stats = dict(AnalyticsDB._stats)
+        espera_total = stats.pop("wait_ms_total")
+        return {
+            "alias": analytics_alias(),
+            "pool_size": AnalyticsDB.TAMANO_POOL,
+            "pool_timeout_seconds": AnalyticsDB.ESPERA_POOL,
+            **stats,
+            "avg_wait_ms": round(espera_total / stats["acquired"], 2) if stats["acquired"] else 0.0,
+        }
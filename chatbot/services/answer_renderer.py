@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import re
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from ..models import ContextoPrompt
+from .sql_cache_service import SQLCacheService
+
+
+class AnswerRenderer:
+    """
+    Redacta localmente la respuesta final para resultados simples (un total, un conteo,
+    un top N, la ficha de un registro) con plantillas en español y montos en pesos chilenos,
+    evitando la segunda llamada a Claude. El texto termina con el mismo JSON de IDs que pide
+    el prompt. Las preguntas que piden comparar o explicar siempre las redacta Claude.
+    """
+
+    HABILITADO = os.getenv("ANSWER_RENDER_LOCAL", "true").lower() == "true"
+    MAX_FILAS = int(os.getenv("ANSWER_RENDER_MAX_ROWS", "10"))
+    MAX_COLUMNAS = 8
+
+    # Columnas cuyo valor es un monto en pesos
+    _MONTOS = ("honorario", "monto", "viatico", "costo", "gasto", "pago", "sueldo")
+    # Columna que da nombre a cada fila de una lista, en orden de preferencia
+    _ETIQUETAS = ("nombre_completo", "descripcion_funcion", "region", "mes")
+    # Prioridad de los IDs para los metadatos, igual que el ejemplo del prompt
+    _TIPOS_ID = ("id_contrato", "id_persona")
+    _NOMBRES = {"anho": "año", "descripcion_funcion": "función", "nombre_completo": "nombre", "region": "región"}
+
+    # Preguntas que esperan análisis y no solo el dato (sobre la pregunta normalizada)
+    _ANALISIS = re.compile(
+        r"\b(compar\w*|diferencia\w*|versus|vs|por que|porque|explica\w*|analiza\w*|analisis|tendencia\w*|"
+        r"evolucion\w*|relacion\w*|conviene|recomienda\w*|resum\w*|describe|interpreta\w*|"
+        r"cambio\w*|variacion\w*)\b"
+    )
+    # Preguntas de ranking: las únicas cuya respuesta de varias filas se redacta localmente
+    _TOP = re.compile(r"\b(top|ranking|primer[oa]s|mas alt[oa]s|mas baj[oa]s|mayores|menores|mas ganaron|mejor pagad\w*|peor pagad\w*)\b")
+
+    @staticmethod
+    def render(filas, pregunta=""):
+        """
+        Retorna el texto de la respuesta (con el JSON de IDs al final) o None si el
+        resultado no califica y debe redactarlo Claude: solo un valor agregado, la ficha
+        de un registro o un top N que la pregunta pidió explícitamente.
+        """
+        if not AnswerRenderer.HABILITADO:
+            return None
+        texto_pregunta = SQLCacheService.normalize_question(pregunta or "")
+        if AnswerRenderer._ANALISIS.search(texto_pregunta):
+            return None
+        if filas and AnswerRenderer._shape(filas, texto_pregunta) is None:
+            return None
+        # Un contexto personalizado puede cambiar tono o idioma: solo Claude puede aplicarlo
+        if ContextoPrompt.objects.filter(activo=True).exists():
+            return None
+
+        try:
+            if not filas:
+                return (
+                    "No se encontró información para tu consulta. "
+                    "Intenta reformular la pregunta o ampliar el período o la región."
+                )
+            columnas = list(filas[0].keys())
+            if AnswerRenderer._shape(filas, texto_pregunta) == "escalar":
+                texto = AnswerRenderer._render_scalar(filas[0], columnas)
+            else:
+                texto = AnswerRenderer._render_list(filas, columnas)
+            return texto + AnswerRenderer._metadata(filas, columnas)
+        except Exception as e:
+            logging.error(f"Error redactando respuesta local: {e}")
+            return None
+
+    @staticmethod
+    def _shape(filas, texto_pregunta):
+        """'escalar', 'registro' o 'top' según el resultado y la pregunta; None si no es ninguna"""
+        columnas = list(filas[0].keys())
+        if len(columnas) > AnswerRenderer.MAX_COLUMNAS:
+            return None
+        con_ids = any(c.startswith("id_") for c in columnas)
+        if len(filas) == 1:
+            if con_ids:
+                return "registro"
+            numericos = [
+                c for c in columnas
+                if isinstance(filas[0][c], (int, float, Decimal)) and not isinstance(filas[0][c], bool)
+            ]
+            # Un total o conteo, a lo más acompañado de la etiqueta del grupo (mes, región)
+            if numericos and len(columnas) - len(numericos) <= 1:
+                return "escalar"
+            return None
+        if len(filas) <= AnswerRenderer.MAX_FILAS and AnswerRenderer._TOP.search(texto_pregunta):
+            return "top"
+        return None
+
+    @staticmethod
+    def format_clp(valor):
+        """Formatea un monto como pesos chilenos: $ 1.000.000"""
+        entero = int(Decimal(str(valor)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        signo = "-" if entero < 0 else ""
+        return f"{signo}$ {abs(entero):,}".replace(",", ".")
+
+    @staticmethod
+    def _format_number(valor):
+        if isinstance(valor, float) and not valor.is_integer():
+            return f"{valor:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        return f"{int(valor):,}".replace(",", ".")
+
+    @staticmethod
+    def _is_amount(columna):
+        return any(parte in columna for parte in AnswerRenderer._MONTOS)
+
+    @staticmethod
+    def _label(columna):
+        nombre = AnswerRenderer._NOMBRES.get(columna, columna.replace("_", " "))
+        return nombre[:1].upper() + nombre[1:]
+
+    @staticmethod
+    def _format_value(columna, valor):
+        if valor is None:
+            return "sin dato"
+        if isinstance(valor, bool):
+            return "sí" if valor else "no"
+        if isinstance(valor, (int, float, Decimal)):
+            if AnswerRenderer._is_amount(columna):
+                return AnswerRenderer.format_clp(valor)
+            if columna == "anho" or columna.startswith("id_"):
+                return str(valor)
+            return AnswerRenderer._format_number(float(valor) if isinstance(valor, Decimal) else valor)
+        if isinstance(valor, datetime):
+            return valor.strftime("%d-%m-%Y %H:%M")
+        if isinstance(valor, date):
+            return valor.strftime("%d-%m-%Y")
+        return str(valor)
+
+    @staticmethod
+    def _render_scalar(fila, columnas):
+        """Una fila de agregados: una oración si hay un solo valor, si no una línea por valor"""
+        if len(columnas) == 1:
+            columna = columnas[0]
+            return f"{AnswerRenderer._label(columna)}: {AnswerRenderer._format_value(columna, fila[columna])}."
+        lineas = [
+            f"- {AnswerRenderer._label(c)}: {AnswerRenderer._format_value(c, fila[c])}"
+            for c in columnas
+        ]
+        return "Este es el resultado de tu consulta:\n" + "\n".join(lineas)
+
+    @staticmethod
+    def _render_list(filas, columnas):
+        """Lista numerada; cada fila se encabeza con su nombre, función, región o mes"""
+        etiqueta = next((c for c in AnswerRenderer._ETIQUETAS if c in columnas), None)
+        detalle = [c for c in columnas if c != etiqueta and not c.startswith("id_")]
+
+        total = len(filas)
+        encabezado = "Se encontró 1 resultado:" if total == 1 else f"Se encontraron {total} resultados:"
+        lineas = [encabezado]
+        for posicion, fila in enumerate(filas, start=1):
+            partes = [
+                f"{AnswerRenderer._label(c).lower()} {AnswerRenderer._format_value(c, fila[c])}"
+                for c in detalle
+            ]
+            titulo = AnswerRenderer._format_value(etiqueta, fila[etiqueta]) if etiqueta else ""
+            if titulo and partes:
+                lineas.append(f"{posicion}. {titulo}: {', '.join(partes)}")
+            else:
+                lineas.append(f"{posicion}. {titulo or ', '.join(partes)}")
+        return "\n".join(lineas)
+
+    @staticmethod
+    def _metadata(filas, columnas):
+        """JSON final con los IDs, con el mismo formato que se le pide a Claude"""
+        tipo = next((t for t in AnswerRenderer._TIPOS_ID if t in columnas), None)
+        if not tipo:
+            return ""
+        ids = list(dict.fromkeys(fila[tipo] for fila in filas if fila[tipo] is not None))
+        return f"\n\n{json.dumps({tipo: ids})}" if ids else ""
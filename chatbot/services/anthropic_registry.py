@@ -0,0 +1,219 @@
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+import weakref
+
+import anthropic
+import httpx
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+load_dotenv()
+
+
+class AnthropicClientRegistry:
+    """
+    Registro de clientes Anthropic compartido por todo el proceso.
+    Mantiene un cliente (y su pool HTTP keep-alive) por API key, reparte las
+    llamadas en round-robin y deja en espera las keys que reciben un 429.
+    """
+
+    _lock = threading.Lock()
+    _claves = None
+    _ciclo = None
+    _clientes = {}
+    _clientes_async = weakref.WeakKeyDictionary()
+    _estado = {}
+
+    @staticmethod
+    def _config():
+        return {
+            "timeout": float(os.getenv("ANTHROPIC_TIMEOUT", "60")),
+            "connect_timeout": float(os.getenv("ANTHROPIC_CONNECT_TIMEOUT", "5")),
+            "max_connections": int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", "20")),
+            "keepalive_expiry": float(os.getenv("ANTHROPIC_KEEPALIVE_EXPIRY", "60")),
+            "cooldown": float(os.getenv("ANTHROPIC_RATE_LIMIT_COOLDOWN", "30")),
+        }
+
+    @staticmethod
+    def _load_keys():
+        """Lee ANTHROPIC_API_KEYS (separadas por coma) o, en su defecto, ANTHROPIC_API_KEY"""
+        registro = AnthropicClientRegistry
+        if registro._claves is None:
+            with registro._lock:
+                if registro._claves is None:
+                    claves = [c.strip() for c in os.getenv("ANTHROPIC_API_KEYS", "").split(",") if c.strip()]
+                    if not claves:
+                        claves = [os.getenv("ANTHROPIC_API_KEY")]
+                    registro._estado = {
+                        i: {"requests": 0, "rate_limited": 0, "errors": 0, "bloqueada_hasta": 0.0}
+                        for i in range(len(claves))
+                    }
+                    registro._ciclo = itertools.cycle(range(len(claves)))
+                    registro._claves = claves
+        return registro._claves
+
+    @staticmethod
+    def _client_kwargs(clave):
+        config = AnthropicClientRegistry._config()
+        claves = AnthropicClientRegistry._load_keys()
+        # Con varias keys es preferible cambiar de key ante un 429 que reintentar sobre la misma
+        reintentos = int(os.getenv("ANTHROPIC_MAX_RETRIES", "0" if len(claves) > 1 else "2"))
+        return {
+            "api_key": clave,
+            "max_retries": reintentos,
+            "timeout": anthropic.Timeout(config["timeout"], connect=config["connect_timeout"]),
+        }, httpx.Limits(
+            max_connections=config["max_connections"],
+            max_keepalive_connections=config["max_connections"],
+            keepalive_expiry=config["keepalive_expiry"],
+        )
+
+    @staticmethod
+    def _next_key():
+        """Siguiente key en round-robin que no esté en espera por rate limit"""
+        registro = AnthropicClientRegistry
+        claves = registro._load_keys()
+        ahora = time.monotonic()
+        with registro._lock:
+            for _ in range(len(claves)):
+                indice = next(registro._ciclo)
+                if registro._estado[indice]["bloqueada_hasta"] <= ahora:
+                    registro._estado[indice]["requests"] += 1
+                    return indice
+            # Todas en espera: usar la que se libera primero
+            indice = min(registro._estado, key=lambda i: registro._estado[i]["bloqueada_hasta"])
+            registro._estado[indice]["requests"] += 1
+            return indice
+
+    @staticmethod
+    def get_client(indice=None):
+        """Retorna (indice, cliente síncrono) reutilizando el pool HTTP de la key"""
+        registro = AnthropicClientRegistry
+        claves = registro._load_keys()
+        if indice is None:
+            indice = registro._next_key()
+        cliente = registro._clientes.get(indice)
+        if cliente is None:
+            with registro._lock:
+                cliente = registro._clientes.get(indice)
+                if cliente is None:
+                    kwargs, limites = registro._client_kwargs(claves[indice])
+                    cliente = anthropic.Anthropic(http_client=anthropic.DefaultHttpxClient(limits=limites), **kwargs)
+                    registro._clientes[indice] = cliente
+        return indice, cliente
+
+    @staticmethod
+    def get_async_client(indice=None):
+        """Retorna (indice, cliente asíncrono); los pools async se mantienen por event loop"""
+        registro = AnthropicClientRegistry
+        claves = registro._load_keys()
+        if indice is None:
+            indice = registro._next_key()
+        loop = asyncio.get_running_loop()
+        with registro._lock:
+            por_loop = registro._clientes_async.setdefault(loop, {})
+            cliente = por_loop.get(indice)
+            if cliente is None:
+                kwargs, limites = registro._client_kwargs(claves[indice])
+                cliente = anthropic.AsyncAnthropic(http_client=anthropic.DefaultAsyncHttpxClient(limits=limites), **kwargs)
+                por_loop[indice] = cliente
+        return indice, cliente
+
+    @staticmethod
+    def _mark_rate_limited(indice, error):
+        registro = AnthropicClientRegistry
+        espera = registro._config()["cooldown"]
+        try:
+            espera = float(error.response.headers.get("retry-after", espera))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        with registro._lock:
+            registro._estado[indice]["rate_limited"] += 1
+            registro._estado[indice]["bloqueada_hasta"] = time.monotonic() + espera
+        logging.warning(f"API key #{indice} con rate limit, en espera {espera:.0f}s")
+
+    @staticmethod
+    def _mark_error(indice):
+        with AnthropicClientRegistry._lock:
+            AnthropicClientRegistry._estado[indice]["errors"] += 1
+
+    @staticmethod
+    def create(**kwargs):
+        """messages.create con cambio de key ante rate limit"""
+        registro = AnthropicClientRegistry
+        intentos = len(registro._load_keys())
+        for intento in range(intentos):
+            indice, cliente = registro.get_client()
+            try:
+                return cliente.messages.create(**kwargs)
+            except anthropic.RateLimitError as e:
+                registro._mark_rate_limited(indice, e)
+                if intento == intentos - 1:
+                    raise
+            except anthropic.APIError:
+                registro._mark_error(indice)
+                raise
+
+    @staticmethod
+    async def acreate(**kwargs):
+        """Versión asíncrona de create"""
+        registro = AnthropicClientRegistry
+        intentos = len(registro._load_keys())
+        for intento in range(intentos):
+            indice, cliente = registro.get_async_client()
+            try:
+                return await cliente.messages.create(**kwargs)
+            except anthropic.RateLimitError as e:
+                registro._mark_rate_limited(indice, e)
+                if intento == intentos - 1:
+                    raise
+            except anthropic.APIError:
+                registro._mark_error(indice)
+                raise
+
+    @staticmethod
+    def stream_text(**kwargs):
+        """
+        messages.stream entregando fragmentos de texto. Solo se cambia de key si el
+        rate limit ocurre antes del primer fragmento.
+        """
+        registro = AnthropicClientRegistry
+        intentos = len(registro._load_keys())
+        for intento in range(intentos):
+            indice, cliente = registro.get_client()
+            emitido = False
+            try:
+                with cliente.messages.stream(**kwargs) as stream:
+                    for fragmento in stream.text_stream:
+                        emitido = True
+                        yield fragmento
+                return
+            except anthropic.RateLimitError as e:
+                registro._mark_rate_limited(indice, e)
+                if emitido or intento == intentos - 1:
+                    raise
+            except anthropic.APIError:
+                registro._mark_error(indice)
+                raise
+
+    @staticmethod
+    def stats():
+        """Contadores por key (sin exponer las keys)"""
+        registro = AnthropicClientRegistry
+        registro._load_keys()
+        ahora = time.monotonic()
+        with registro._lock:
+            return [
+                {
+                    "key": i,
+                    "requests": e["requests"],
+                    "rate_limited": e["rate_limited"],
+                    "errors": e["errors"],
+                    "cooldown_seconds": max(0.0, round(e["bloqueada_hasta"] - ahora, 1)),
+                }
+                for i, e in registro._estado.items()
+            ]
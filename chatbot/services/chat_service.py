@@ -1,33 +1,35 @@
-from django.utils import timezone
-from django.db import connection
-import json
+from django.db import connection, transaction
+from asgiref.sync import sync_to_async
 import re
 import logging
-from decimal import Decimal
 
-from ..models import SesionChat, MensajeChat, PreguntaBloqueada, DatosFuenteMensaje, TerminoExcluido
+from ..models import SesionChat, MensajeChat, TerminoExcluido
 from .validation_service import ValidationService
 from .ai_service import AIService
-
-
-class DecimalEncoder(json.JSONEncoder):
-    """JSON encoder that handles Decimal objects"""
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super().default(obj)
+from .result_cache_service import ResultCacheService
+from .history_service import HistoryService
+from .intent_service import IntentService
+from .llm_governor import LLMGovernor, LLMOverloadedError
+from .coalescing_service import CoalescingService
+from .exclusion_service import ExclusionService
+from .query_guard import QueryGuard, QueryRejectedError
+from .analytics_db import AnalyticsDB
+from .source_data_service import SourceDataService
+from .session_counters import SessionCounters
 
 
 class ChatService:
     """Servicio para manejar la lógica de negocio del chat"""
     
+    ADVERTENCIA_COSTOSA = "⚠️ La consulta es demasiado costosa para ejecutarse. Intenta acotarla (por ejemplo, a un mes, región o función)."
+    
     @staticmethod
     def create_session(user):
         """Crea una nueva sesión de chat"""
         try:
             with connection.cursor() as cur:
                 cur.execute(
-                    "INSERT INTO sesion_chat (fecha_inicio, estado, nombre_sesion, usuario_id) VALUES (NOW(), 'activa', %s, %s) RETURNING id_sesion",
+                    "INSERT INTO sesion_chat (fecha_inicio, ultima_actividad, estado, nombre_sesion, usuario_id) VALUES (NOW(), NOW(), 'activa', %s, %s) RETURNING id_sesion",
                     ["Sesión nueva", user.id]
                 )
                 id_sesion = cur.fetchone()[0]
@@ -39,86 +41,268 @@ class ChatService:
     @staticmethod
     def process_message(sesion, pregunta, user):
         """Procesa un mensaje del usuario y genera la respuesta de la IA"""
+        with LLMGovernor.user(user.id):
+            try:
+                # Validar pregunta
+                clasificacion = ValidationService.classify_question(pregunta)
+                if not clasificacion.valida:
+                    return ChatService._handle_invalid_question(sesion, pregunta, clasificacion.razon)
+                
+                terminos_excluidos = ChatService._get_excluded_terms(user)
+                historial_sql, historial_respuesta = HistoryService.get_histories(sesion)
+                
+                # Generar y ejecutar el SQL una sola vez por pregunta idéntica en curso
+                resultado = CoalescingService.execute(
+                    CoalescingService.key(pregunta, terminos_excluidos),
+                    lambda: ChatService._compute_rows(pregunta, historial_sql, terminos_excluidos)
+                )
+                
+                # La respuesta se redacta con el historial de esta sesión, no el del líder
+                resultado = ChatService._compose_answer(pregunta, resultado, historial_respuesta)
+                
+                # Procesar y guardar respuesta
+                return ChatService._save_result(sesion, resultado)
+                
+            except Exception as e:
+                logging.error(f"Error processing message: {e}")
+                raise
+    
+    @staticmethod
+    async def aprocess_message(sesion, pregunta, user):
+        """
+        Versión asíncrona de process_message: las llamadas a Claude usan AsyncAnthropic
+        y el acceso a base de datos usa el ORM asíncrono, de modo que un solo proceso
+        ASGI puede atender muchos mensajes en paralelo.
+        """
+        with LLMGovernor.user(user.id):
+            try:
+                clasificacion = ValidationService.classify_question(pregunta)
+                if not clasificacion.valida:
+                    return await sync_to_async(ChatService._handle_invalid_question)(sesion, pregunta, clasificacion.razon)
+                
+                terminos_excluidos = [
+                    palabra async for palabra in
+                    TerminoExcluido.objects.filter(usuario=user).values_list("palabra", flat=True)
+                ]
+                historial_sql, historial_respuesta = await HistoryService.aget_histories(sesion)
+                
+                clave = await sync_to_async(CoalescingService.key)(pregunta, terminos_excluidos)
+                resultado = await CoalescingService.aexecute(
+                    clave,
+                    lambda: ChatService._acompute_rows(pregunta, historial_sql, terminos_excluidos)
+                )
+                resultado = await ChatService._acompose_answer(pregunta, resultado, historial_respuesta)
+                
+                return await sync_to_async(ChatService._save_result)(sesion, resultado)
+                
+            except Exception as e:
+                logging.error(f"Error processing message (async): {e}")
+                raise
+    
+    @staticmethod
+    def process_message_stream(sesion, pregunta, user):
+        """
+        Variante en streaming de process_message. Genera tuplas (evento, datos) por cada
+        etapa del pipeline: validated, sql_generated, rows_fetched, token (fragmentos de la
+        respuesta) y finalmente done o error. La respuesta se persiste al completar el stream.
+        """
+        with LLMGovernor.user(user.id):
+            try:
+                clasificacion = ValidationService.classify_question(pregunta)
+                if not clasificacion.valida:
+                    result = ChatService._handle_invalid_question(sesion, pregunta, clasificacion.razon)
+                    yield "error", {"message": result["message"]}
+                    return
+                yield "validated", {}
+                
+                terminos_excluidos = ChatService._get_excluded_terms(user)
+                historial_sql, historial_respuesta = HistoryService.get_histories(sesion)
+                
+                vuelo, lider = CoalescingService.begin(CoalescingService.key(pregunta, terminos_excluidos))
+                try:
+                    resultado = None if lider else vuelo.wait()
+                    if resultado is not None:
+                        # Misma pregunta resuelta por otra solicitud en curso: se reutilizan sus filas
+                        if resultado["valido"]:
+                            yield "sql_generated", {}
+                    else:
+                        resultado = {"valido": False}
+                        sql_query = ChatService._generate_sql(pregunta, historial_sql, terminos_excluidos)
+                        consulta = ValidationService.normalize_sql(sql_query)
+                        if consulta is not None:
+                            yield "sql_generated", {}
+                            try:
+                                filas = ChatService._execute_sql_query(ExclusionService.apply(consulta.sql, terminos_excluidos))
+                                resultado = {"valido": True, "filas": filas}
+                            except QueryRejectedError:
+                                resultado["advertencia"] = ChatService.ADVERTENCIA_COSTOSA
+                        if lider:
+                            CoalescingService.publish(vuelo, resultado)
+                finally:
+                    if lider:
+                        CoalescingService.finish(vuelo)
+                
+                if resultado["valido"]:
+                    filas = resultado["filas"]
+                    yield "rows_fetched", {"row_count": len(filas)}
+                    
+                    # El JSON de metadatos va al final de la respuesta: desde la primera "{"
+                    # se retiene el texto hasta saber si corresponde a metadatos
+                    partes = []
+                    retenido = False
+                    for fragmento in AIService.stream_final_response(pregunta, filas, historial_respuesta):
+                        partes.append(fragmento)
+                        if retenido:
+                            continue
+                        pos = fragmento.find("{")
+                        if pos != -1:
+                            retenido = True
+                            fragmento = fragmento[:pos]
+                        if fragmento:
+                            yield "token", {"text": fragmento}
+                    
+                    respuesta, tipo_relacionado, ids_relacionados = AIService._extract_metadata_from_response(
+                        "".join(partes).strip()
+                    )
+                    resultado = {
+                        "valido": True, "filas": filas, "respuesta": respuesta,
+                        "tipo": tipo_relacionado, "ids": ids_relacionados
+                    }
+                
+                result = ChatService._save_result(sesion, resultado)
+                if not resultado["valido"]:
+                    yield "error", {"message": result["message"]}
+                    return
+                yield "done", {
+                    "response": result["message"],
+                    "has_source_data": bool(result.get("datos_fuente")),
+                    "metadata": result.get("ids_extra")
+                }
+                
+            except LLMOverloadedError as e:
+                logging.warning(f"Mensaje rechazado por saturación del LLM: {e}")
+                yield "error", {"message": "El asistente está con alta demanda, intenta nuevamente en unos segundos", "retry_after": e.retry_after}
+            except Exception as e:
+                logging.error(f"Error processing message stream: {e}")
+                yield "error", {"message": "Error procesando mensaje"}
+    
+    @staticmethod
+    def _compute_rows(pregunta, historial_sql, terminos_excluidos):
+        """
+        Genera el SQL y lo ejecuta: la parte compartible entre solicitudes idénticas. La respuesta
+        no se comparte porque se redacta con el historial de cada sesión (ver _compose_answer).
+        """
+        # Plantilla determinista si la pregunta es conocida; si no, SQL generado por Claude
+        sql_query = ChatService._generate_sql(pregunta, historial_sql, terminos_excluidos)
+        consulta = ValidationService.normalize_sql(sql_query)
+        if consulta is None:
+            return {"valido": False}
+        
         try:
-            # Validar pregunta
-            if not ValidationService.is_valid_question(pregunta):
-                return ChatService._handle_invalid_question(sesion, pregunta)
-            
-            # Obtener términos excluidos
-            terminos_excluidos = list(
-                TerminoExcluido.objects.filter(usuario=user).values_list("palabra", flat=True)
-            )
-            
-            # Obtener historial
-            mensajes = MensajeChat.objects.filter(sesion=sesion).order_by('fecha')
-            historial = [
-                {"role": "user" if m.tipo_emisor == "usuario" else "assistant", "content": m.contenido}
-                for m in mensajes
-            ]
-            
-            # Generar SQL y respuesta
-            sql_query = AIService.generate_sql_query(pregunta, historial, terminos_excluidos)
-            
-            if not ValidationService.is_valid_sql(sql_query):
-                return ChatService._handle_invalid_sql(sesion)
-            
-            # Ejecutar consulta
-            filas = ChatService._execute_sql_query(sql_query)
-            
-            # Generar respuesta final
-            respuesta, tipo_relacionado, ids_relacionados = AIService.generate_final_response(
-                pregunta, filas, historial
-            )
-            
-            # Procesar y guardar respuesta
-            return ChatService._save_response(
-                sesion, respuesta, filas, tipo_relacionado, ids_relacionados
-            )
-            
-        except Exception as e:
-            logging.error(f"Error processing message: {e}")
-            raise
+            filas = ChatService._execute_sql_query(ExclusionService.apply(consulta.sql, terminos_excluidos))
+        except QueryRejectedError:
+            return {"valido": False, "advertencia": ChatService.ADVERTENCIA_COSTOSA}
+        return {"valido": True, "filas": filas}
     
     @staticmethod
-    def _handle_invalid_question(sesion, pregunta):
-        """Maneja preguntas inválidas"""
-        advertencia = "⚠️ Tu pregunta no está relacionada con recursos humanos universitarios."
-        MensajeChat.objects.create(
-            sesion=sesion,
-            tipo_emisor="ia",
-            contenido=advertencia,
-            fecha=timezone.now()
+    def _compose_answer(pregunta, resultado, historial_respuesta):
+        """Agrega al resultado (propio o coalescido) la respuesta redactada para esta sesión"""
+        if not resultado["valido"]:
+            return resultado
+        respuesta, tipo_relacionado, ids_relacionados = AIService.generate_final_response(
+            pregunta, resultado["filas"], historial_respuesta
         )
+        return {**resultado, "respuesta": respuesta, "tipo": tipo_relacionado, "ids": ids_relacionados}
+    
+    @staticmethod
+    async def _acompose_answer(pregunta, resultado, historial_respuesta):
+        """Versión asíncrona de _compose_answer"""
+        if not resultado["valido"]:
+            return resultado
+        respuesta, tipo_relacionado, ids_relacionados = await AIService.agenerate_final_response(
+            pregunta, resultado["filas"], historial_respuesta
+        )
+        return {**resultado, "respuesta": respuesta, "tipo": tipo_relacionado, "ids": ids_relacionados}
+    
+    @staticmethod
+    async def _acompute_rows(pregunta, historial_sql, terminos_excluidos):
+        """Versión asíncrona de _compute_rows"""
+        sql_query = await sync_to_async(IntentService.match)(pregunta, terminos_excluidos)
+        if not sql_query:
+            sql_query = await AIService.agenerate_sql_query(
+                pregunta, historial_sql, ExclusionService.prompt_terms(terminos_excluidos)
+            )
+        consulta = ValidationService.normalize_sql(sql_query)
+        if consulta is None:
+            return {"valido": False}
+        sql_final = await sync_to_async(ExclusionService.apply)(consulta.sql, terminos_excluidos)
         
-        _, razon = ValidationService.is_valid_question(pregunta)
-        PreguntaBloqueada.objects.create(
-            sesion=sesion,
-            pregunta=pregunta,
-            razon=razon,
-            fecha=timezone.now()
+        # La consulta analítica es de solo lectura: puede correr fuera del hilo compartido
+        try:
+            filas = await sync_to_async(ChatService._execute_sql_query_threaded, thread_sensitive=False)(sql_final)
+        except QueryRejectedError:
+            return {"valido": False, "advertencia": ChatService.ADVERTENCIA_COSTOSA}
+        return {"valido": True, "filas": filas}
+    
+    @staticmethod
+    def _save_result(sesion, resultado):
+        """Persiste en la sesión el resultado propio o el de una solicitud coalescida"""
+        if not resultado["valido"]:
+            return ChatService._handle_invalid_sql(sesion, resultado.get("advertencia"))
+        return ChatService._save_response(
+            sesion, resultado["respuesta"], resultado["filas"], resultado["tipo"], resultado["ids"]
         )
-        return {"success": False, "message": advertencia}
     
     @staticmethod
-    def _handle_invalid_sql(sesion):
-        """Maneja SQL inválido"""
-        advertencia = "⚠️ Se detectó una combinación de palabras incoherentes. Intenta reformular la pregunta."
-        MensajeChat.objects.create(
-            sesion=sesion,
-            tipo_emisor="ia",
-            contenido=advertencia,
-            fecha=timezone.now()
+    def _generate_sql(pregunta, historial_sql, terminos_excluidos):
+        """
+        Usa la plantilla de IntentService si la pregunta es conocida; si no, genera el SQL con Claude.
+        Las exclusiones las aplica después ExclusionService, por lo que no van al prompt.
+        """
+        return (
+            IntentService.match(pregunta, terminos_excluidos)
+            or AIService.generate_sql_query(pregunta, historial_sql, ExclusionService.prompt_terms(terminos_excluidos))
         )
+    
+    @staticmethod
+    def _get_excluded_terms(user):
+        """Retorna los términos excluidos configurados por el usuario"""
+        return list(
+            TerminoExcluido.objects.filter(usuario=user).values_list("palabra", flat=True)
+        )
+    
+    @staticmethod
+    def _handle_invalid_question(sesion, pregunta, razon):
+        """Maneja preguntas inválidas (la razón viene de la misma clasificación que la rechazó)"""
+        advertencia = "⚠️ Tu pregunta no está relacionada con recursos humanos universitarios."
+        SessionCounters.add_message(sesion, "ia", advertencia)
+        SessionCounters.add_blocked(sesion, pregunta, razon)
+        return {"success": False, "message": advertencia}
+    
+    @staticmethod
+    def _handle_invalid_sql(sesion, advertencia=None):
+        """Maneja SQL inválido o rechazado por el guardián de consultas"""
+        advertencia = advertencia or "⚠️ Se detectó una combinación de palabras incoherentes. Intenta reformular la pregunta."
+        SessionCounters.add_message(sesion, "ia", advertencia)
         return {"success": False, "message": advertencia}
     
     @staticmethod
     def _execute_sql_query(sql_query):
-        """Ejecuta la consulta SQL y retorna los resultados"""
-        with connection.cursor() as cur:
-            cur.execute(sql_query)
-            columnas = [desc[0] for desc in cur.description]
-            filas = [dict(zip(columnas, row)) for row in cur.fetchall()]
-        return filas
+        """Ejecuta la consulta SQL (o la obtiene desde caché) y retorna los resultados"""
+        return ResultCacheService.get_or_execute(sql_query, ChatService._run_sql_query)
+    
+    @staticmethod
+    def _execute_sql_query_threaded(sql_query):
+        """Ejecuta la consulta desde un hilo del executor, respetando CONN_MAX_AGE al terminar"""
+        try:
+            return ChatService._execute_sql_query(sql_query)
+        finally:
+            AnalyticsDB.close_if_unusable_or_obsolete()
+    
+    @staticmethod
+    def _run_sql_query(sql_query):
+        """Ejecuta la consulta SQL en el alias analítico, previa evaluación de su plan"""
+        return QueryGuard.execute(sql_query)
     
     @staticmethod
     def _save_response(sesion, respuesta, filas, tipo_relacionado, ids_relacionados):
@@ -129,32 +313,21 @@ class ChatService:
             # Crear el JSON que espera el frontend basado en los datos ya extraídos
             ids_extra = {tipo_relacionado: ids_relacionados}
         
-        # Crear mensaje
-        mensaje = MensajeChat.objects.create(
-            sesion=sesion,
-            tipo_emisor="ia",
-            contenido=respuesta,
-            fecha=timezone.now()
-        )
-        
-        # Guardar metadata
         metadata = {}
         if ids_relacionados:
             metadata["tipo"] = tipo_relacionado
             metadata["ids"] = ids_relacionados
         
-        if metadata:
-            mensaje.metadata = metadata
-            mensaje.save()
-        
-        # Guardar datos fuente
-        if filas:
-            json_valido = json.dumps(filas, cls=DecimalEncoder)
-            DatosFuenteMensaje.objects.create(mensaje=mensaje, datos=json_valido)
+        # Mensaje (con su metadata), contadores de la sesión y datos fuente en una sola transacción
+        with transaction.atomic():
+            mensaje = SessionCounters.add_message(sesion, "ia", respuesta, metadata or None)
+            if filas:
+                SourceDataService.store(mensaje, filas)
         
         return {
             "success": True,
             "message": respuesta,
+            "message_id": mensaje.id_mensaje,
             "datos_fuente": filas,
             "ids_extra": ids_extra
         }
@@ -176,7 +349,7 @@ class ChatService:
     @staticmethod
     def can_delete_session(sesion_id):
         """Verifica si una sesión puede ser eliminada"""
-        return not PreguntaBloqueada.objects.filter(sesion_id=sesion_id).exists()
+        return not SessionCounters.has_blocked(sesion_id)
     
     @staticmethod
     def delete_session(sesion_id, user):
@@ -185,8 +358,11 @@ class ChatService:
             return False
         
         try:
-            MensajeChat.objects.filter(sesion_id=sesion_id).delete()
-            SesionChat.objects.filter(id_sesion=sesion_id, usuario=user).delete()
+            with transaction.atomic():
+                mensajes = MensajeChat.objects.filter(sesion_id=sesion_id)
+                SourceDataService.release(mensajes)
+                mensajes.delete()
+                SesionChat.objects.filter(id_sesion=sesion_id, usuario=user).delete()
             return True
         except Exception as e:
             logging.error(f"Error deleting session: {e}")
@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from ..models import ContextoPrompt, SolicitudEnCurso
+from .sql_cache_service import SQLCacheService
+from .result_cache_service import ResultCacheService
+from .exclusion_service import ExclusionService
+from .columnar_result import ResultadoColumnar
+
+
+class _Vuelo:
+    """Una ejecución en curso a la que pueden sumarse otras solicitudes idénticas"""
+
+    def __init__(self, clave):
+        self.clave = clave
+        self.evento = threading.Event()
+        self.resultado = None
+        self.publicado = False
+        self.reclamado_en_bd = False
+        self.remoto = False
+        self._lock = threading.Lock()
+        self._futuros = []
+
+    def wait(self, timeout=None):
+        """Resultado del líder, o None si falló o no terminó a tiempo"""
+        self.evento.wait(CoalescingService.ESPERA_MAXIMA if timeout is None else timeout)
+        return self.resultado
+
+    async def wait_async(self, timeout=None):
+        """Como wait, pero espera un future del event loop en vez de ocupar un hilo"""
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        with self._lock:
+            if self.evento.is_set():
+                return self.resultado
+            self._futuros.append((loop, futuro))
+        try:
+            await asyncio.wait_for(futuro, CoalescingService.ESPERA_MAXIMA if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                if (loop, futuro) in self._futuros:
+                    self._futuros.remove((loop, futuro))
+        return self.resultado
+
+    def set(self):
+        """Despierta a los seguidores, tanto hilos como corrutinas"""
+        with self._lock:
+            self.evento.set()
+            futuros, self._futuros = self._futuros, []
+        for loop, futuro in futuros:
+            try:
+                loop.call_soon_threadsafe(_Vuelo._notify, futuro)
+            except RuntimeError:
+                # Event loop cerrado: nadie espera ya ese future
+                pass
+
+    @staticmethod
+    def _notify(futuro):
+        if not futuro.done():
+            futuro.set_result(True)
+
+
+class CoalescingService:
+    """
+    Coalesce preguntas idénticas en curso: la primera solicitud (líder) genera el SQL y
+    lo ejecuta; las demás esperan esas filas y redactan su propia respuesta con el
+    historial de su sesión. Dentro de un proceso se coordina con eventos entre hilos y,
+    con CHAT_COALESCE_DB=true, entre workers mediante la tabla solicitudes_en_curso.
+    """
+
+    HABILITADO = os.getenv("CHAT_COALESCE_ENABLED", "true").lower() == "true"
+    ENTRE_WORKERS = os.getenv("CHAT_COALESCE_DB", "false").lower() == "true"
+    ESPERA_MAXIMA = float(os.getenv("CHAT_COALESCE_WAIT", "60"))
+    INTERVALO_SONDEO = float(os.getenv("CHAT_COALESCE_POLL_INTERVAL", "0.25"))
+    # Tiempo que el resultado queda en la tabla para los workers que aún sondean
+    RETENCION = float(os.getenv("CHAT_COALESCE_DB_RETENTION", "10"))
+
+    _vuelos = {}
+    _lock = threading.Lock()
+    _stats = {"leaders": 0, "followers": 0, "remote_followers": 0, "fallbacks": 0}
+
+    @staticmethod
+    def key(pregunta, terminos_excluidos=None):
+        """
+        Clave de coalescencia: pregunta normalizada, términos excluidos, contexto activo
+        y versión de datos. None si la pregunta depende del historial de la sesión.
+        """
+        if not CoalescingService.HABILITADO or not SQLCacheService.is_cacheable(pregunta):
+            return None
+        contexto = ContextoPrompt.objects.filter(activo=True).values_list("id", "prompt_sistema").first()
+        partes = [
+            SQLCacheService.normalize_question(pregunta),
+            # Misma normalización que el motor de exclusiones: términos equivalentes, misma clave
+            "|".join(ExclusionService.signature(terminos_excluidos)),
+            f"{contexto[0]}:{hashlib.sha256(contexto[1].encode('utf-8')).hexdigest()}" if contexto else "",
+            str(ResultCacheService.data_version()),
+        ]
+        return hashlib.sha256("\n".join(partes).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def begin(clave, sondear=True):
+        """
+        Retorna (vuelo, es_lider). Con clave None no se coalesce: (None, True).
+        El líder debe llamar a publish() con el resultado y siempre a finish().
+        Con sondear=False, si otro worker tiene la clave se retorna sin esperarlo y
+        quien llama debe sondear la tabla (ver aexecute).
+        """
+        if clave is None:
+            return None, True
+
+        servicio = CoalescingService
+        with servicio._lock:
+            vuelo = servicio._vuelos.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = _Vuelo(clave)
+                servicio._vuelos[clave] = vuelo
+                servicio._stats["leaders"] += 1
+            else:
+                servicio._stats["followers"] += 1
+        if not lider:
+            return vuelo, False
+
+        if servicio.ENTRE_WORKERS and not servicio._claim(vuelo):
+            # Otro worker ya la está resolviendo: este proceso espera su resultado
+            with servicio._lock:
+                servicio._stats["leaders"] -= 1
+                servicio._stats["remote_followers"] += 1
+            vuelo.remoto = True
+            if sondear:
+                servicio._complete(vuelo, servicio._poll(clave))
+            return vuelo, False
+        return vuelo, True
+
+    @staticmethod
+    def publish(vuelo, resultado):
+        """Entrega el resultado del líder a los seguidores"""
+        if vuelo is None:
+            return
+        vuelo.resultado = resultado
+        vuelo.publicado = True
+        if vuelo.reclamado_en_bd:
+            try:
+                SolicitudEnCurso.objects.filter(clave=vuelo.clave).update(
+                    estado="listo", resultado=json.dumps(resultado, default=CoalescingService._json_default)
+                )
+            except Exception as e:
+                logging.error(f"Error publicando resultado coalescido: {e}")
+        vuelo.set()
+
+    @staticmethod
+    def finish(vuelo):
+        """Cierra el vuelo; si el líder no publicó, los seguidores calculan por su cuenta"""
+        if vuelo is None:
+            return
+        if not vuelo.publicado and vuelo.reclamado_en_bd:
+            SolicitudEnCurso.objects.filter(clave=vuelo.clave).delete()
+        CoalescingService._complete(vuelo, vuelo.resultado)
+
+    @staticmethod
+    def execute(clave, calcular):
+        """Ejecuta `calcular` una sola vez por clave y comparte el resultado"""
+        vuelo, lider = CoalescingService.begin(clave)
+        if not lider:
+            resultado = vuelo.wait()
+            if resultado is not None:
+                return resultado
+            CoalescingService._fallback()
+            return calcular()
+        try:
+            resultado = calcular()
+            CoalescingService.publish(vuelo, resultado)
+            return resultado
+        finally:
+            CoalescingService.finish(vuelo)
+
+    @staticmethod
+    async def aexecute(clave, acalcular):
+        """
+        Versión asíncrona de execute; `acalcular` retorna una corrutina. Los seguidores
+        esperan en el event loop: ni la espera local ni el sondeo remoto ocupan un hilo.
+        """
+        vuelo, lider = await sync_to_async(CoalescingService.begin, thread_sensitive=False)(clave, sondear=False)
+        if not lider:
+            if vuelo.remoto and not vuelo.evento.is_set():
+                CoalescingService._complete(vuelo, await CoalescingService._apoll(clave))
+            resultado = await vuelo.wait_async()
+            if resultado is not None:
+                return resultado
+            CoalescingService._fallback()
+            return await acalcular()
+        try:
+            resultado = await acalcular()
+            await sync_to_async(CoalescingService.publish)(vuelo, resultado)
+            return resultado
+        finally:
+            await sync_to_async(CoalescingService.finish)(vuelo)
+
+    @staticmethod
+    def stats():
+        """Líderes, seguidores (locales y de otros workers) y vuelos en curso"""
+        with CoalescingService._lock:
+            return {**CoalescingService._stats, "in_flight": len(CoalescingService._vuelos)}
+
+    @staticmethod
+    def _fallback():
+        logging.warning("Líder de solicitud coalescida sin resultado, se calcula localmente")
+        with CoalescingService._lock:
+            CoalescingService._stats["fallbacks"] += 1
+
+    @staticmethod
+    def _complete(vuelo, resultado):
+        vuelo.resultado = resultado
+        with CoalescingService._lock:
+            if CoalescingService._vuelos.get(vuelo.clave) is vuelo:
+                del CoalescingService._vuelos[vuelo.clave]
+        vuelo.set()
+
+    @staticmethod
+    def _claim(vuelo):
+        """Intenta registrar la clave en la tabla de locks; False si otro worker la tiene"""
+        servicio = CoalescingService
+        vencimiento = timezone.now() - timedelta(seconds=servicio.ESPERA_MAXIMA + servicio.RETENCION)
+        SolicitudEnCurso.objects.filter(fecha_creacion__lt=vencimiento).delete()
+        try:
+            with transaction.atomic():
+                SolicitudEnCurso.objects.create(clave=vuelo.clave)
+        except IntegrityError:
+            # El resultado retenido de una ejecución anterior ya no está "en curso"
+            retenido = timezone.now() - timedelta(seconds=servicio.RETENCION)
+            if not SolicitudEnCurso.objects.filter(
+                clave=vuelo.clave, estado="listo", fecha_creacion__lt=retenido
+            ).delete()[0]:
+                return False
+            try:
+                with transaction.atomic():
+                    SolicitudEnCurso.objects.create(clave=vuelo.clave)
+            except IntegrityError:
+                return False
+        vuelo.reclamado_en_bd = True
+        return True
+
+    @staticmethod
+    def _poll(clave):
+        """Sondea la tabla hasta que el líder remoto publique (None si falla o expira)"""
+        limite = time.monotonic() + CoalescingService.ESPERA_MAXIMA
+        while time.monotonic() < limite:
+            fila = SolicitudEnCurso.objects.filter(clave=clave).values_list("estado", "resultado").first()
+            if fila is None:
+                return None
+            if fila[0] == "listo":
+                return json.loads(fila[1])
+            time.sleep(CoalescingService.INTERVALO_SONDEO)
+        return None
+
+    @staticmethod
+    async def _apoll(clave):
+        """Versión asíncrona de _poll: consultas cortas en el pool de sync_to_async y esperas en el event loop"""
+        consultar = sync_to_async(
+            lambda: SolicitudEnCurso.objects.filter(clave=clave).values_list("estado", "resultado").first(),
+            thread_sensitive=False,
+        )
+        limite = time.monotonic() + CoalescingService.ESPERA_MAXIMA
+        while time.monotonic() < limite:
+            fila = await consultar()
+            if fila is None:
+                return None
+            if fila[0] == "listo":
+                return json.loads(fila[1])
+            await asyncio.sleep(CoalescingService.INTERVALO_SONDEO)
+        return None
+
+    @staticmethod
+    def _json_default(obj):
+        if isinstance(obj, ResultadoColumnar):
+            return obj.rows()
+        if isinstance(obj, Decimal):
+            return float(obj)
+        if hasattr(obj, "isoformat"):
+            return obj.isoformat()
+        raise TypeError(f"Tipo no serializable: {type(obj).__name__}")
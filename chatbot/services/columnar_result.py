@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+from datetime import date, datetime, time
+from decimal import Decimal
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ResultadoColumnar:
+    """
+    Resultado de una consulta guardado por columnas: los nombres una sola vez y, por
+    columna, un arreglo tipado (enteros o flotantes sin nulos) o una lista. Los Decimal
+    se convierten por columna a int (si todos son enteros) o float. Se comporta como la
+    lista de dicts anterior (len, índice, iteración) para los consumidores que lo necesiten,
+    pero el prompt, la persistencia y la API lo recorren por columnas.
+    """
+
+    __slots__ = ("columnas", "datos", "truncado")
+
+    TAMANO_LOTE = int(os.getenv("SQL_FETCH_BATCH_SIZE", "500"))
+
+    # Formato binario: MAGIA + versión + códec (z=zlib, s=zstd) + carga comprimida
+    MAGIA = b"RC"
+    VERSION = 1
+
+    _MIN_ENTERO, _MAX_ENTERO = -(2 ** 63), 2 ** 63 - 1
+
+    def __init__(self, columnas, datos, truncado=False):
+        self.columnas = tuple(columnas)
+        self.datos = list(datos)
+        self.truncado = truncado
+
+    # ------------------- Construcción -------------------
+
+    @classmethod
+    def from_cursor(cls, cursor, tope, lote=None):
+        """
+        Lee el cursor con fetchmany en lotes y transpone cada lote a las columnas,
+        sin crear un dict por fila. Se detiene al superar `tope` filas (truncado=True).
+        """
+        lote = lote or cls.TAMANO_LOTE
+        columnas = listas = None
+        # Se pide una fila más que el tope solo para saber si el resultado quedó truncado
+        pendientes = tope + 1
+        while pendientes > 0:
+            filas = cursor.fetchmany(min(lote, pendientes))
+            if columnas is None:
+                # Un cursor con nombre de psycopg2 recién tiene description tras el primer FETCH
+                columnas = [desc[0] for desc in cursor.description]
+                listas = [[] for _ in columnas]
+            if not filas:
+                break
+            for lista, valores in zip(listas, zip(*filas)):
+                lista.extend(valores)
+            pendientes -= len(filas)
+        truncado = pendientes <= 0
+        if truncado:
+            for lista in listas:
+                del lista[tope:]
+            logging.warning(f"Resultado truncado a {tope} filas")
+        return cls(columnas, [cls._compact(lista) for lista in listas], truncado)
+
+    @classmethod
+    def from_rows(cls, filas):
+        """Desde una lista de dicts (resultados antiguos en caché o coalescidos entre workers)"""
+        if not filas:
+            return cls((), [])
+        columnas = list(filas[0].keys())
+        return cls(columnas, [cls._compact([fila.get(c) for fila in filas]) for c in columnas])
+
+    @classmethod
+    def of(cls, filas):
+        """El mismo objeto si ya es columnar; si no, lo construye desde la lista de dicts"""
+        return filas if isinstance(filas, cls) else cls.from_rows(filas)
+
+    @classmethod
+    def _compact(cls, valores):
+        """Convierte los Decimal de la columna y la guarda en un arreglo tipado si es posible"""
+        no_nulos = [v for v in valores if v is not None]
+        if not no_nulos:
+            return valores
+        tipos = set(map(type, no_nulos))
+        if tipos == {Decimal}:
+            if all(v == v.to_integral_value() for v in no_nulos):
+                valores = [None if v is None else int(v) for v in valores]
+                tipos = {int}
+            else:
+                valores = [None if v is None else float(v) for v in valores]
+                tipos = {float}
+        if len(no_nulos) < len(valores):
+            return valores
+        if tipos == {int} and cls._MIN_ENTERO <= min(valores) and max(valores) <= cls._MAX_ENTERO:
+            return array("q", valores)
+        if tipos == {float}:
+            return array("d", valores)
+        return valores
+
+    # ------------------- Acceso -------------------
+
+    def __len__(self):
+        return len(self.datos[0]) if self.datos else 0
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getitem__(self, indice):
+        if isinstance(indice, slice):
+            return ResultadoColumnar(self.columnas, [columna[indice] for columna in self.datos], self.truncado)
+        return {c: columna[indice] for c, columna in zip(self.columnas, self.datos)}
+
+    def __iter__(self):
+        for valores in zip(*self.datos):
+            yield dict(zip(self.columnas, valores))
+
+    def __eq__(self, otro):
+        if isinstance(otro, ResultadoColumnar):
+            return self.columnas == otro.columnas and list(map(list, self.datos)) == list(map(list, otro.datos))
+        if isinstance(otro, list):
+            return self.rows() == otro
+        return NotImplemented
+
+    def __repr__(self):
+        return f"ResultadoColumnar({len(self)} filas, columnas={list(self.columnas)})"
+
+    def column(self, nombre):
+        return self.datos[self.columnas.index(nombre)]
+
+    def rows(self):
+        """Lista de dicts, para los consumidores que todavía trabajan por fila"""
+        return list(self)
+
+    # ------------------- Serialización -------------------
+
+    def to_json(self):
+        """
+        JSON de la lista de filas (mismo formato que json.dumps de la lista de dicts),
+        codificando cada columna de una vez y armando las filas con fragmentos de texto.
+        """
+        if not self.datos:
+            return "[]"
+        claves = [json.dumps(c, ensure_ascii=True) + ": " for c in self.columnas]
+        columnas = [self._encode_column(columna) for columna in self.datos]
+        return "[" + ", ".join(
+            "{" + ", ".join(clave + valor for clave, valor in zip(claves, valores)) + "}"
+            for valores in zip(*columnas)
+        ) + "]"
+
+    @staticmethod
+    def _encode_column(columna):
+        if isinstance(columna, array):
+            return list(map(str, columna)) if columna.typecode == "q" else list(map(json.dumps, columna))
+        return [json.dumps(ResultadoColumnar._json_value(v)) for v in columna]
+
+    @staticmethod
+    def _json_value(valor):
+        if isinstance(valor, Decimal):
+            return float(valor)
+        if isinstance(valor, (date, datetime, time)):
+            return valor.isoformat()
+        return valor
+
+    def to_bytes(self, codec="zlib"):
+        """
+        Formato compacto para guardar: encabezado JSON con columnas y tipos una sola vez,
+        arreglos tipados como bytes little-endian y las demás columnas como listas JSON,
+        todo comprimido con zlib o zstd.
+        """
+        return self.compress(self.payload(), codec)
+
+    def payload(self):
+        """Codificación canónica sin comprimir: resultados iguales producen los mismos bytes"""
+        tipos, bloques = [], []
+        for columna in self.datos:
+            if isinstance(columna, array):
+                if sys.byteorder == "big":
+                    columna = array(columna.typecode, columna)
+                    columna.byteswap()
+                tipos.append(columna.typecode)
+                bloques.append(columna.tobytes())
+            else:
+                tipos.append("j")
+                bloques.append(json.dumps([self._json_value(v) for v in columna]).encode("utf-8"))
+        encabezado = json.dumps({
+            "c": self.columnas, "t": tipos, "n": [len(b) for b in bloques], "f": len(self), "tr": self.truncado,
+        }).encode("utf-8")
+        return struct.pack("<I", len(encabezado)) + encabezado + b"".join(bloques)
+
+    @classmethod
+    def compress(cls, carga, codec="zlib"):
+        if codec == "zstd" and zstandard is not None:
+            return cls.MAGIA + bytes([cls.VERSION]) + b"s" + zstandard.ZstdCompressor(level=3).compress(carga)
+        return cls.MAGIA + bytes([cls.VERSION]) + b"z" + zlib.compress(carga, 6)
+
+    @classmethod
+    def from_bytes(cls, contenido):
+        """Inverso de to_bytes; acepta bytes o memoryview (BinaryField de PostgreSQL)"""
+        contenido = bytes(contenido)
+        if contenido[:2] != cls.MAGIA or contenido[2] != cls.VERSION:
+            raise ValueError("Formato de resultado desconocido")
+        codec = contenido[3:4]
+        if codec == b"s":
+            if zstandard is None:
+                raise ValueError("El resultado está comprimido con zstd y el paquete zstandard no está instalado")
+            carga = zstandard.ZstdDecompressor().decompress(contenido[4:])
+        elif codec == b"z":
+            carga = zlib.decompress(contenido[4:])
+        else:
+            raise ValueError(f"Códec desconocido: {codec!r}")
+
+        (largo,) = struct.unpack_from("<I", carga)
+        encabezado = json.loads(carga[4:4 + largo])
+        posicion = 4 + largo
+        datos = []
+        for tipo, tamano in zip(encabezado["t"], encabezado["n"]):
+            bloque = carga[posicion:posicion + tamano]
+            posicion += tamano
+            if tipo == "j":
+                datos.append(json.loads(bloque))
+            else:
+                columna = array(tipo)
+                columna.frombytes(bloque)
+                if sys.byteorder == "big":
+                    columna.byteswap()
+                datos.append(columna)
+        return cls(encabezado["c"], datos, encabezado["tr"])
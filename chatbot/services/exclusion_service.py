@@ -0,0 +1,178 @@
+import logging
+import os
+import re
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db.models import CharField, Func, Q, Value
+from django.db.models.functions import Lower
+
+from ..models import Persona, Funcion, TiempoContrato, Contrato, TerminoExcluido
+from .sql_cache_service import SQLCacheService
+from .result_cache_service import ResultCacheService
+from .sql_parser import SQLParser
+
+
+class ExclusionService:
+    """
+    Motor de exclusiones: en lugar de pedirle al modelo filtros NOT LIKE por cada término
+    excluido, precalcula los ids de persona, función, tiempo y contrato que coinciden con
+    los términos (en nombre_completo, descripcion_funcion, calificacion_profesional, mes
+    y region) y los aplica como anti-join sobre el SQL ya analizado. Los conjuntos se
+    guardan como arreglos de ids comprimidos, por combinación de términos y versión de datos.
+    """
+
+    HABILITADO = os.getenv("EXCLUSION_ENGINE_ENABLED", "true").lower() == "true"
+    TTL = int(os.getenv("EXCLUSION_CACHE_TTL", "86400"))
+    MAX_EN_MEMORIA = 256
+
+    # Tabla consultable -> columna id sobre la que se aplica el anti-join
+    COLUMNAS_ID = {
+        "persona": "id_persona",
+        "funcion": "id_funcion",
+        "tiempo_contrato": "id_tiempo",
+        "contrato": "id_contrato",
+    }
+
+    # Mismas equivalencias que SQLCacheService.normalize_question, aplicadas en la base
+    # (también las mayúsculas, por si LOWER no las convierte según la collation)
+    _TILDES = (
+        "áàâäãéèêëíìîïóòôöõúùûüñçÁÀÂÄÃÉÈÊËÍÌÎÏÓÒÔÖÕÚÙÛÜÑÇ",
+        "aaaaaeeeeiiiiooooouuuuncaaaaaeeeeiiiiooooouuuunc",
+    )
+
+    _memoria = OrderedDict()
+    _lock = threading.Lock()
+    _stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def signature(terminos_excluidos):
+        """Términos normalizados, únicos y ordenados"""
+        return tuple(sorted({
+            SQLCacheService.normalize_question(t) for t in (terminos_excluidos or []) if t and t.strip()
+        }))
+
+    @staticmethod
+    def prompt_terms(terminos_excluidos):
+        """Términos que deben ir en el prompt de SQL: ninguno si el motor aplica las exclusiones"""
+        return [] if ExclusionService.HABILITADO else terminos_excluidos
+
+    @staticmethod
+    def excluded_ids(terminos_excluidos):
+        """{tabla: frozenset de ids excluidos} para los términos dados"""
+        firma = ExclusionService.signature(terminos_excluidos)
+        if not firma:
+            return {}
+        clave = f"exclusiones:{ResultCacheService.data_version()}:{'|'.join(firma)}"
+
+        with ExclusionService._lock:
+            conjuntos = ExclusionService._memoria.get(clave)
+            if conjuntos is not None:
+                ExclusionService._memoria.move_to_end(clave)
+                ExclusionService._stats["hits"] += 1
+                return conjuntos
+
+        guardado = cache.get(clave)
+        if guardado is not None:
+            conjuntos = {tabla: ExclusionService._decode(datos) for tabla, datos in guardado.items()}
+        else:
+            conjuntos = ExclusionService._compute(firma)
+            cache.set(clave, {tabla: ExclusionService._encode(ids) for tabla, ids in conjuntos.items()}, ExclusionService.TTL)
+            logging.info(
+                f"Exclusiones calculadas para {len(firma)} términos: "
+                + ", ".join(f"{tabla}={len(ids)}" for tabla, ids in conjuntos.items())
+            )
+
+        with ExclusionService._lock:
+            ExclusionService._stats["misses"] += 1
+            ExclusionService._memoria[clave] = conjuntos
+            while len(ExclusionService._memoria) > ExclusionService.MAX_EN_MEMORIA:
+                ExclusionService._memoria.popitem(last=False)
+        return conjuntos
+
+    @staticmethod
+    def apply(sql, terminos_excluidos):
+        """SQL canónico con los anti-joins de exclusión agregados (sin cambios si no hay términos)"""
+        if not ExclusionService.HABILITADO or not terminos_excluidos:
+            return sql
+        conjuntos = ExclusionService.excluded_ids(terminos_excluidos)
+        return SQLParser.add_anti_joins(sql, {
+            tabla: (ExclusionService.COLUMNAS_ID[tabla], ids) for tabla, ids in conjuntos.items()
+        })
+
+    @staticmethod
+    def refresh_user(user):
+        """Precalcula las exclusiones del usuario tras un cambio en sus términos"""
+        if not ExclusionService.HABILITADO:
+            return
+        try:
+            ExclusionService.excluded_ids(
+                TerminoExcluido.objects.filter(usuario=user).values_list("palabra", flat=True)
+            )
+        except Exception as e:
+            logging.error(f"Error precalculando exclusiones: {e}")
+
+    @staticmethod
+    def stats():
+        with ExclusionService._lock:
+            return {
+                "enabled": ExclusionService.HABILITADO,
+                **ExclusionService._stats,
+                "sets_in_memory": len(ExclusionService._memoria),
+            }
+
+    @staticmethod
+    def _compute(firma):
+        """
+        Ids cuyas columnas de texto contienen alguno de los términos como palabra o frase completa.
+        La coincidencia se evalúa en la base (expresión regular sobre la columna en minúsculas y
+        sin tildes), sin traer las tablas de dimensiones a Python.
+        """
+        # Límites de palabra con lookarounds; entre las palabras de una frase, cualquier separador
+        patron = r"(?<![0-9a-z_])(?:" + "|".join(
+            r"[^0-9a-z_]+".join(re.escape(palabra) for palabra in termino.split()) for termino in firma
+        ) + r")(?![0-9a-z_])"
+
+        def coincidentes(modelo, columna_id, *columnas):
+            textos = {f"texto_{columna}": ExclusionService._normalized(columna) for columna in columnas}
+            filtro = Q()
+            for alias in textos:
+                filtro |= Q(**{f"{alias}__regex": patron})
+            return set(modelo.objects.annotate(**textos).filter(filtro).values_list(columna_id, flat=True))
+
+        personas = coincidentes(Persona, "id_persona", "nombre_completo")
+        funciones = coincidentes(Funcion, "id_funcion", "descripcion_funcion", "calificacion_profesional")
+        tiempos = coincidentes(TiempoContrato, "id_tiempo", "mes", "region")
+        contratos = set()
+        if personas or funciones or tiempos:
+            contratos = set(Contrato.objects.filter(
+                Q(persona_id__in=personas) | Q(funcion_id__in=funciones) | Q(tiempo_id__in=tiempos)
+            ).values_list("id_contrato", flat=True))
+        return {
+            "persona": frozenset(personas),
+            "funcion": frozenset(funciones),
+            "tiempo_contrato": frozenset(tiempos),
+            "contrato": frozenset(contratos),
+        }
+
+    @staticmethod
+    def _normalized(columna):
+        """Columna en minúsculas y sin tildes"""
+        return Func(
+            Lower(columna), Value(ExclusionService._TILDES[0]), Value(ExclusionService._TILDES[1]),
+            function="translate", output_field=CharField(),
+        )
+
+    @staticmethod
+    def _encode(ids):
+        """Arreglo ordenado de enteros sin signo de 32 bits, comprimido"""
+        return zlib.compress(array("I", sorted(ids)).tobytes())
+
+    @staticmethod
+    def _decode(datos):
+        ids = array("I")
+        ids.frombytes(zlib.decompress(datos))
+        return frozenset(ids)
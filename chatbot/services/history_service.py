@@ -0,0 +1,162 @@
+import logging
+import os
+
+from ..models import MensajeChat, ResumenSesion
+from .llm_backend import LLMBackend
+
+
+class HistoryService:
+    """
+    Arma el historial que se envía a Claude con un presupuesto de tokens por etapa.
+    Los mensajes más recientes van textuales; los anteriores se incorporan de forma
+    incremental a un resumen persistido por sesión (ResumenSesion).
+    """
+
+    MENSAJES_RECIENTES = int(os.getenv("HISTORY_RECENT_MESSAGES", "8"))
+    LOTE_RESUMEN = int(os.getenv("HISTORY_SUMMARY_BATCH", "4"))
+    PRESUPUESTOS = {
+        "sql": int(os.getenv("HISTORY_TOKEN_BUDGET_SQL", "1500")),
+        "respuesta": int(os.getenv("HISTORY_TOKEN_BUDGET_ANSWER", "3000")),
+    }
+
+    @staticmethod
+    def estimate_tokens(texto):
+        """Estimación aproximada de tokens (~4 caracteres por token)"""
+        return max(1, len(texto or "") // 4)
+
+    @staticmethod
+    def get_histories(sesion):
+        """Retorna (historial_sql, historial_respuesta) leyendo los mensajes una sola vez"""
+        mensajes = list(
+            MensajeChat.objects.filter(sesion=sesion)
+            .order_by('fecha', 'id_mensaje')
+            .only('id_mensaje', 'tipo_emisor', 'contenido')
+        )
+        resumen = HistoryService._update_summary(sesion, mensajes)
+        return HistoryService._build(resumen, mensajes)
+
+    @staticmethod
+    async def aget_histories(sesion):
+        """
+        Versión asíncrona de get_histories: ORM asíncrono y resumen con acreate, de modo que
+        una llamada de resumen (o la espera de cupo en el gobernador) no bloquea el hilo
+        compartido de sync_to_async del que dependen las demás solicitudes.
+        """
+        mensajes = [
+            m async for m in MensajeChat.objects.filter(sesion=sesion)
+            .order_by('fecha', 'id_mensaje')
+            .only('id_mensaje', 'tipo_emisor', 'contenido')
+        ]
+        resumen = await HistoryService._aupdate_summary(sesion, mensajes)
+        return HistoryService._build(resumen, mensajes)
+
+    @staticmethod
+    def _build(resumen, mensajes):
+        """(historial_sql, historial_respuesta) a partir del resumen y los mensajes que no cubre"""
+        pendientes = [m for m in mensajes if m.id_mensaje > resumen.ultimo_mensaje]
+        return (
+            HistoryService._fit_budget(resumen.resumen, pendientes, HistoryService.PRESUPUESTOS["sql"]),
+            HistoryService._fit_budget(resumen.resumen, pendientes, HistoryService.PRESUPUESTOS["respuesta"]),
+        )
+
+    @staticmethod
+    def _to_message(m):
+        return {"role": "user" if m.tipo_emisor == "usuario" else "assistant", "content": m.contenido}
+
+    @staticmethod
+    def _fit_budget(resumen, mensajes, presupuesto):
+        """Incluye el resumen y los mensajes más nuevos que quepan en el presupuesto"""
+        historial = []
+        restante = presupuesto
+        if resumen:
+            restante -= HistoryService.estimate_tokens(resumen)
+
+        for m in reversed(mensajes):
+            costo = HistoryService.estimate_tokens(m.contenido)
+            # El mensaje más reciente (la pregunta actual) siempre se incluye
+            if historial and costo > restante:
+                break
+            historial.append(HistoryService._to_message(m))
+            restante -= costo
+        historial.reverse()
+
+        if resumen:
+            historial.insert(0, {"role": "user", "content": f"Resumen de la conversación anterior: {resumen}"})
+        return historial
+
+    @staticmethod
+    def _update_summary(sesion, mensajes):
+        """
+        Incorpora al resumen los mensajes que quedaron fuera de la ventana reciente.
+        Solo se llama a Claude cuando se acumula un lote completo, para no resumir en cada turno.
+        """
+        resumen, _ = ResumenSesion.objects.get_or_create(sesion=sesion)
+        nuevos = HistoryService._summary_batch(resumen, mensajes)
+        if not nuevos:
+            return resumen
+
+        try:
+            resumen.resumen = HistoryService._summarize(resumen.resumen, nuevos)
+            resumen.ultimo_mensaje = nuevos[-1].id_mensaje
+            resumen.save(update_fields=['resumen', 'ultimo_mensaje', 'fecha_actualizacion'])
+        except Exception as e:
+            # Sin resumen actualizado se sigue con los mensajes textuales recortados por presupuesto
+            logging.error(f"Error actualizando resumen de sesión {sesion.id_sesion}: {e}")
+        return resumen
+
+    @staticmethod
+    async def _aupdate_summary(sesion, mensajes):
+        """Versión asíncrona de _update_summary"""
+        resumen, _ = await ResumenSesion.objects.aget_or_create(sesion=sesion)
+        nuevos = HistoryService._summary_batch(resumen, mensajes)
+        if not nuevos:
+            return resumen
+
+        try:
+            resumen.resumen = await HistoryService._asummarize(resumen.resumen, nuevos)
+            resumen.ultimo_mensaje = nuevos[-1].id_mensaje
+            await resumen.asave(update_fields=['resumen', 'ultimo_mensaje', 'fecha_actualizacion'])
+        except Exception as e:
+            logging.error(f"Error actualizando resumen de sesión {sesion.id_sesion}: {e}")
+        return resumen
+
+    @staticmethod
+    def _summary_batch(resumen, mensajes):
+        """Mensajes fuera de la ventana reciente aún no resumidos, si ya completan un lote"""
+        fuera_de_ventana = mensajes[:-HistoryService.MENSAJES_RECIENTES] if HistoryService.MENSAJES_RECIENTES else mensajes
+        nuevos = [m for m in fuera_de_ventana if m.id_mensaje > resumen.ultimo_mensaje]
+        return nuevos if len(nuevos) >= HistoryService.LOTE_RESUMEN else []
+
+    @staticmethod
+    def _summarize(resumen_actual, mensajes):
+        """Actualiza el resumen previo con los mensajes nuevos"""
+        response = LLMBackend.get().create(**HistoryService._summary_request(resumen_actual, mensajes))
+        return response.content[0].text.strip()
+
+    @staticmethod
+    async def _asummarize(resumen_actual, mensajes):
+        """Versión asíncrona de _summarize"""
+        response = await LLMBackend.get().acreate(**HistoryService._summary_request(resumen_actual, mensajes))
+        return response.content[0].text.strip()
+
+    @staticmethod
+    def _summary_request(resumen_actual, mensajes):
+        """Parámetros de la llamada de resumen"""
+        conversacion = "\n".join(
+            f"{'Usuario' if m.tipo_emisor == 'usuario' else 'Asistente'}: {m.contenido}"
+            for m in mensajes
+        )
+        prompt = f"""Resumen actual de una conversación sobre datos de RRHH universitarios:
+{resumen_actual or "(vacío)"}
+
+Nuevos mensajes:
+{conversacion}
+
+Actualiza el resumen incorporando los nuevos mensajes. Conserva nombres de personas, regiones, meses, montos e IDs mencionados, ya que pueden ser referenciados después. Máximo 150 palabras. Responde solo con el resumen."""
+
+        return dict(
+            model="claude-3-5-haiku-latest",
+            max_tokens=400,
+            temperature=0,
+            messages=[{"role": "user", "content": prompt}]
+        )
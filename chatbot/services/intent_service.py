@@ -0,0 +1,287 @@
+import logging
+import re
+import threading
+
+from ..models import Persona, TiempoContrato
+from .sql_cache_service import SQLCacheService
+from .result_cache_service import ResultCacheService
+from .exclusion_service import ExclusionService
+
+
+class IntentService:
+    """
+    Camino rápido determinista: reconoce preguntas de forma fija (las mismas de
+    QuestionTemplates) y arma el SQL desde plantillas pre-validadas sin llamar a Claude. Los valores
+    de mes, región y persona se resuelven contra las tablas de dimensiones. Cada palabra de la
+    pregunta debe quedar cubierta por la plantilla (vocabulario, slots o palabras vacías): si
+    sobra algún calificador, o hay una negación, la pregunta la resuelve Claude.
+    """
+
+    MAX_LIMITE = 100
+
+    _PALABRAS_VACIAS = frozenset((
+        "dame", "dime", "muestra", "muestrame", "mostrar", "lista", "listar", "ver", "cual", "cuales",
+        "es", "son", "el", "la", "los", "las", "lo", "un", "una", "de", "del", "en", "por", "para",
+        "a", "al", "y", "que", "me", "nos", "hay", "durante", "quien", "quienes",
+    ))
+    # Calificadores que invierten o restringen el sentido de una plantilla
+    _NEGACIONES = re.compile(
+        r"\b(no|ni|sin|excepto|salvo|menos|fuera|bajos?|menor(es)?|minimos?|peor(es)?|exclu\w*|distint\w*)\b"
+    )
+
+    _lock = threading.Lock()
+    _stats = {"total": 0, "matched": 0, "por_intencion": {}, "omitidas": {}}
+    _dimensiones = {"version": None, "meses": {}, "regiones": {}, "personas": []}
+
+    _SELECT_CONTRATO = """SELECT c.id_contrato, p.id_persona, p.nombre_completo, c.honorario_total_bruto,
+       f.descripcion_funcion, t.mes, t.anho, t.region
+FROM contrato c
+JOIN persona p ON c.id_persona = p.id_persona
+JOIN funcion f ON c.id_funcion = f.id_funcion
+JOIN tiempo_contrato t ON c.id_tiempo = t.id_tiempo"""
+
+    @staticmethod
+    def match(pregunta, terminos_excluidos=None):
+        """Retorna el SQL para la pregunta si corresponde a una intención conocida, o None"""
+        if terminos_excluidos and not ExclusionService.HABILITADO:
+            # Sin el motor de exclusiones los filtros dependen del criterio de Claude: no se usa el camino rápido
+            IntentService._record(None, "exclusiones")
+            return None
+        if not SQLCacheService.is_cacheable(pregunta):
+            IntentService._record(None, "depende_del_historial")
+            return None
+
+        texto = SQLCacheService.normalize_question(pregunta)
+        if IntentService._NEGACIONES.search(texto):
+            IntentService._record(None, "negacion")
+            return None
+        try:
+            for nombre, resolver in IntentService._INTENCIONES:
+                sql = resolver(texto)
+                if sql:
+                    IntentService._record(nombre)
+                    logging.info(f"Intención '{nombre}' resuelta sin LLM")
+                    return sql
+        except Exception as e:
+            logging.error(f"Error resolviendo intención: {e}")
+
+        IntentService._record(None, "sin_coincidencia")
+        return None
+
+    @staticmethod
+    def stats():
+        """Cobertura del camino rápido: preguntas resueltas sin LLM por intención"""
+        with IntentService._lock:
+            total = IntentService._stats["total"]
+            resueltas = IntentService._stats["matched"]
+            return {
+                "total": total,
+                "matched": resueltas,
+                "coverage": round(resueltas / total, 4) if total else 0.0,
+                "by_intent": dict(IntentService._stats["por_intencion"]),
+                "skipped": dict(IntentService._stats["omitidas"]),
+            }
+
+    @staticmethod
+    def _record(intencion, motivo=None):
+        with IntentService._lock:
+            IntentService._stats["total"] += 1
+            if intencion:
+                IntentService._stats["matched"] += 1
+                por_intencion = IntentService._stats["por_intencion"]
+                por_intencion[intencion] = por_intencion.get(intencion, 0) + 1
+            else:
+                omitidas = IntentService._stats["omitidas"]
+                omitidas[motivo] = omitidas.get(motivo, 0) + 1
+
+    # ------------------- Resolución de slots -------------------
+
+    @staticmethod
+    def _quote(valor):
+        """Literal SQL para valores provenientes de las tablas de dimensiones"""
+        return "'" + str(valor).replace("'", "''") + "'"
+
+    @staticmethod
+    def _load_dimensions():
+        """Meses, regiones y nombres existentes, recargados cuando cambia la versión de datos"""
+        version = ResultCacheService.data_version()
+        dimensiones = IntentService._dimensiones
+        if dimensiones["version"] != version:
+            normalizar = SQLCacheService.normalize_question
+            meses = {}
+            regiones = {}
+            for mes, region in TiempoContrato.objects.values_list("mes", "region").distinct():
+                if mes:
+                    meses[normalizar(mes)] = mes
+                if region:
+                    # "Región de Valparaíso" también debe reconocerse como "valparaiso"
+                    nucleo = re.sub(r"^region (de |del |de la )?", "", normalizar(region))
+                    regiones[nucleo] = region
+            personas = [
+                (id_persona, set(normalizar(nombre).split()))
+                for id_persona, nombre in Persona.objects.values_list("id_persona", "nombre_completo")
+            ]
+            with IntentService._lock:
+                IntentService._dimensiones = {
+                    "version": version, "meses": meses, "regiones": regiones, "personas": personas
+                }
+        return IntentService._dimensiones
+
+    @staticmethod
+    def _find_slot(texto, valores):
+        """(clave, valor) de la dimensión mencionada en el texto (la más larga si hay varias)"""
+        encontrados = [clave for clave in valores if re.search(rf"\b{re.escape(clave)}\b", texto)]
+        if not encontrados:
+            return None, None
+        clave = max(encontrados, key=len)
+        return clave, valores[clave]
+
+    @staticmethod
+    def _filters(texto):
+        """Mes y región mencionados, sus condiciones y los patrones que consumen en la pregunta"""
+        dimensiones = IntentService._load_dimensions()
+        clave_mes, mes = IntentService._find_slot(texto, dimensiones["meses"])
+        clave_region, region = IntentService._find_slot(texto, dimensiones["regiones"])
+        condiciones = {}
+        slots = {}
+        if mes:
+            condiciones["mes"] = f"t.mes = {IntentService._quote(mes)}"
+            slots["mes"] = rf"(?:mes )?{re.escape(clave_mes)}"
+        if region:
+            condiciones["region"] = f"t.region = {IntentService._quote(region)}"
+            slots["region"] = rf"(?:region (?:de la |del |de )?)?{re.escape(clave_region)}"
+        return mes, region, condiciones, slots
+
+    @staticmethod
+    def _covers(texto, patrones):
+        """True si la plantilla consume cada palabra de la pregunta, salvo las palabras vacías"""
+        for patron in patrones:
+            texto = re.sub(rf"\b(?:{patron})\b", " ", texto)
+        return all(palabra in IntentService._PALABRAS_VACIAS for palabra in texto.split())
+
+    @staticmethod
+    def _where(condiciones):
+        return f"\nWHERE {' AND '.join(condiciones)}" if condiciones else ""
+
+    # ------------------- Intenciones -------------------
+
+    @staticmethod
+    def _top_honorarios(texto):
+        if not re.search(r"\btop\b|mas altos|mas ganaron|mejor pagad", texto):
+            return None
+        if not re.search(r"honorario|ganaron|pagad|sueldo", texto):
+            return None
+        numero = re.search(r"\b(\d{1,3})\b", texto)
+        limite = min(int(numero.group(1)) if numero else 5, IntentService.MAX_LIMITE)
+        _, _, condiciones, slots = IntentService._filters(texto)
+        vocabulario = [
+            r"top", r"mas altos", r"mas altas", r"mayores", r"mas ganaron", r"mejor pagad[oa]s?",
+            r"honorarios?", r"sueldos?", r"personas", r"contratos", r"\d{1,3}",
+        ]
+        if not IntentService._covers(texto, vocabulario + list(slots.values())):
+            return None
+        return (
+            f"{IntentService._SELECT_CONTRATO}{IntentService._where(condiciones.values())}\n"
+            f"ORDER BY c.honorario_total_bruto DESC\nLIMIT {limite};"
+        )
+
+    @staticmethod
+    def _promedio_por_region(texto):
+        if not ("promedio" in texto and re.search(r"\b(por|cada) region", texto)):
+            return None
+        _, _, condiciones, slots = IntentService._filters(texto)
+        # La región agrupa; una región concreta en la pregunta no tiene lugar en la plantilla
+        vocabulario = [r"promedio", r"honorarios?", r"(?:por|cada) region(?:es)?"]
+        if not IntentService._covers(texto, vocabulario + ([slots["mes"]] if "mes" in slots else [])):
+            return None
+        condiciones = [condiciones["mes"]] if "mes" in condiciones else []
+        return (
+            "SELECT t.region, ROUND(AVG(c.honorario_total_bruto)) AS promedio_honorario, "
+            "COUNT(c.id_contrato) AS contratos\n"
+            "FROM contrato c\nJOIN tiempo_contrato t ON c.id_tiempo = t.id_tiempo"
+            f"{IntentService._where(condiciones)}\n"
+            "GROUP BY t.region\nORDER BY promedio_honorario DESC\nLIMIT 100;"
+        )
+
+    @staticmethod
+    def _gasto_total_mes(texto):
+        if not (re.search(r"\b(gasto|total)\b", texto) and "honorario" in texto):
+            return None
+        mes, _, condiciones, slots = IntentService._filters(texto)
+        if not mes:
+            return None
+        vocabulario = [r"gasto", r"total", r"honorarios?", r"pagad[oa]s?"]
+        if not IntentService._covers(texto, vocabulario + list(slots.values())):
+            return None
+        return (
+            "SELECT t.mes, SUM(c.honorario_total_bruto) AS total_honorarios, "
+            "COUNT(c.id_contrato) AS contratos\n"
+            "FROM contrato c\nJOIN tiempo_contrato t ON c.id_tiempo = t.id_tiempo"
+            f"{IntentService._where(condiciones.values())}\n"
+            "GROUP BY t.mes\nLIMIT 100;"
+        )
+
+    @staticmethod
+    def _personas_por_region(texto):
+        if not re.search(r"\bcuant[ao]s (personas|trabajadores)\b", texto):
+            return None
+        _, region, condiciones, slots = IntentService._filters(texto)
+        if not region:
+            return None
+        vocabulario = [r"cuant[ao]s", r"personas", r"trabajadores", r"trabajan", r"hay"]
+        if not IntentService._covers(texto, vocabulario + list(slots.values())):
+            return None
+        return (
+            "SELECT t.region, COUNT(DISTINCT c.id_persona) AS personas, "
+            "COUNT(c.id_contrato) AS contratos\n"
+            "FROM contrato c\nJOIN tiempo_contrato t ON c.id_tiempo = t.id_tiempo"
+            f"{IntentService._where(condiciones.values())}\n"
+            "GROUP BY t.region\nLIMIT 100;"
+        )
+
+    @staticmethod
+    def _honorarios_mes(texto):
+        if not re.search(r"\bhonorarios (de|del|en)\b", texto):
+            return None
+        mes, _, condiciones, slots = IntentService._filters(texto)
+        if not mes:
+            return None
+        if not IntentService._covers(texto, [r"honorarios"] + list(slots.values())):
+            return None
+        return (
+            f"{IntentService._SELECT_CONTRATO}{IntentService._where(condiciones.values())}\n"
+            "ORDER BY c.honorario_total_bruto DESC\nLIMIT 100;"
+        )
+
+    @staticmethod
+    def _contratos_persona(texto):
+        coincidencia = re.match(
+            r"^(?:busca(?:r)? (?:la )?informacion de|informacion de|contratos de|datos de) (.+)$", texto
+        )
+        if not coincidencia:
+            return None
+        tokens = [t for t in coincidencia.group(1).split() if len(t) >= 3]
+        if not tokens:
+            return None
+
+        # Coincidencia por palabras completas del nombre, sin tildes ni orden
+        personas = IntentService._load_dimensions()["personas"]
+        ids = [id_persona for id_persona, palabras in personas if palabras.issuperset(tokens)]
+        if not ids or len(ids) > IntentService.MAX_LIMITE:
+            return None
+
+        return (
+            f"{IntentService._SELECT_CONTRATO}\n"
+            f"WHERE p.id_persona IN ({', '.join(str(int(i)) for i in ids)})\n"
+            "ORDER BY t.anho DESC, c.id_contrato DESC\nLIMIT 100;"
+        )
+
+
+IntentService._INTENCIONES = [
+    ("top_honorarios", IntentService._top_honorarios),
+    ("promedio_por_region", IntentService._promedio_por_region),
+    ("gasto_total_mes", IntentService._gasto_total_mes),
+    ("personas_por_region", IntentService._personas_por_region),
+    ("honorarios_mes", IntentService._honorarios_mes),
+    ("contratos_persona", IntentService._contratos_persona),
+]
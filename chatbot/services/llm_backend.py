@@ -0,0 +1,319 @@
+import asyncio
+import csv
+from abc import ABC, abstractmethod
+import importlib
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import anthropic
+import httpx
+from anthropic.types import Message, TextBlock, Usage
+from dotenv import load_dotenv
+
+from .anthropic_registry import AnthropicClientRegistry
+from .llm_governor import LLMGovernor
+
+# Cargar variables de entorno
+load_dotenv()
+
+
+class LLMBackend(ABC):
+    """
+    Interfaz de los backends de LLM usados por AIService, HistoryService y bot.py.
+    Todos reciben los mismos argumentos que messages.create de Anthropic y retornan
+    objetos Message del SDK, de modo que los llamadores no dependen del backend.
+
+    El backend se elige con LLM_BACKEND: "anthropic" (por defecto), "fake" o la ruta
+    completa de una clase propia (ej. "mi_paquete.backends.MiBackend"). Una subclase
+    que no implemente create, acreate o stream_text falla al instanciarse en get().
+    """
+
+    _BACKENDS = {
+        "anthropic": "chatbot.services.llm_backend.AnthropicBackend",
+        "fake": "chatbot.services.llm_backend.FakeLLMBackend",
+    }
+    _instancia = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get():
+        """Retorna el backend configurado (una instancia por proceso), sujeto a LLMGovernor"""
+        if LLMBackend._instancia is None:
+            with LLMBackend._lock:
+                if LLMBackend._instancia is None:
+                    nombre = os.getenv("LLM_BACKEND", "anthropic").strip()
+                    ruta = LLMBackend._BACKENDS.get(nombre.lower(), nombre)
+                    modulo, clase = ruta.rsplit(".", 1)
+                    backend = getattr(importlib.import_module(modulo), clase)()
+                    LLMBackend._instancia = GovernedBackend(backend)
+                    logging.info(f"Backend LLM: {ruta}")
+        return LLMBackend._instancia
+
+    @staticmethod
+    def reset():
+        """Descarta el backend actual; el próximo get() vuelve a leer LLM_BACKEND"""
+        with LLMBackend._lock:
+            LLMBackend._instancia = None
+
+    @abstractmethod
+    def create(self, **kwargs):
+        """Equivalente a messages.create"""
+
+    @abstractmethod
+    async def acreate(self, **kwargs):
+        """Versión asíncrona de create"""
+
+    @abstractmethod
+    def stream_text(self, **kwargs):
+        """Generador de fragmentos de texto de la respuesta"""
+
+    def stats(self):
+        """Contadores propios del backend"""
+        return {}
+
+
+class GovernedBackend(LLMBackend):
+    """Envuelve un backend para que cada llamada pase por el control de admisión"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, **kwargs):
+        with LLMGovernor.slot():
+            return self.backend.create(**kwargs)
+
+    async def acreate(self, **kwargs):
+        async with LLMGovernor.aslot():
+            return await self.backend.acreate(**kwargs)
+
+    def stream_text(self, **kwargs):
+        with LLMGovernor.slot():
+            yield from self.backend.stream_text(**kwargs)
+
+    def stats(self):
+        return {**self.backend.stats(), "governor": LLMGovernor.stats()}
+
+
+class AnthropicBackend(LLMBackend):
+    """Backend real: API de Anthropic a través del registro de clientes compartido"""
+
+    def create(self, **kwargs):
+        return AnthropicClientRegistry.create(**kwargs)
+
+    async def acreate(self, **kwargs):
+        return await AnthropicClientRegistry.acreate(**kwargs)
+
+    def stream_text(self, **kwargs):
+        yield from AnthropicClientRegistry.stream_text(**kwargs)
+
+    def stats(self):
+        return {"backend": "anthropic", "keys": AnthropicClientRegistry.stats()}
+
+
+class FakeLLMBackend(LLMBackend):
+    """
+    Backend local para pruebas de carga sin consumir cuota ni red. Genera SQL y
+    respuestas por reglas (o desde un archivo de respuestas fijas) y simula la
+    latencia, el uso de tokens y los errores de la API según la configuración:
+
+    - FAKE_LLM_LATENCY: "fixed:MS", "uniform:MIN:MAX", "normal:MEDIA:DESV" o
+      "lognormal:MEDIANA:SIGMA" (milisegundos).
+    - FAKE_LLM_STREAM_CHUNK_MS: pausa entre fragmentos en streaming.
+    - FAKE_LLM_ERROR_RATE / FAKE_LLM_RATE_LIMIT_RATE: probabilidad de error 500 / 429.
+    - FAKE_LLM_RESPONSES_FILE: JSON {"regex": "respuesta"} evaluado sobre el prompt.
+    - FAKE_LLM_SEED: semilla para corridas repetibles.
+    """
+
+    MODELO = "fake-llm"
+    CARACTERES_POR_TOKEN = 4
+    TAMANO_FRAGMENTO = 24
+
+    _SQL_POR_DEFECTO = """SELECT c.id_contrato, p.id_persona, p.nombre_completo, c.honorario_total_bruto, t.mes, t.anho, t.region
+FROM contrato c
+JOIN persona p ON c.id_persona = p.id_persona
+JOIN tiempo_contrato t ON c.id_tiempo = t.id_tiempo
+ORDER BY c.honorario_total_bruto DESC
+LIMIT 10;"""
+    _SQL_POR_REGLA = [
+        (r"promedio", """SELECT t.region, ROUND(AVG(c.honorario_total_bruto)) AS promedio_honorario, COUNT(c.id_contrato) AS contratos
+FROM contrato c
+JOIN tiempo_contrato t ON c.id_tiempo = t.id_tiempo
+GROUP BY t.region
+ORDER BY promedio_honorario DESC
+LIMIT 100;"""),
+        (r"cu[aá]nt[oa]s|total|gasto", """SELECT COUNT(c.id_contrato) AS contratos, SUM(c.honorario_total_bruto) AS total_honorarios
+FROM contrato c
+LIMIT 1;"""),
+    ]
+
+    def __init__(self):
+        self.latencia = self._parse_latency(os.getenv("FAKE_LLM_LATENCY", "lognormal:600:0.4"))
+        self.pausa_fragmento = float(os.getenv("FAKE_LLM_STREAM_CHUNK_MS", "15")) / 1000
+        self.tasa_error = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+        self.tasa_rate_limit = float(os.getenv("FAKE_LLM_RATE_LIMIT_RATE", "0"))
+        semilla = os.getenv("FAKE_LLM_SEED")
+        self.random = random.Random(int(semilla) if semilla else None)
+        self.respuestas_fijas = self._load_responses(os.getenv("FAKE_LLM_RESPONSES_FILE"))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0, "errors": 0, "rate_limited": 0,
+            "input_tokens": 0, "output_tokens": 0, "latency_ms_total": 0.0,
+        }
+
+    # ------------------- Configuración -------------------
+
+    @staticmethod
+    def _parse_latency(especificacion):
+        tipo, *valores = especificacion.split(":")
+        valores = [float(v) for v in valores]
+        distribuciones = {
+            "fixed": lambda r: valores[0],
+            "uniform": lambda r: r.uniform(valores[0], valores[1]),
+            "normal": lambda r: max(0.0, r.gauss(valores[0], valores[1])),
+            "lognormal": lambda r: r.lognormvariate(0, valores[1]) * valores[0],
+        }
+        if tipo not in distribuciones:
+            raise ValueError(f"Distribución de latencia no soportada: {especificacion}")
+        return distribuciones[tipo]
+
+    @staticmethod
+    def _load_responses(ruta):
+        if not ruta:
+            return []
+        with open(ruta, encoding="utf-8") as archivo:
+            return [(re.compile(patron, re.IGNORECASE | re.DOTALL), texto) for patron, texto in json.load(archivo).items()]
+
+    # ------------------- Interfaz -------------------
+
+    def create(self, **kwargs):
+        espera = self._start_call()
+        time.sleep(espera)
+        return self._finish_call(kwargs, espera)
+
+    async def acreate(self, **kwargs):
+        espera = self._start_call()
+        await asyncio.sleep(espera)
+        return self._finish_call(kwargs, espera)
+
+    def stream_text(self, **kwargs):
+        espera = self._start_call()
+        time.sleep(espera)
+        mensaje = self._finish_call(kwargs, espera)
+        texto = mensaje.content[0].text
+        for inicio in range(0, len(texto), self.TAMANO_FRAGMENTO):
+            if inicio:
+                time.sleep(self.pausa_fragmento)
+            yield texto[inicio:inicio + self.TAMANO_FRAGMENTO]
+
+    def stats(self):
+        with self._lock:
+            datos = dict(self._stats)
+        datos["backend"] = "fake"
+        datos["avg_latency_ms"] = round(datos.pop("latency_ms_total") / datos["requests"], 1) if datos["requests"] else 0.0
+        return datos
+
+    # ------------------- Simulación -------------------
+
+    def _start_call(self):
+        """Sortea la latencia y, según las tasas configuradas, falla como lo haría la API"""
+        with self._lock:
+            self._stats["requests"] += 1
+            sorteo = self.random.random()
+            espera = self.latencia(self.random) / 1000
+
+        if sorteo < self.tasa_rate_limit:
+            with self._lock:
+                self._stats["rate_limited"] += 1
+            raise anthropic.RateLimitError(
+                "Rate limit simulado",
+                response=self._http_response(429, {"retry-after": "1"}),
+                body=None,
+            )
+        if sorteo < self.tasa_rate_limit + self.tasa_error:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise anthropic.InternalServerError(
+                "Error simulado", response=self._http_response(500), body=None
+            )
+        return espera
+
+    @staticmethod
+    def _http_response(estado, encabezados=None):
+        solicitud = httpx.Request("POST", "https://fake-llm.local/v1/messages")
+        return httpx.Response(estado, headers=encabezados or {}, request=solicitud)
+
+    def _finish_call(self, kwargs, espera):
+        mensajes = kwargs.get("messages", [])
+        prompt = mensajes[0]["content"] if mensajes else ""
+        texto = self._generate(prompt)
+
+        tokens_entrada = sum(len(m.get("content", "")) for m in mensajes) // self.CARACTERES_POR_TOKEN
+        tokens_salida = min(len(texto) // self.CARACTERES_POR_TOKEN, kwargs.get("max_tokens", 1000))
+        with self._lock:
+            self._stats["input_tokens"] += tokens_entrada
+            self._stats["output_tokens"] += tokens_salida
+            self._stats["latency_ms_total"] += espera * 1000
+
+        return Message(
+            id=f"msg_fake_{next(self._ids)}",
+            type="message",
+            role="assistant",
+            model=kwargs.get("model", self.MODELO),
+            content=[TextBlock(type="text", text=texto)],
+            stop_reason="end_turn",
+            stop_sequence=None,
+            usage=Usage(input_tokens=tokens_entrada, output_tokens=tokens_salida),
+        )
+
+    def _generate(self, prompt):
+        """Respuesta según el tipo de prompt: SQL, respuesta final o resumen"""
+        for patron, texto in self.respuestas_fijas:
+            if patron.search(prompt):
+                return texto
+
+        if "Genera una consulta SQL" in prompt:
+            pregunta = re.search(r'lenguaje natural:\s*"(.*?)"', prompt, re.DOTALL)
+            pregunta = pregunta.group(1) if pregunta else ""
+            for patron, sql in self._SQL_POR_REGLA:
+                if re.search(patron, pregunta, re.IGNORECASE):
+                    return sql
+            return self._SQL_POR_DEFECTO
+
+        if prompt.startswith("Dada la siguiente pregunta"):
+            return self._answer(prompt)
+
+        if "Actualiza el resumen" in prompt:
+            return "Resumen simulado de la conversación."
+
+        return "Respuesta simulada."
+
+    @staticmethod
+    def _answer(prompt):
+        """Respuesta final con el JSON de IDs tomado de los resultados del prompt"""
+        filas = re.search(r"^(\d+) filas", prompt, re.MULTILINE)
+        texto = f"Respuesta simulada: la consulta retornó {filas.group(1)} filas." if filas else "Respuesta simulada."
+
+        for tipo in ("id_contrato", "id_persona"):
+            ids = FakeLLMBackend._ids_from_prompt(prompt, tipo)
+            if ids:
+                return f"{texto}\n\n{json.dumps({tipo: ids})}"
+        return texto
+
+    @staticmethod
+    def _ids_from_prompt(prompt, columna):
+        # Resultados codificados como CSV (ResultEncoder)
+        bloque = re.search(r"\(CSV\):\n(.*?)(?:\n\n|\nResumen por columna|$)", prompt, re.DOTALL)
+        if bloque:
+            filas = list(csv.reader(bloque.group(1).splitlines()))
+            if filas and columna in filas[0]:
+                indice = filas[0].index(columna)
+                return [int(f[indice]) for f in filas[1:] if len(f) > indice and f[indice].isdigit()]
+        # Resultados como lista de dicts (bot.py)
+        return [int(v) for v in re.findall(rf"'{columna}': (\d+)", prompt)]
@@ -0,0 +1,287 @@
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+class LLMOverloadedError(Exception):
+    """No hay capacidad para otra llamada al LLM dentro del plazo de espera"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Servicio de IA saturado, reintentar en {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LLMGovernor:
+    """
+    Control de admisión de las llamadas al LLM: token bucket (llamadas por segundo),
+    cupos de concurrencia global y por usuario, y una cola que atiende a los usuarios
+    en round-robin para que una ráfaga de uno no bloquee al resto. Si la espera
+    superaría el plazo, la llamada se rechaza con LLMOverloadedError.
+    """
+
+    HABILITADO = os.getenv("LLM_GOVERNOR_ENABLED", "true").lower() == "true"
+    MAX_CONCURRENCIA = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+    MAX_POR_USUARIO = int(os.getenv("LLM_MAX_CONCURRENCY_PER_USER", "2"))
+    TASA = float(os.getenv("LLM_RATE_PER_SECOND", "0"))
+    RAFAGA = float(os.getenv("LLM_RATE_BURST", "10"))
+    ESPERA_MAXIMA = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))
+    MAX_COLA = int(os.getenv("LLM_MAX_QUEUE", "200"))
+    MUESTRAS = 1000
+
+    _usuario = contextvars.ContextVar("llm_usuario", default=None)
+    _cond = threading.Condition()
+    _colas = OrderedDict()
+    _activos_usuario = {}
+    _estado = {"activos": 0, "en_cola": 0, "tokens": RAFAGA, "relleno": time.monotonic(), "duracion_media": 0.0}
+    _metricas = {"admitted": 0, "rejected": 0, "timed_out": 0, "max_queue_depth": 0}
+    _esperas = deque(maxlen=MUESTRAS)
+
+    @staticmethod
+    @contextmanager
+    def user(id_usuario):
+        """Asocia las llamadas al LLM del bloque al usuario indicado"""
+        token = LLMGovernor._usuario.set(id_usuario)
+        try:
+            yield
+        finally:
+            try:
+                LLMGovernor._usuario.reset(token)
+            except ValueError:
+                # Generador consumido desde otro contexto (streaming bajo ASGI)
+                LLMGovernor._usuario.set(None)
+
+    @staticmethod
+    @contextmanager
+    def slot():
+        """Ocupa un cupo durante la llamada al LLM (bloquea hasta obtenerlo o rechaza)"""
+        if not LLMGovernor.HABILITADO:
+            yield
+            return
+        usuario = LLMGovernor._usuario.get()
+        LLMGovernor.acquire(usuario)
+        inicio = time.monotonic()
+        try:
+            yield
+        finally:
+            LLMGovernor.release(usuario, time.monotonic() - inicio)
+
+    @staticmethod
+    @asynccontextmanager
+    async def aslot():
+        """Versión asíncrona de slot: la espera en cola es un future del event loop, sin ocupar hilos"""
+        if not LLMGovernor.HABILITADO:
+            yield
+            return
+        usuario = LLMGovernor._usuario.get()
+        await LLMGovernor.aacquire(usuario)
+        inicio = time.monotonic()
+        try:
+            yield
+        finally:
+            LLMGovernor.release(usuario, time.monotonic() - inicio)
+
+    @staticmethod
+    def acquire(usuario):
+        gob = LLMGovernor
+        ticket = {"concedido": False, "aviso": None}
+        llegada = time.monotonic()
+        limite = llegada + gob.ESPERA_MAXIMA
+
+        with gob._cond:
+            gob._enqueue(usuario, ticket)
+            while not ticket["concedido"]:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    gob._time_out(usuario, ticket)
+                gob._cond.wait(min(restante, gob._token_wait() or restante))
+                gob._dispatch()
+            gob._admitted(llegada)
+
+    @staticmethod
+    async def aacquire(usuario):
+        """
+        Como acquire, pero el ticket lleva un future que _dispatch completa con
+        call_soon_threadsafe: el coroutine espera en el event loop y no retiene un hilo
+        """
+        gob = LLMGovernor
+        loop = asyncio.get_running_loop()
+        concedido = loop.create_future()
+        ticket = {"concedido": False, "aviso": (loop, concedido)}
+        llegada = time.monotonic()
+        limite = llegada + gob.ESPERA_MAXIMA
+
+        with gob._cond:
+            gob._enqueue(usuario, ticket)
+        try:
+            while not concedido.done():
+                restante = limite - time.monotonic()
+                with gob._cond:
+                    if ticket["concedido"]:
+                        break
+                    if restante <= 0:
+                        gob._time_out(usuario, ticket)
+                    espera = min(restante, gob._token_wait() or restante)
+                try:
+                    await asyncio.wait_for(asyncio.shield(concedido), espera)
+                except asyncio.TimeoutError:
+                    # Con límite de tasa nadie más despacha al reponerse el token
+                    with gob._cond:
+                        gob._dispatch()
+        except asyncio.CancelledError:
+            with gob._cond:
+                if not ticket["concedido"]:
+                    gob._dequeue(usuario, ticket)
+                    raise
+            # El cupo se concedió justo antes de la cancelación: se devuelve de inmediato
+            gob.release(usuario, 0.0)
+            raise
+        with gob._cond:
+            gob._admitted(llegada)
+
+    @staticmethod
+    def _enqueue(usuario, ticket):
+        """Admite el ticket en la cola o rechaza si la espera estimada supera el plazo (requiere _cond)"""
+        gob = LLMGovernor
+        estimada = gob._estimated_wait(gob._estado["en_cola"] + 1)
+        if gob._estado["en_cola"] >= gob.MAX_COLA or (gob._estado["en_cola"] and estimada > gob.ESPERA_MAXIMA):
+            gob._metricas["rejected"] += 1
+            raise LLMOverloadedError(gob._retry_after(estimada))
+
+        gob._colas.setdefault(usuario, deque()).append(ticket)
+        gob._estado["en_cola"] += 1
+        gob._metricas["max_queue_depth"] = max(gob._metricas["max_queue_depth"], gob._estado["en_cola"])
+        gob._dispatch()
+
+    @staticmethod
+    def _dequeue(usuario, ticket):
+        """Saca de la cola un ticket que no fue concedido (requiere _cond)"""
+        gob = LLMGovernor
+        gob._colas[usuario].remove(ticket)
+        if not gob._colas[usuario]:
+            del gob._colas[usuario]
+        gob._estado["en_cola"] -= 1
+
+    @staticmethod
+    def _time_out(usuario, ticket):
+        gob = LLMGovernor
+        gob._dequeue(usuario, ticket)
+        gob._metricas["timed_out"] += 1
+        raise LLMOverloadedError(gob._retry_after(gob._estimated_wait(gob._estado["en_cola"])))
+
+    @staticmethod
+    def _admitted(llegada):
+        LLMGovernor._metricas["admitted"] += 1
+        LLMGovernor._esperas.append(time.monotonic() - llegada)
+
+    @staticmethod
+    def _notify(concedido):
+        if not concedido.done():
+            concedido.set_result(True)
+
+    @staticmethod
+    def release(usuario, duracion):
+        gob = LLMGovernor
+        with gob._cond:
+            gob._estado["activos"] -= 1
+            gob._activos_usuario[usuario] -= 1
+            if not gob._activos_usuario[usuario]:
+                del gob._activos_usuario[usuario]
+            # Media móvil de la duración de las llamadas, para estimar la espera en cola
+            media = gob._estado["duracion_media"]
+            gob._estado["duracion_media"] = duracion if not media else 0.9 * media + 0.1 * duracion
+            gob._dispatch()
+
+    @staticmethod
+    def _refill():
+        if not LLMGovernor.TASA:
+            return
+        ahora = time.monotonic()
+        estado = LLMGovernor._estado
+        estado["tokens"] = min(LLMGovernor.RAFAGA, estado["tokens"] + (ahora - estado["relleno"]) * LLMGovernor.TASA)
+        estado["relleno"] = ahora
+
+    @staticmethod
+    def _token_wait():
+        """Segundos hasta el próximo token, o None si no hay que esperar por tasa"""
+        if not LLMGovernor.TASA or LLMGovernor._estado["tokens"] >= 1:
+            return None
+        return (1 - LLMGovernor._estado["tokens"]) / LLMGovernor.TASA
+
+    @staticmethod
+    def _dispatch():
+        """Concede cupos a los primeros de la cola, alternando entre usuarios (requiere _cond)"""
+        gob = LLMGovernor
+        concedidos = False
+        while gob._estado["activos"] < gob.MAX_CONCURRENCIA and gob._estado["en_cola"]:
+            gob._refill()
+            if gob.TASA and gob._estado["tokens"] < 1:
+                break
+            # El usuario puede ser None (llamadas sin usuario, ej. bot.py), por eso no se usa next(..., None)
+            candidatos = [u for u in gob._colas if gob._activos_usuario.get(u, 0) < gob.MAX_POR_USUARIO]
+            if not candidatos:
+                break
+            elegido = candidatos[0]
+            ticket = gob._colas[elegido].popleft()
+            if gob._colas[elegido]:
+                gob._colas.move_to_end(elegido)
+            else:
+                del gob._colas[elegido]
+            gob._estado["en_cola"] -= 1
+            if ticket["aviso"]:
+                loop, concedido = ticket["aviso"]
+                try:
+                    loop.call_soon_threadsafe(gob._notify, concedido)
+                except RuntimeError:
+                    # Event loop cerrado: nadie espera ya este ticket
+                    continue
+            ticket["concedido"] = True
+            gob._estado["activos"] += 1
+            gob._activos_usuario[elegido] = gob._activos_usuario.get(elegido, 0) + 1
+            if gob.TASA:
+                gob._estado["tokens"] -= 1
+            concedidos = True
+        if concedidos:
+            gob._cond.notify_all()
+
+    @staticmethod
+    def _estimated_wait(posicion):
+        """Espera aproximada de quien queda en la posición indicada de la cola"""
+        gob = LLMGovernor
+        por_concurrencia = math.ceil(posicion / gob.MAX_CONCURRENCIA) * gob._estado["duracion_media"]
+        por_tasa = posicion / gob.TASA if gob.TASA else 0.0
+        return max(por_concurrencia, por_tasa)
+
+    @staticmethod
+    def _retry_after(espera):
+        return max(1, math.ceil(espera or LLMGovernor._estado["duracion_media"]))
+
+    @staticmethod
+    def stats():
+        """Profundidad de la cola, cupos en uso y tiempos de espera"""
+        gob = LLMGovernor
+        with gob._cond:
+            esperas = sorted(gob._esperas)
+            datos = {
+                "enabled": gob.HABILITADO,
+                "active": gob._estado["activos"],
+                "queue_depth": gob._estado["en_cola"],
+                "queued_users": len(gob._colas),
+                "max_concurrency": gob.MAX_CONCURRENCIA,
+                "max_concurrency_per_user": gob.MAX_POR_USUARIO,
+                "rate_per_second": gob.TASA,
+                "avg_call_seconds": round(gob._estado["duracion_media"], 3),
+                **gob._metricas,
+            }
+        if esperas:
+            datos["wait_ms"] = {
+                "avg": round(sum(esperas) / len(esperas) * 1000, 1),
+                "p50": round(esperas[len(esperas) // 2] * 1000, 1),
+                "p95": round(esperas[min(len(esperas) - 1, int(len(esperas) * 0.95))] * 1000, 1),
+                "max": round(esperas[-1] * 1000, 1),
+            }
+        return datos
@@ -0,0 +1,91 @@
+import os
+
+from django.db.models import Exists, OuterRef, Q
+
+from ..models import MensajeChat, DatosFuenteMensaje
+
+
+class MessagePageService:
+    """
+    Mensajes de una sesión por páginas, en orden (fecha, id_mensaje): al abrir la sesión
+    los N más recientes, `before=<id_mensaje>` para retroceder y `after=<id_mensaje>`
+    para traer solo los nuevos tras enviar. Cada página es un rango del índice
+    (id_sesion, fecha, id_mensaje) y la marca de datos fuente va en la misma consulta.
+    """
+
+    LIMITE_DEFECTO = int(os.getenv("MESSAGES_PAGE_SIZE", "50"))
+    LIMITE_MAXIMO = int(os.getenv("MESSAGES_MAX_PAGE_SIZE", "200"))
+
+    @staticmethod
+    def queryset(sesion):
+        return MensajeChat.objects.filter(sesion=sesion).annotate(
+            tiene_datos_fuente=Exists(DatosFuenteMensaje.objects.filter(mensaje=OuterRef("pk")))
+        )
+
+    @staticmethod
+    def page(sesion, before=None, after=None, limite=None):
+        """
+        Página de mensajes en orden cronológico: {"messages", "has_more", "oldest_id", "newest_id"}.
+        `has_more` indica si hay más mensajes anteriores (o posteriores, con `after`).
+        Lanza ValueError si los parámetros no son válidos o el mensaje de referencia no es de la sesión.
+        """
+        if before is not None and after is not None:
+            raise ValueError("Usa before o after, no ambos")
+        try:
+            limite = MessagePageService.LIMITE_DEFECTO if limite is None else int(limite)
+        except ValueError:
+            raise ValueError("limit debe ser un entero")
+        if limite < 1:
+            raise ValueError("limit debe ser mayor que 0")
+        limite = min(limite, MessagePageService.LIMITE_MAXIMO)
+
+        mensajes = MessagePageService.queryset(sesion)
+        if after is not None:
+            fecha, id_mensaje = MessagePageService._anchor(sesion, after)
+            mensajes = mensajes.filter(
+                Q(fecha__gt=fecha) | Q(fecha=fecha, id_mensaje__gt=id_mensaje)
+            ).order_by("fecha", "id_mensaje")
+        else:
+            if before is not None:
+                fecha, id_mensaje = MessagePageService._anchor(sesion, before)
+                mensajes = mensajes.filter(Q(fecha__lt=fecha) | Q(fecha=fecha, id_mensaje__lt=id_mensaje))
+            mensajes = mensajes.order_by("-fecha", "-id_mensaje")
+
+        # Una fila extra solo para saber si hay más
+        filas = list(mensajes[:limite + 1])
+        hay_mas = len(filas) > limite
+        filas = filas[:limite]
+        if after is None:
+            filas.reverse()
+        return {
+            "messages": filas,
+            "has_more": hay_mas,
+            "oldest_id": filas[0].id_mensaje if filas else None,
+            "newest_id": filas[-1].id_mensaje if filas else None,
+        }
+
+    @staticmethod
+    def all(sesion):
+        return list(MessagePageService.queryset(sesion).order_by("fecha", "id_mensaje"))
+
+    @staticmethod
+    def _anchor(sesion, id_mensaje):
+        try:
+            id_mensaje = int(id_mensaje)
+        except (TypeError, ValueError):
+            raise ValueError("El cursor de mensaje debe ser un id_mensaje")
+        fila = MensajeChat.objects.filter(sesion=sesion, id_mensaje=id_mensaje).values_list("fecha", "id_mensaje").first()
+        if fila is None:
+            raise ValueError("El mensaje de referencia no pertenece a la sesión")
+        return fila
+
+    @staticmethod
+    def serialize(mensaje):
+        return {
+            "id": mensaje.id_mensaje,
+            "sender": mensaje.tipo_emisor,
+            "content": mensaje.contenido,
+            "timestamp": mensaje.fecha.isoformat() if mensaje.fecha else None,
+            "has_source_data": mensaje.tiene_datos_fuente,
+            "metadata": mensaje.metadata or None,
+        }
@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+from django.conf import settings
+
+
+class PGPoolTimeout(psycopg2.pool.PoolError):
+    """No se liberó ninguna conexión del pool dentro del plazo de espera"""
+
+    def __init__(self, mensaje, retry_after):
+        super().__init__(mensaje)
+        self.retry_after = retry_after
+
+
+class PGPool:
+    """
+    Pool de conexiones psycopg2 para el acceso SQL directo de bot.py (guardar_mensaje se
+    llama en cada mensaje de la API y de la vista web). Reutiliza conexiones abiertas con
+    los mismos datos que DATABASES['default']: verifica con SELECT 1 las que llevan más de
+    PG_POOL_CHECK_IDLE segundos sin uso, cierra las que superan PG_POOL_MAX_LIFETIME y
+    descarta las que quedaron rotas. Con PG_POOL_MAX_SIZE conexiones prestadas, espera
+    hasta PG_POOL_TIMEOUT segundos antes de fallar.
+    """
+
+    TAMANO_MAXIMO = int(os.getenv("PG_POOL_MAX_SIZE", "8"))
+    ESPERA = float(os.getenv("PG_POOL_TIMEOUT", "10"))
+    VIDA_MAXIMA = float(os.getenv("PG_POOL_MAX_LIFETIME", "1800"))
+    INACTIVIDAD_CHEQUEO = float(os.getenv("PG_POOL_CHECK_IDLE", "30"))
+
+    _condicion = threading.Condition()
+    _libres = []  # (conexión, creada, último uso); se reutiliza primero la más reciente
+    _abiertas = 0
+    _pid = os.getpid()
+    _stats = {"opened": 0, "reused": 0, "discarded": 0, "timeouts": 0}
+
+    @staticmethod
+    @contextmanager
+    def connection():
+        """
+        Presta una conexión mientras dura el bloque: confirma la transacción al salir
+        o la revierte si hubo una excepción, y devuelve la conexión al pool.
+        """
+        conexion, creada = PGPool._acquire()
+        try:
+            yield conexion
+            conexion.commit()
+        except Exception:
+            PGPool._release(conexion, creada, sana=PGPool._rollback(conexion))
+            raise
+        PGPool._release(conexion, creada, sana=True)
+
+    @staticmethod
+    def _acquire():
+        PGPool._reset_after_fork()
+        limite = time.monotonic() + PGPool.ESPERA
+        while True:
+            with PGPool._condicion:
+                while not PGPool._libres and PGPool._abiertas >= PGPool.TAMANO_MAXIMO:
+                    restante = limite - time.monotonic()
+                    if restante <= 0 or not PGPool._condicion.wait(restante):
+                        PGPool._stats["timeouts"] += 1
+                        logging.warning(f"Pool PostgreSQL sin conexiones libres tras {PGPool.ESPERA}s de espera")
+                        raise PGPoolTimeout(
+                            f"Sin conexiones disponibles (pool de {PGPool.TAMANO_MAXIMO})",
+                            max(1, round(PGPool.ESPERA)),
+                        )
+                if PGPool._libres:
+                    conexion, creada, ultimo_uso = PGPool._libres.pop()
+                else:
+                    PGPool._abiertas += 1
+                    conexion = None
+
+            if conexion is None:
+                break
+            # El chequeo puede ir a la red: se hace fuera del lock
+            if PGPool._usable(conexion, creada, ultimo_uso):
+                with PGPool._condicion:
+                    PGPool._stats["reused"] += 1
+                return conexion, creada
+            with PGPool._condicion:
+                PGPool._discard(conexion)
+                PGPool._condicion.notify()
+
+        # Conexión nueva, con el cupo ya reservado
+        try:
+            conexion = psycopg2.connect(**PGPool._params())
+        except Exception:
+            with PGPool._condicion:
+                PGPool._abiertas -= 1
+                PGPool._condicion.notify()
+            raise
+        with PGPool._condicion:
+            PGPool._stats["opened"] += 1
+        return conexion, time.monotonic()
+
+    @staticmethod
+    def _usable(conexion, creada, ultimo_uso):
+        ahora = time.monotonic()
+        if conexion.closed or ahora - creada > PGPool.VIDA_MAXIMA:
+            return False
+        if ahora - ultimo_uso <= PGPool.INACTIVIDAD_CHEQUEO:
+            return True
+        try:
+            with conexion.cursor() as cur:
+                cur.execute("SELECT 1")
+            conexion.rollback()
+            return True
+        except psycopg2.Error as e:
+            logging.warning(f"Conexión del pool descartada en el chequeo: {e}")
+            return False
+
+    @staticmethod
+    def _rollback(conexion):
+        """Revierte la transacción; retorna False si la conexión quedó inutilizable"""
+        if conexion.closed:
+            return False
+        try:
+            conexion.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _release(conexion, creada, sana):
+        with PGPool._condicion:
+            if sana and not conexion.closed and time.monotonic() - creada <= PGPool.VIDA_MAXIMA:
+                PGPool._libres.append((conexion, creada, time.monotonic()))
+            else:
+                PGPool._discard(conexion)
+            PGPool._condicion.notify()
+
+    @staticmethod
+    def _discard(conexion):
+        """Cierra la conexión y libera su cupo; llamar con el lock tomado"""
+        PGPool._abiertas -= 1
+        PGPool._stats["discarded"] += 1
+        try:
+            conexion.close()
+        except psycopg2.Error:
+            pass
+
+    @staticmethod
+    def _reset_after_fork():
+        """Un worker creado por fork no debe reutilizar los sockets del proceso padre"""
+        if PGPool._pid == os.getpid():
+            return
+        with PGPool._condicion:
+            if PGPool._pid != os.getpid():
+                PGPool._libres = []
+                PGPool._abiertas = 0
+                PGPool._pid = os.getpid()
+
+    @staticmethod
+    def _params():
+        config = settings.DATABASES["default"]
+        return {
+            "dbname": config["NAME"],
+            "user": config["USER"],
+            "password": config["PASSWORD"],
+            "host": config["HOST"],
+            "port": config["PORT"],
+            "connect_timeout": config.get("OPTIONS", {}).get("connect_timeout", 5),
+            "application_name": "chatbot-bot",
+        }
+
+    @staticmethod
+    def close_all():
+        """Cierra las conexiones libres (las prestadas se cierran al devolverse si superan su vida)"""
+        with PGPool._condicion:
+            while PGPool._libres:
+                PGPool._discard(PGPool._libres.pop()[0])
+
+    @staticmethod
+    def stats():
+        with PGPool._condicion:
+            return {
+                "max_size": PGPool.TAMANO_MAXIMO,
+                "open": PGPool._abiertas,
+                "idle": len(PGPool._libres),
+                **PGPool._stats,
+            }
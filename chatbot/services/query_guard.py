@@ -0,0 +1,214 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.db import transaction, OperationalError
+from django.db.models import Avg, Count, Max
+from django.utils import timezone
+
+from ..models import EvaluacionConsulta
+from .sql_parser import SQLParser, InvalidSQLError
+from .analytics_db import AnalyticsDB
+from .columnar_result import ResultadoColumnar
+
+
+class QueryRejectedError(Exception):
+    """La consulta no se ejecutó: su plan supera los umbrales o excedió el statement_timeout"""
+
+    def __init__(self, motivo):
+        super().__init__(motivo)
+        self.motivo = motivo
+
+
+class QueryGuard:
+    """
+    Guardián previo a la ejecución del SQL generado, que corre en el alias analítico (ver
+    AnalyticsDB). En PostgreSQL abre una transacción de solo lectura con statement_timeout
+    propio, estima el plan con EXPLAIN (FORMAT JSON) y rechaza las consultas cuyo costo total o filas intermedias superan los umbrales.
+    Si solo el costo es excesivo, intenta reescribirla con un LIMIT menor y vuelve a
+    estimarla. Cada decisión queda registrada con el costo del plan en evaluaciones_consulta.
+    """
+
+    HABILITADO = os.getenv("QUERY_GUARD_ENABLED", "true").lower() == "true"
+    MAX_COSTO = float(os.getenv("QUERY_MAX_COST", "100000"))
+    MAX_FILAS_PLAN = float(os.getenv("QUERY_MAX_PLAN_ROWS", "1000000"))
+    LIMITE_REESCRITURA = int(os.getenv("QUERY_REWRITE_LIMIT", "20"))
+    TIMEOUT_MS = int(os.getenv("QUERY_STATEMENT_TIMEOUT_MS", "5000"))
+    REGISTRAR = os.getenv("QUERY_GUARD_LOG_DECISIONS", "true").lower() == "true"
+    TOPE_FILAS = int(os.getenv("SQL_FETCH_MAX_ROWS", str(SQLParser.MAX_FILAS)))
+
+    _lock = threading.Lock()
+    _stats = {"aceptada": 0, "reescrita": 0, "rechazada": 0, "cancelada": 0}
+
+    @staticmethod
+    def execute(sql):
+        """Ejecuta la consulta si su plan está dentro de los umbrales; retorna un ResultadoColumnar"""
+        with AnalyticsDB.slot() as conexion:
+            if not QueryGuard.HABILITADO or conexion.vendor != "postgresql":
+                return QueryGuard._fetch(conexion, sql)
+
+            evaluacion = {"sql": sql, "decision": "aceptada", "motivo": ""}
+            try:
+                filas = QueryGuard._guarded(conexion, sql, evaluacion)
+            except QueryRejectedError as e:
+                evaluacion["decision"] = evaluacion.get("decision_rechazo", "rechazada")
+                evaluacion["motivo"] = e.motivo
+                QueryGuard._record(evaluacion)
+                raise
+        QueryGuard._record(evaluacion)
+        return filas
+
+    @staticmethod
+    def _guarded(conexion, sql, evaluacion):
+        # SET TRANSACTION solo es válido como primera sentencia de una transacción nueva
+        anidada = conexion.in_atomic_block
+        with transaction.atomic(using=conexion.alias):
+            with conexion.cursor() as cur:
+                if not anidada:
+                    cur.execute("SET TRANSACTION READ ONLY")
+                cur.execute("SELECT current_setting('statement_timeout')")
+                timeout_previo = cur.fetchone()[0]
+                cur.execute("SELECT set_config('statement_timeout', %s, true)", [str(QueryGuard.TIMEOUT_MS)])
+                sql = QueryGuard._evaluate(cur, sql, evaluacion)
+                inicio = time.perf_counter()
+                try:
+                    filas = QueryGuard._fetch(conexion, sql)
+                except OperationalError as e:
+                    if not QueryGuard._is_timeout(e):
+                        raise
+                    evaluacion["decision_rechazo"] = "cancelada"
+                    evaluacion["duracion_ms"] = (time.perf_counter() - inicio) * 1000
+                    raise QueryRejectedError(f"Superó statement_timeout ({QueryGuard.TIMEOUT_MS} ms)") from e
+                evaluacion["duracion_ms"] = (time.perf_counter() - inicio) * 1000
+                if anidada:
+                    # Al liberar el savepoint el SET LOCAL seguiría vigente en la transacción externa
+                    cur.execute("SELECT set_config('statement_timeout', %s, true)", [timeout_previo])
+        return filas
+
+    @staticmethod
+    def _evaluate(cur, sql, evaluacion):
+        """Decide con el plan estimado; retorna el SQL a ejecutar o lanza QueryRejectedError"""
+        costo, filas, intermedias = QueryGuard._explain(cur, sql)
+        evaluacion.update(costo_estimado=costo, filas_estimadas=filas, filas_intermedias=intermedias)
+
+        if intermedias > QueryGuard.MAX_FILAS_PLAN:
+            raise QueryRejectedError(
+                f"El plan estima {intermedias:.0f} filas intermedias (máximo {QueryGuard.MAX_FILAS_PLAN:.0f})"
+            )
+        if costo <= QueryGuard.MAX_COSTO:
+            return sql
+
+        try:
+            reescrita = SQLParser.with_limit(sql, QueryGuard.LIMITE_REESCRITURA)
+        except InvalidSQLError:
+            reescrita = sql
+        if reescrita != sql:
+            costo_reescrita, filas, intermedias = QueryGuard._explain(cur, reescrita)
+            if costo_reescrita <= QueryGuard.MAX_COSTO:
+                evaluacion.update(
+                    sql=reescrita, decision="reescrita", filas_estimadas=filas, filas_intermedias=intermedias,
+                    motivo=f"Costo {costo:.0f} reducido a {costo_reescrita:.0f} con LIMIT {QueryGuard.LIMITE_REESCRITURA}",
+                )
+                return reescrita
+        raise QueryRejectedError(f"Costo estimado {costo:.0f} supera el máximo {QueryGuard.MAX_COSTO:.0f}")
+
+    @staticmethod
+    def _explain(cur, sql):
+        """(costo total, filas estimadas del resultado, mayor estimación de filas entre los nodos)"""
+        cur.execute("EXPLAIN (FORMAT JSON) " + sql)
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        raiz = plan[0]["Plan"]
+
+        intermedias = 0.0
+        pendientes = [raiz]
+        while pendientes:
+            nodo = pendientes.pop()
+            intermedias = max(intermedias, float(nodo.get("Plan Rows", 0)))
+            pendientes.extend(nodo.get("Plans", []))
+        return float(raiz["Total Cost"]), float(raiz["Plan Rows"]), intermedias
+
+    @staticmethod
+    def _fetch(conexion, sql):
+        """Lee el resultado con un cursor del lado del servidor (en PostgreSQL), en lotes y con tope de filas"""
+        with conexion.chunked_cursor() as cur:
+            cur.execute(sql)
+            return ResultadoColumnar.from_cursor(cur, QueryGuard.TOPE_FILAS)
+
+    @staticmethod
+    def _is_timeout(error):
+        """query_canceled (57014) de psycopg2 o psycopg 3"""
+        causa = error.__cause__
+        return "57014" in (getattr(causa, "pgcode", None), getattr(causa, "sqlstate", None))
+
+    @staticmethod
+    def _record(evaluacion):
+        decision = evaluacion["decision"]
+        with QueryGuard._lock:
+            QueryGuard._stats[decision] += 1
+        if decision != "aceptada":
+            logging.warning(f"Consulta {decision}: {evaluacion['motivo']}")
+        if not QueryGuard.REGISTRAR:
+            return
+        try:
+            sql = evaluacion["sql"]
+            try:
+                huella = SQLParser.parse(sql).huella
+            except InvalidSQLError:
+                huella = hashlib.sha256(sql.encode("utf-8")).hexdigest()
+            EvaluacionConsulta.objects.create(
+                huella=huella,
+                sql=sql,
+                decision=decision,
+                motivo=evaluacion["motivo"][:200],
+                costo_estimado=evaluacion.get("costo_estimado"),
+                filas_estimadas=evaluacion.get("filas_estimadas"),
+                filas_intermedias=evaluacion.get("filas_intermedias"),
+                duracion_ms=evaluacion.get("duracion_ms"),
+            )
+        except Exception as e:
+            logging.error(f"Error registrando evaluación de consulta: {e}")
+
+    @staticmethod
+    def stats(horas=24):
+        """Umbrales, decisiones de este proceso y costos registrados en las últimas `horas`"""
+        with QueryGuard._lock:
+            decisiones = dict(QueryGuard._stats)
+        desde = timezone.now() - timedelta(hours=horas)
+        registradas = EvaluacionConsulta.objects.filter(fecha__gte=desde)
+        por_decision = {
+            fila["decision"]: {
+                "count": fila["total"],
+                "avg_cost": round(fila["costo_promedio"] or 0, 2),
+                "max_cost": fila["costo_maximo"],
+                "avg_ms": round(fila["duracion_promedio"] or 0, 2),
+            }
+            for fila in registradas.values("decision").annotate(
+                total=Count("id"), costo_promedio=Avg("costo_estimado"),
+                costo_maximo=Max("costo_estimado"), duracion_promedio=Avg("duracion_ms"),
+            )
+        }
+        costos = sorted(
+            c for c in registradas.order_by("-fecha").values_list("costo_estimado", flat=True)[:1000]
+            if c is not None
+        )
+        return {
+            "enabled": QueryGuard.HABILITADO,
+            "max_cost": QueryGuard.MAX_COSTO,
+            "max_plan_rows": QueryGuard.MAX_FILAS_PLAN,
+            "rewrite_limit": QueryGuard.LIMITE_REESCRITURA,
+            "statement_timeout_ms": QueryGuard.TIMEOUT_MS,
+            "decisions": decisiones,
+            "recorded": {
+                "hours": horas,
+                "by_decision": por_decision,
+                "cost_percentiles": {
+                    f"p{p}": costos[min(len(costos) - 1, int(len(costos) * p / 100))] for p in (50, 90, 99)
+                } if costos else {},
+            },
+        }
@@ -0,0 +1,225 @@
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import NamedTuple, Optional
+
+
+class ClasificacionPregunta(NamedTuple):
+    valida: bool
+    score: float
+    razon: Optional[str]
+
+
+class QuestionClassifier:
+    """
+    Clasificador de preguntas del dominio de RRHH. Normaliza el texto una sola vez y
+    lo evalúa con autómatas de palabras clave compilados (una expresión regular por
+    lista) y, si existe, con un modelo TF-IDF + regresión logística entrenado con las
+    preguntas aceptadas y bloqueadas. El modelo se recarga solo si cambia el archivo.
+    """
+
+    RUTA_MODELO = os.getenv(
+        "QUESTION_CLASSIFIER_MODEL",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "question_classifier.json"),
+    )
+    INTERVALO_RECARGA = float(os.getenv("QUESTION_CLASSIFIER_RELOAD_INTERVAL", "30"))
+
+    ABSURDOS = [
+        "galaxia", "alien", "extraterrestre", "quien gano el mundial de quidditch",
+        "cocinar", "pastel de papas", "inflacion en saturno", "marciano", "dragones"
+    ]
+    CLAVES_VALIDAS = [
+        "honorario", "contrato", "persona", "nombre", "apellido", "funcion", "calificacion",
+        "región", "mes", "año", "pagado", "liquido", "bruto", "tipo de pago", "profesion",
+        "psicólogo", "sueldo", "remuneración", "trabajador", "gasto", "top", "más ganaron", "ganó"
+    ]
+    RAZON_ABSURDA = "Pregunta absurda o fuera de contexto"
+    RAZON_SIN_TERMINOS = "No contiene términos relacionados ni estructura válida"
+
+    _lock = threading.Lock()
+    _modelo = {"datos": None, "mtime": None, "revisado_en": 0.0}
+
+    _TILDES = (("á", "a"), ("é", "e"), ("í", "i"), ("ó", "o"), ("ú", "u"), ("ü", "u"))
+
+    @staticmethod
+    def normalize(texto):
+        """Minúsculas y sin tildes (ñ se conserva)"""
+        texto = texto.lower().strip()
+        if not texto.isascii():
+            for con_tilde, sin_tilde in QuestionClassifier._TILDES:
+                texto = texto.replace(con_tilde, sin_tilde)
+        return texto
+
+    @staticmethod
+    def _automaton(palabras):
+        """
+        Regex con las palabras factorizadas en un trie (ej. "ga(?:no|sto)"): en cada posición
+        del texto se prueba una sola rama por carácter, como en un autómata Aho-Corasick.
+        Mantiene la coincidencia por subcadena de las listas originales.
+        """
+        trie = {}
+        for palabra in {QuestionClassifier.normalize(p) for p in palabras}:
+            nodo = trie
+            for caracter in palabra:
+                nodo = nodo.setdefault(caracter, {})
+            nodo[""] = True
+
+        def construir(nodo):
+            ramas = [re.escape(c) + construir(hijo) for c, hijo in sorted(nodo.items()) if c]
+            if not ramas:
+                return ""
+            # Una palabra que es prefijo de otra ya coincide por sí sola
+            if "" in nodo:
+                return ""
+            return ramas[0] if len(ramas) == 1 else f"(?:{'|'.join(ramas)})"
+
+        return re.compile(construir(trie))
+
+    @staticmethod
+    def tokenize(texto_normalizado):
+        """Unigramas y bigramas de palabras"""
+        palabras = re.findall(r"\w+", texto_normalizado)
+        return palabras + [f"{a} {b}" for a, b in zip(palabras, palabras[1:])]
+
+    @staticmethod
+    def classify(pregunta):
+        """Retorna ClasificacionPregunta(valida, score, razon) en una sola pasada"""
+        clasificador = QuestionClassifier
+        texto = clasificador.normalize(pregunta)
+
+        if clasificador._RE_ABSURDOS.search(texto):
+            return ClasificacionPregunta(False, 0.0, clasificador.RAZON_ABSURDA)
+        if clasificador._RE_CLAVES.search(texto):
+            return ClasificacionPregunta(True, 1.0, None)
+
+        modelo = clasificador.get_model()
+        if modelo is not None:
+            score = clasificador._score(modelo, texto)
+            if score >= modelo["threshold"]:
+                return ClasificacionPregunta(True, score, None)
+            return ClasificacionPregunta(
+                False, score, f"Baja similitud con preguntas del dominio (score {score:.2f})"
+            )
+
+        if len(texto.split()) >= 4 and clasificador._RE_ESTRUCTURA.search(texto):
+            return ClasificacionPregunta(True, 0.5, None)
+        return ClasificacionPregunta(False, 0.0, clasificador.RAZON_SIN_TERMINOS)
+
+    # ------------------- Modelo -------------------
+
+    @staticmethod
+    def get_model():
+        """Modelo vigente; revisa el mtime del archivo cada INTERVALO_RECARGA segundos"""
+        estado = QuestionClassifier._modelo
+        ahora = time.monotonic()
+        if ahora - estado["revisado_en"] < QuestionClassifier.INTERVALO_RECARGA:
+            return estado["datos"]
+
+        with QuestionClassifier._lock:
+            if ahora - estado["revisado_en"] >= QuestionClassifier.INTERVALO_RECARGA:
+                QuestionClassifier._reload()
+                estado["revisado_en"] = ahora
+        return estado["datos"]
+
+    @staticmethod
+    def _reload():
+        estado = QuestionClassifier._modelo
+        ruta = QuestionClassifier.RUTA_MODELO
+        try:
+            mtime = os.path.getmtime(ruta)
+        except OSError:
+            estado["datos"], estado["mtime"] = None, None
+            return
+        if mtime == estado["mtime"]:
+            return
+        try:
+            with open(ruta, encoding="utf-8") as archivo:
+                datos = json.load(archivo)
+            estado["datos"], estado["mtime"] = datos, mtime
+            logging.info(f"Modelo de clasificación de preguntas cargado ({datos.get('trained_at')})")
+        except (OSError, ValueError) as e:
+            # Se mantiene el modelo anterior si el archivo nuevo no se puede leer
+            logging.error(f"Error cargando modelo de clasificación {ruta}: {e}")
+
+    @staticmethod
+    def _vectorize(idf, texto_normalizado):
+        """Vector TF-IDF disperso (dict) normalizado L2"""
+        conteos = Counter(t for t in QuestionClassifier.tokenize(texto_normalizado) if t in idf)
+        vector = {t: n * idf[t] for t, n in conteos.items()}
+        norma = math.sqrt(sum(v * v for v in vector.values()))
+        return {t: v / norma for t, v in vector.items()} if norma else {}
+
+    @staticmethod
+    def _score(modelo, texto_normalizado):
+        vector = QuestionClassifier._vectorize(modelo["idf"], texto_normalizado)
+        pesos = modelo["weights"]
+        z = modelo["bias"] + sum(v * pesos.get(t, 0.0) for t, v in vector.items())
+        return 1 / (1 + math.exp(-max(-30.0, min(30.0, z))))
+
+    @staticmethod
+    def train(aceptadas, bloqueadas, epocas=200, tasa=0.5, regularizacion=1e-4, min_frecuencia=1, threshold=0.5, semilla=0):
+        """
+        Entrena el modelo con descenso de gradiente estocástico sobre vectores dispersos.
+        Retorna el dict serializable que espera classify.
+        """
+        documentos = [(QuestionClassifier.normalize(p), 1) for p in aceptadas] + \
+                     [(QuestionClassifier.normalize(p), 0) for p in bloqueadas]
+
+        frecuencia = Counter()
+        for texto, _ in documentos:
+            frecuencia.update(set(QuestionClassifier.tokenize(texto)))
+        total = len(documentos)
+        idf = {
+            t: math.log((1 + total) / (1 + n)) + 1
+            for t, n in frecuencia.items() if n >= min_frecuencia
+        }
+
+        muestras = [(QuestionClassifier._vectorize(idf, texto), etiqueta) for texto, etiqueta in documentos]
+        # Pesos por clase para que el desbalance (muchas más aceptadas) no sesgue el modelo
+        positivos = sum(1 for _, e in muestras if e) or 1
+        negativos = (total - positivos) or 1
+        peso_clase = {1: total / (2 * positivos), 0: total / (2 * negativos)}
+
+        pesos = {}
+        sesgo = 0.0
+        aleatorio = random.Random(semilla)
+        for epoca in range(epocas):
+            aleatorio.shuffle(muestras)
+            paso = tasa / (1 + epoca * 0.01)
+            for vector, etiqueta in muestras:
+                z = sesgo + sum(v * pesos.get(t, 0.0) for t, v in vector.items())
+                prediccion = 1 / (1 + math.exp(-max(-30.0, min(30.0, z))))
+                error = (prediccion - etiqueta) * peso_clase[etiqueta]
+                for t, v in vector.items():
+                    pesos[t] = pesos.get(t, 0.0) - paso * (error * v + regularizacion * pesos.get(t, 0.0))
+                sesgo -= paso * error
+
+        return {
+            "trained_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "samples": {"accepted": total - len(bloqueadas), "blocked": len(bloqueadas)},
+            "threshold": threshold,
+            "bias": sesgo,
+            "idf": idf,
+            "weights": {t: round(w, 6) for t, w in pesos.items() if abs(w) > 1e-6},
+        }
+
+    @staticmethod
+    def save_model(modelo, ruta=None):
+        """Escribe el modelo de forma atómica; los procesos lo recargan al detectar el cambio"""
+        ruta = ruta or QuestionClassifier.RUTA_MODELO
+        temporal = f"{ruta}.tmp"
+        with open(temporal, "w", encoding="utf-8") as archivo:
+            json.dump(modelo, archivo, ensure_ascii=False)
+        os.replace(temporal, ruta)
+        return ruta
+
+
+QuestionClassifier._RE_ABSURDOS = QuestionClassifier._automaton(QuestionClassifier.ABSURDOS)
+QuestionClassifier._RE_CLAVES = QuestionClassifier._automaton(QuestionClassifier.CLAVES_VALIDAS)
+QuestionClassifier._RE_ESTRUCTURA = re.compile(r"(cuanto|cuales|dame|muestra|que|quien)")
@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from ..models import VersionDatos
+from .sql_parser import SQLParser, InvalidSQLError
+
+
+class ResultCacheService:
+    """Caché de resultados de consultas SQL sobre las tablas de RRHH"""
+
+    TTL = int(os.getenv("RESULT_CACHE_TTL", "3600"))
+    ESPERA_MAXIMA = float(os.getenv("RESULT_CACHE_WAIT_SECONDS", "30"))
+    VERSION_REFRESCO = float(os.getenv("RESULT_CACHE_VERSION_REFRESH", "5"))
+    NOMBRE_VERSION = "rrhh"
+
+    _inflight = {}
+    _lock = threading.Lock()
+    _version = {"valor": None, "leida_en": 0.0}
+
+    @staticmethod
+    def fingerprint(sql_query):
+        """
+        Huella del SQL en su forma canónica (SQLParser: alias, mayúsculas y espacios normalizados).
+        Si no se puede analizar: sin espacios redundantes, sin ';' final y en minúsculas fuera de literales.
+        """
+        try:
+            return hashlib.sha256(SQLParser.parse(sql_query).sql.encode("utf-8")).hexdigest()
+        except InvalidSQLError:
+            pass
+        partes = re.split(r"('(?:[^']|'')*')", sql_query.strip().rstrip(";"))
+        canonico = "".join(
+            parte if parte.startswith("'") else " ".join(parte.lower().split())
+            for parte in partes
+        )
+        return hashlib.sha256(canonico.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def data_version():
+        """Versión actual de los datos de RRHH (se relee cada pocos segundos)"""
+        ahora = time.monotonic()
+        estado = ResultCacheService._version
+        if estado["valor"] is None or ahora - estado["leida_en"] > ResultCacheService.VERSION_REFRESCO:
+            registro = VersionDatos.objects.filter(nombre=ResultCacheService.NOMBRE_VERSION).first()
+            estado["valor"] = registro.version if registro else 0
+            estado["leida_en"] = ahora
+        return estado["valor"]
+
+    @staticmethod
+    def bump_data_version():
+        """Incrementa la versión de datos, invalidando todos los resultados cacheados"""
+        with transaction.atomic():
+            VersionDatos.objects.get_or_create(nombre=ResultCacheService.NOMBRE_VERSION)
+            VersionDatos.objects.filter(nombre=ResultCacheService.NOMBRE_VERSION).update(
+                version=F("version") + 1
+            )
+        ResultCacheService._version["valor"] = None
+        nueva = ResultCacheService.data_version()
+        logging.info(f"Versión de datos RRHH incrementada a {nueva}")
+        return nueva
+
+    @staticmethod
+    def cache_key(sql_query):
+        """Clave de caché: versión de datos + huella del SQL"""
+        return f"resultado_sql:{ResultCacheService.data_version()}:{ResultCacheService.fingerprint(sql_query)}"
+
+    @staticmethod
+    def get_or_execute(sql_query, ejecutor):
+        """
+        Retorna el resultado cacheado de la consulta o la ejecuta con `ejecutor`.
+        Consultas idénticas concurrentes en el mismo proceso se ejecutan una sola vez.
+        """
+        clave = ResultCacheService.cache_key(sql_query)
+        filas = cache.get(clave)
+        if filas is not None:
+            logging.info("Resultado SQL obtenido desde caché")
+            return filas
+
+        with ResultCacheService._lock:
+            evento = ResultCacheService._inflight.get(clave)
+            lider = evento is None
+            if lider:
+                evento = threading.Event()
+                ResultCacheService._inflight[clave] = evento
+
+        if not lider:
+            evento.wait(ResultCacheService.ESPERA_MAXIMA)
+            filas = cache.get(clave)
+            if filas is not None:
+                return filas
+            # El líder falló o demoró demasiado: ejecutar por cuenta propia
+            return ejecutor(sql_query)
+
+        try:
+            filas = ejecutor(sql_query)
+            cache.set(clave, filas, ResultCacheService.TTL)
+            return filas
+        finally:
+            with ResultCacheService._lock:
+                ResultCacheService._inflight.pop(clave, None)
+            evento.set()
@@ -0,0 +1,97 @@
+import csv
+import io
+import os
+from array import array
+from collections import Counter
+from datetime import date, datetime
+from decimal import Decimal
+
+from .columnar_result import ResultadoColumnar
+
+
+class ResultEncoder:
+    """
+    Codifica el resultado SQL para el prompt de la respuesta final: CSV con el
+    encabezado una sola vez y, para resultados grandes, una muestra de filas más
+    un resumen estadístico por columna.
+    """
+
+    MAX_FILAS_COMPLETAS = int(os.getenv("RESULT_PROMPT_MAX_ROWS", "20"))
+    FILAS_MUESTRA = int(os.getenv("RESULT_PROMPT_SAMPLE_ROWS", "10"))
+    TOP_VALORES = 3
+
+    @staticmethod
+    def encode(filas):
+        """Retorna el texto compacto que representa `filas` (ResultadoColumnar o lista de dicts)"""
+        resultado = ResultadoColumnar.of(filas)
+        if not resultado:
+            return "Sin resultados (0 filas)."
+
+        columnas = resultado.columnas
+        total = len(resultado)
+
+        if total <= ResultEncoder.MAX_FILAS_COMPLETAS:
+            return f"{total} filas (CSV):\n{ResultEncoder._to_csv(columnas, resultado.datos)}"
+
+        muestra = [columna[:ResultEncoder.FILAS_MUESTRA] for columna in resultado.datos]
+        return (
+            f"{total} filas. Primeras {len(muestra[0])} (CSV):\n"
+            f"{ResultEncoder._to_csv(columnas, muestra)}\n"
+            f"Resumen por columna de las {total} filas:\n"
+            f"{ResultEncoder._summaries(columnas, resultado.datos)}"
+        )
+
+    @staticmethod
+    def _format_value(valor):
+        if valor is None:
+            return ""
+        if isinstance(valor, Decimal):
+            return format(valor.normalize(), "f") if valor == valor.to_integral() else str(valor)
+        if isinstance(valor, (date, datetime)):
+            return valor.isoformat()
+        return str(valor)
+
+    @staticmethod
+    def _format_column(columna):
+        """Texto de cada valor de la columna; los arreglos tipados no requieren revisar tipos"""
+        if isinstance(columna, array):
+            return list(map(str, columna))
+        return list(map(ResultEncoder._format_value, columna))
+
+    @staticmethod
+    def _to_csv(columnas, datos):
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer, lineterminator="\n")
+        escritor.writerow(columnas)
+        escritor.writerows(zip(*map(ResultEncoder._format_column, datos)))
+        return buffer.getvalue().rstrip("\n")
+
+    @staticmethod
+    def _summaries(columnas, datos):
+        """Estadísticas por columna calculadas sobre columnas completas (no fila a fila)"""
+        lineas = []
+        for col, valores in zip(columnas, datos):
+            # Los IDs se listan completos para que la respuesta pueda referenciarlos
+            if col.startswith("id_"):
+                lineas.append(f"- {col}: {', '.join(v for v in ResultEncoder._format_column(valores) if v)}")
+                continue
+
+            if isinstance(valores, array):
+                # Arreglo tipado: numérico y sin nulos
+                numericos = no_nulos = valores
+            else:
+                no_nulos = [v for v in valores if v is not None]
+                numericos = [v for v in no_nulos if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)]
+            if numericos and len(numericos) == len(no_nulos):
+                suma = sum(numericos)
+                media = suma / len(numericos)
+                lineas.append(
+                    f"- {col}: count={len(numericos)}, min={ResultEncoder._format_value(min(numericos))}, "
+                    f"max={ResultEncoder._format_value(max(numericos))}, sum={ResultEncoder._format_value(suma)}, "
+                    f"mean={round(float(media), 2)}"
+                )
+            else:
+                top = Counter(ResultEncoder._format_value(v) for v in no_nulos).most_common(ResultEncoder.TOP_VALORES)
+                top_texto = ", ".join(f"{valor} ({n})" for valor, n in top)
+                lineas.append(f"- {col}: count={len(no_nulos)}, distintos={len(set(map(str, no_nulos)))}, top: {top_texto}")
+        return "\n".join(lineas)
@@ -0,0 +1,86 @@
+from django.db import connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from ..models import SesionChat, MensajeChat, PreguntaBloqueada
+
+
+class SessionCounters:
+    """
+    Contadores desnormalizados de sesion_chat: mensajes por emisor, preguntas bloqueadas y
+    última actividad. Se incrementan con un UPDATE relativo en la misma transacción que
+    inserta el mensaje o la pregunta bloqueada, de modo que las vistas y la API los leen
+    en vez de contar filas. `manage.py backfill_session_counters` los recalcula.
+    """
+
+    @staticmethod
+    def add_message(sesion, tipo_emisor, contenido, metadata=None):
+        """Crea el mensaje y actualiza los contadores de su sesión"""
+        campo = "total_mensajes_usuario" if tipo_emisor == "usuario" else "total_mensajes_ia"
+        ahora = timezone.now()
+        with transaction.atomic():
+            mensaje = MensajeChat.objects.create(
+                sesion=sesion, tipo_emisor=tipo_emisor, contenido=contenido, fecha=ahora, metadata=metadata
+            )
+            SesionChat.objects.filter(id_sesion=sesion.id_sesion).update(
+                **{campo: F(campo) + 1}, ultima_actividad=ahora
+            )
+        return mensaje
+
+    @staticmethod
+    def add_blocked(sesion, pregunta, razon):
+        """Registra la pregunta bloqueada y actualiza los contadores de su sesión"""
+        ahora = timezone.now()
+        with transaction.atomic():
+            bloqueada = PreguntaBloqueada.objects.create(sesion=sesion, pregunta=pregunta, razon=razon, fecha=ahora)
+            SesionChat.objects.filter(id_sesion=sesion.id_sesion).update(
+                total_bloqueadas=F("total_bloqueadas") + 1, ultima_actividad=ahora
+            )
+        return bloqueada
+
+    @staticmethod
+    def has_blocked(sesion_id):
+        """
+        Decide si la sesión se puede borrar: se consulta preguntas_bloqueadas y no el contador,
+        para que un contador desfasado nunca permita borrar preguntas bloqueadas registradas
+        """
+        return PreguntaBloqueada.objects.filter(sesion_id=sesion_id).exists()
+
+    @staticmethod
+    def totals():
+        """Totales del panel de administración en un solo recorrido de sesion_chat"""
+        return SesionChat.objects.aggregate(
+            total_sesiones=Count("id_sesion"),
+            sesiones_activas=Count("id_sesion", filter=Q(estado="activa")),
+            total_mensajes=Coalesce(Sum(F("total_mensajes_usuario") + F("total_mensajes_ia")), 0),
+            preguntas_bloqueadas=Coalesce(Sum("total_bloqueadas"), 0),
+        )
+
+    @staticmethod
+    def backfill(desde_id, hasta_id):
+        """Recalcula los contadores de las sesiones con id en [desde_id, hasta_id]; retorna las filas actualizadas"""
+        with connection.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE sesion_chat SET
+                    total_mensajes_usuario = (
+                        SELECT COUNT(*) FROM mensaje_chat m
+                        WHERE m.id_sesion = sesion_chat.id_sesion AND m.tipo_emisor = 'usuario'
+                    ),
+                    total_mensajes_ia = (
+                        SELECT COUNT(*) FROM mensaje_chat m
+                        WHERE m.id_sesion = sesion_chat.id_sesion AND m.tipo_emisor <> 'usuario'
+                    ),
+                    total_bloqueadas = (
+                        SELECT COUNT(*) FROM preguntas_bloqueadas p WHERE p.id_sesion = sesion_chat.id_sesion
+                    ),
+                    ultima_actividad = COALESCE(
+                        (SELECT MAX(m.fecha) FROM mensaje_chat m WHERE m.id_sesion = sesion_chat.id_sesion),
+                        fecha_inicio
+                    )
+                WHERE id_sesion BETWEEN %s AND %s
+                """,
+                [desde_id, hasta_id],
+            )
+            return cur.rowcount
@@ -0,0 +1,107 @@
+import base64
+import os
+from datetime import datetime
+
+from django.db.models import Q
+
+from ..models import SesionChat
+
+
+class SessionListService:
+    """
+    Listado de sesiones de un usuario paginado por cursor (keyset) sobre
+    (fecha_inicio, id_sesion), del más reciente al más antiguo: cada página es un
+    rango del índice de sesion_chat, sin OFFSET ni COUNT. La marca de preguntas
+    bloqueadas sale del contador de la propia fila, sin consultas por sesión.
+    """
+
+    LIMITE_DEFECTO = int(os.getenv("SESSIONS_PAGE_SIZE", "20"))
+    LIMITE_MAXIMO = int(os.getenv("SESSIONS_MAX_PAGE_SIZE", "100"))
+
+    # Campo de la respuesta -> (columnas que necesita, valor desde la sesión)
+    CAMPOS = {
+        "id": (("id_sesion",), lambda s: s.id_sesion),
+        "nombre": (("nombre_sesion",), lambda s: s.nombre_sesion or "(sin nombre)"),
+        "fecha_creacion": (("fecha_inicio",), lambda s: s.fecha_inicio.isoformat() if s.fecha_inicio else None),
+        "finalizada": (("estado",), lambda s: s.estado == "finalizada"),
+        "tiene_pregunta_bloqueada": (("total_bloqueadas",), lambda s: s.total_bloqueadas > 0),
+        "ultima_actividad": (
+            ("ultima_actividad",), lambda s: s.ultima_actividad.isoformat() if s.ultima_actividad else None
+        ),
+        "total_mensajes": (
+            ("total_mensajes_usuario", "total_mensajes_ia"), lambda s: s.total_mensajes_usuario + s.total_mensajes_ia
+        ),
+    }
+    CAMPOS_DEFECTO = ("id", "nombre", "fecha_creacion", "finalizada", "tiene_pregunta_bloqueada")
+
+    @staticmethod
+    def parse_fields(texto):
+        """Campos pedidos en `fields` (separados por coma); lanza ValueError si alguno no existe"""
+        if not texto:
+            return SessionListService.CAMPOS_DEFECTO
+        campos = tuple(c.strip() for c in texto.split(",") if c.strip())
+        desconocidos = [c for c in campos if c not in SessionListService.CAMPOS]
+        if desconocidos:
+            raise ValueError(f"Campos desconocidos: {', '.join(desconocidos)}")
+        return campos or SessionListService.CAMPOS_DEFECTO
+
+    @staticmethod
+    def serialize(sesiones, campos):
+        valores = [SessionListService.CAMPOS[c][1] for c in campos]
+        return [{c: valor(s) for c, valor in zip(campos, valores)} for s in sesiones]
+
+    @staticmethod
+    def queryset(usuario, campos):
+        columnas = {"id_sesion", "fecha_inicio"}
+        for campo in campos:
+            columnas.update(SessionListService.CAMPOS[campo][0])
+        return SesionChat.objects.filter(usuario=usuario).only(*columnas).order_by("-fecha_inicio", "-id_sesion")
+
+    @staticmethod
+    def all(usuario, campos=CAMPOS_DEFECTO):
+        """Todas las sesiones en una sola consulta (respuesta en arreglo, compatible con el sidebar)"""
+        return SessionListService.serialize(SessionListService.queryset(usuario, campos), campos)
+
+    @staticmethod
+    def page(usuario, cursor=None, limite=None, campos=CAMPOS_DEFECTO):
+        """
+        Página de sesiones posteriores al cursor: {"sessions", "next_cursor", "has_more"}.
+        Lanza ValueError si el cursor o el límite no son válidos.
+        """
+        try:
+            limite = SessionListService.LIMITE_DEFECTO if limite is None else int(limite)
+        except ValueError:
+            raise ValueError("limit debe ser un entero")
+        if limite < 1:
+            raise ValueError("limit debe ser mayor que 0")
+        limite = min(limite, SessionListService.LIMITE_MAXIMO)
+
+        sesiones = SessionListService.queryset(usuario, campos)
+        if cursor:
+            fecha, id_sesion = SessionListService.decode_cursor(cursor)
+            sesiones = sesiones.filter(
+                Q(fecha_inicio__lt=fecha) | Q(fecha_inicio=fecha, id_sesion__lt=id_sesion)
+            )
+        # Una fila extra solo para saber si hay otra página
+        filas = list(sesiones[:limite + 1])
+        hay_mas = len(filas) > limite
+        filas = filas[:limite]
+        return {
+            "sessions": SessionListService.serialize(filas, campos),
+            "next_cursor": SessionListService.encode_cursor(filas[-1]) if hay_mas else None,
+            "has_more": hay_mas,
+        }
+
+    @staticmethod
+    def encode_cursor(sesion):
+        texto = f"{sesion.fecha_inicio.isoformat()}|{sesion.id_sesion}"
+        return base64.urlsafe_b64encode(texto.encode("ascii")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            texto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+            fecha, id_sesion = texto.rsplit("|", 1)
+            return datetime.fromisoformat(fecha), int(id_sesion)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Cursor inválido")
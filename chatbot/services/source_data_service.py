@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F
+
+from ..models import DatosFuenteMensaje, ResultadoAlmacenado
+from .columnar_result import ResultadoColumnar
+
+
+class SourceDataService:
+    """
+    Almacenamiento y lectura bajo demanda de los datos fuente de un mensaje. Cada resultado
+    se guarda una sola vez por contenido (ResultadoAlmacenado, con conteo de referencias),
+    en formato columnar comprimido, y se lee en páginas por cursor opaco
+    (posición de la última fila entregada) y proyección de columnas. El resultado
+    decodificado de cada mensaje se guarda en una caché LRU pequeña, ya que no cambia
+    una vez guardado y las páginas siguientes suelen pedirse enseguida.
+    """
+
+    LIMITE_DEFECTO = int(os.getenv("SOURCE_DATA_PAGE_SIZE", "50"))
+    LIMITE_MAXIMO = int(os.getenv("SOURCE_DATA_MAX_PAGE_SIZE", "500"))
+    TAMANO_CACHE = int(os.getenv("SOURCE_DATA_CACHE_SIZE", "64"))
+    # zstd si el paquete zstandard está instalado; si no, zlib
+    CODEC = os.getenv("SOURCE_DATA_CODEC", "zstd")
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def store(mensaje, filas):
+        """Asocia el resultado al mensaje, guardándolo solo si no existe uno idéntico"""
+        with transaction.atomic():
+            huella, _ = SourceDataService.intern(filas)
+            return DatosFuenteMensaje.objects.create(mensaje=mensaje, resultado_id=huella)
+
+    @staticmethod
+    def intern(filas):
+        """
+        Suma una referencia al resultado almacenado con el mismo contenido o lo crea con una.
+        Retorna (huella, bytes nuevos guardados); solo comprime cuando el resultado es nuevo.
+        """
+        carga = ResultadoColumnar.of(filas).payload()
+        huella = hashlib.sha256(carga).hexdigest()
+        existentes = ResultadoAlmacenado.objects.filter(huella=huella)
+        if existentes.update(referencias=F("referencias") + 1):
+            return huella, 0
+
+        contenido = ResultadoColumnar.compress(carga, SourceDataService.CODEC)
+        try:
+            with transaction.atomic():
+                ResultadoAlmacenado.objects.create(
+                    huella=huella, contenido=contenido, tamano=len(contenido), referencias=1
+                )
+        except IntegrityError:
+            # Otro worker lo creó entre el UPDATE y el INSERT
+            existentes.update(referencias=F("referencias") + 1)
+            return huella, 0
+        return huella, len(contenido)
+
+    @staticmethod
+    def release(mensajes):
+        """Resta las referencias de los datos fuente de `mensajes` (queryset); llamar antes de eliminarlos"""
+        conteos = (
+            DatosFuenteMensaje.objects.filter(mensaje__in=mensajes, resultado__isnull=False)
+            .values("resultado_id").annotate(total=Count("id"))
+        )
+        for fila in conteos:
+            ResultadoAlmacenado.objects.filter(huella=fila["resultado_id"]).update(
+                referencias=F("referencias") - fila["total"]
+            )
+
+    @staticmethod
+    def decode(contenido, datos=None):
+        """ResultadoColumnar desde lo guardado: formato comprimido o, en filas antiguas, la lista JSON"""
+        if contenido is not None:
+            return ResultadoColumnar.from_bytes(contenido)
+        if isinstance(datos, str):
+            datos = json.loads(datos)
+        return ResultadoColumnar.from_rows(datos or [])
+
+    @staticmethod
+    def load(mensaje_id):
+        """Datos fuente del mensaje como ResultadoColumnar, o None si no tiene"""
+        with SourceDataService._lock:
+            resultado = SourceDataService._cache.get(mensaje_id)
+            if resultado is not None:
+                SourceDataService._cache.move_to_end(mensaje_id)
+                return resultado
+
+        guardado = DatosFuenteMensaje.objects.filter(mensaje_id=mensaje_id).values_list(
+            "resultado__contenido", "datos_comprimidos", "datos"
+        ).first()
+        if guardado is None:
+            return None
+        compartido, propio, datos = guardado
+        resultado = SourceDataService.decode(compartido if compartido is not None else propio, datos)
+
+        with SourceDataService._lock:
+            SourceDataService._cache[mensaje_id] = resultado
+            while len(SourceDataService._cache) > SourceDataService.TAMANO_CACHE:
+                SourceDataService._cache.popitem(last=False)
+        return resultado
+
+    @staticmethod
+    def page(mensaje_id, cursor=None, limite=None, columnas=None):
+        """
+        Página de filas posteriores al cursor: {"columns", "rows", "total", "next_cursor"}.
+        Lanza ValueError si el cursor, el límite o alguna columna no son válidos.
+        """
+        resultado = SourceDataService.load(mensaje_id)
+        if resultado is None:
+            return None
+
+        try:
+            limite = SourceDataService.LIMITE_DEFECTO if limite is None else int(limite)
+        except ValueError:
+            raise ValueError("limit debe ser un entero")
+        if limite < 1:
+            raise ValueError("limit debe ser mayor que 0")
+        limite = min(limite, SourceDataService.LIMITE_MAXIMO)
+
+        inicio = SourceDataService.decode_cursor(cursor) if cursor else 0
+        seleccion = list(resultado.columnas) if not columnas else columnas
+        desconocidas = [c for c in seleccion if c not in resultado.columnas]
+        if desconocidas:
+            raise ValueError(f"Columnas desconocidas: {', '.join(desconocidas)}")
+
+        fin = min(inicio + limite, len(resultado))
+        filas = list(zip(*(resultado.column(c)[inicio:fin] for c in seleccion))) if fin > inicio else []
+        return {
+            "columns": seleccion,
+            "rows": filas,
+            "total": len(resultado),
+            "next_cursor": SourceDataService.encode_cursor(fin) if fin < len(resultado) else None,
+        }
+
+    @staticmethod
+    def encode_cursor(posicion):
+        return base64.urlsafe_b64encode(f"p:{posicion}".encode("ascii")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            texto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+            prefijo, posicion = texto.split(":", 1)
+            posicion = int(posicion)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Cursor inválido")
+        if prefijo != "p" or posicion < 0:
+            raise ValueError("Cursor inválido")
+        return posicion
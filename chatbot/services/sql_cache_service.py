@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from ..models import ConsultaSQLCache
+
+
+class SQLCacheService:
+    """Caché persistente de SQL generado, indexado por pregunta normalizada"""
+
+    TTL = timedelta(seconds=int(os.getenv("SQL_CACHE_TTL", "86400")))
+    MAX_ENTRADAS = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "5000"))
+
+    # Preguntas que dependen del historial ("los anteriores", "esas personas") no se cachean
+    _REFERENCIAS_CONTEXTO = re.compile(
+        r"\b(anterior(es)?|previo|previa|mism[oa]s?|es[oa]s|ell[oa]s|aquell[oa]s|dich[oa]s)\b"
+    )
+
+    _stats = {"hits": 0, "misses": 0}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def normalize_question(pregunta):
+        """Normaliza la pregunta: minúsculas, sin tildes, sin signos finales y espacios colapsados"""
+        texto = unicodedata.normalize("NFKD", pregunta.lower())
+        texto = "".join(c for c in texto if not unicodedata.combining(c))
+        texto = re.sub(r"[¿?¡!.,;:]+", " ", texto)
+        return " ".join(texto.split())
+
+    @staticmethod
+    def schema_version():
+        """Hash corto de la estructura de tablas entregada al modelo"""
+        from .ai_service import AIService
+        estructura = AIService._get_table_structure()
+        return hashlib.sha256(estructura.encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def build_key(pregunta_normalizada, terminos_excluidos=None):
+        """Construye la clave de caché a partir de pregunta, exclusiones y versión de esquema"""
+        terminos = ",".join(sorted({t.strip().lower() for t in (terminos_excluidos or []) if t.strip()}))
+        base = f"{pregunta_normalizada}|{terminos}|{SQLCacheService.schema_version()}"
+        return hashlib.sha256(base.encode("utf-8")).hexdigest(), terminos
+
+    @staticmethod
+    def is_cacheable(pregunta):
+        """Indica si la pregunta es independiente del historial de la conversación"""
+        normalizada = SQLCacheService.normalize_question(pregunta)
+        return not SQLCacheService._REFERENCIAS_CONTEXTO.search(normalizada)
+
+    @staticmethod
+    def get(pregunta, terminos_excluidos=None):
+        """Retorna el SQL cacheado para la pregunta o None si no existe o expiró"""
+        if not SQLCacheService.is_cacheable(pregunta):
+            return None
+
+        clave, _ = SQLCacheService.build_key(
+            SQLCacheService.normalize_question(pregunta), terminos_excluidos
+        )
+        try:
+            entrada = ConsultaSQLCache.objects.filter(clave=clave).first()
+            ahora = timezone.now()
+            if entrada and entrada.fecha_creacion >= ahora - SQLCacheService.TTL:
+                ConsultaSQLCache.objects.filter(pk=entrada.pk).update(
+                    hits=F("hits") + 1, ultimo_uso=ahora
+                )
+                SQLCacheService._count("hits")
+                logging.info(f"SQL cache hit: {entrada.pregunta_normalizada}")
+                return entrada.sql
+            if entrada:
+                entrada.delete()
+        except Exception as e:
+            logging.error(f"Error leyendo caché SQL: {e}")
+
+        SQLCacheService._count("misses")
+        return None
+
+    @staticmethod
+    def set(pregunta, terminos_excluidos, sql):
+        """Guarda el SQL generado y aplica el límite de tamaño de la caché"""
+        if not sql or not SQLCacheService.is_cacheable(pregunta):
+            return
+
+        normalizada = SQLCacheService.normalize_question(pregunta)
+        clave, terminos = SQLCacheService.build_key(normalizada, terminos_excluidos)
+        try:
+            ConsultaSQLCache.objects.update_or_create(
+                clave=clave,
+                defaults={
+                    "pregunta_normalizada": normalizada,
+                    "terminos_excluidos": terminos,
+                    "version_esquema": SQLCacheService.schema_version(),
+                    "sql": sql,
+                    "ultimo_uso": timezone.now(),
+                },
+            )
+            SQLCacheService._evict()
+        except Exception as e:
+            logging.error(f"Error guardando caché SQL: {e}")
+
+    @staticmethod
+    def _evict():
+        """Elimina entradas expiradas y las menos usadas recientemente si se supera el máximo"""
+        ConsultaSQLCache.objects.filter(
+            fecha_creacion__lt=timezone.now() - SQLCacheService.TTL
+        ).delete()
+
+        exceso = ConsultaSQLCache.objects.count() - SQLCacheService.MAX_ENTRADAS
+        if exceso > 0:
+            ids = list(
+                ConsultaSQLCache.objects.order_by("ultimo_uso").values_list("id", flat=True)[:exceso]
+            )
+            ConsultaSQLCache.objects.filter(id__in=ids).delete()
+
+    @staticmethod
+    def purge():
+        """Vacía la caché y reinicia los contadores. Retorna la cantidad de entradas eliminadas"""
+        eliminadas, _ = ConsultaSQLCache.objects.all().delete()
+        with SQLCacheService._lock:
+            SQLCacheService._stats = {"hits": 0, "misses": 0}
+        return eliminadas
+
+    @staticmethod
+    def stats():
+        """Retorna contadores del proceso y tamaño actual de la caché"""
+        with SQLCacheService._lock:
+            hits = SQLCacheService._stats["hits"]
+            misses = SQLCacheService._stats["misses"]
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "entries": ConsultaSQLCache.objects.count(),
+            "max_entries": SQLCacheService.MAX_ENTRADAS,
+            "ttl_seconds": int(SQLCacheService.TTL.total_seconds()),
+            "schema_version": SQLCacheService.schema_version(),
+        }
+
+    @staticmethod
+    def _count(campo):
+        with SQLCacheService._lock:
+            SQLCacheService._stats[campo] += 1
@@ -0,0 +1,1078 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class InvalidSQLError(ValueError):
+    """La consulta no pertenece al subconjunto de SQL permitido"""
+
+
+class ConsultaNormalizada(NamedTuple):
+    sql: str        # SQL canónico ejecutable: LIMIT forzado, alias y formato normalizados
+    huella: str     # hash de la forma de la consulta con los literales reemplazados por "?"
+    limite: int
+    tablas: tuple
+
+
+class _Token(NamedTuple):
+    tipo: str       # palabra, ident, cadena, numero, op, fin
+    valor: str
+    pos: int
+
+
+_TOKEN = re.compile(r"""
+    (?P<espacio>\s+|--[^\n]*|/\*.*?\*/)
+  | (?P<cadena>'(?:[^']|'')*')
+  | (?P<ident>"(?:[^"]|"")+")
+  | (?P<numero>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<palabra>[^\W\d]\w*)
+  | (?P<op>::|<>|!=|<=|>=|\|\||!~\*|!~|~\*|[-+*/%=<>(),.;\[\]~])
+""", re.X | re.S)
+
+# Inicio de la consulta dentro de la respuesta del modelo (puede venir precedida de texto o ```sql)
+_INICIO = re.compile(r"\bselect\b|\bwith\s+(?:recursive\s+)?\w+\s*(?:\([^)]*\)\s*)?as\s*\(", re.I)
+
+# Cierre del bloque ```sql de la respuesta
+_CIERRE = re.compile(r"^[ \t]*```", re.M)
+
+# Salto de línea seguido de un posible párrafo de explicación: título markdown o palabra inicial
+_LINEA = re.compile(r"\n[ \t]*(?P<titulo>#{1,6}[ \t]|\*\*)?(?P<resto>[^\n]*)")
+
+# Palabras que no pueden usarse como alias sin AS
+_RESERVADAS = frozenset("""
+    all and any as asc between by case cross desc distinct else end except exists fetch filter for from
+    full group having ilike in inner intersect into is join lateral left like limit natural not null nulls
+    offset on or order outer over right select similar some then union using when where window with
+""".split())
+
+# Comienzo de otra sentencia: si aparece tras la consulta, la respuesta se rechaza completa
+_SENTENCIAS = frozenset("""
+    alter analyze begin call cluster comment commit copy create deallocate declare delete discard do drop
+    exec execute grant import insert listen load lock merge notify prepare refresh reindex reset revoke
+    rollback security select set truncate update vacuum with
+""".split())
+
+# Funciones con sintaxis de palabras clave en los argumentos: substring(x FROM 1 FOR 3), position(a IN b)
+_FUNCIONES_CON_PALABRAS = frozenset(["substring", "position", "trim", "overlay"])
+_SEPARADORES_FUNCION = frozenset(["from", "for", "in", "placing", "both", "leading", "trailing"])
+
+_PREFIJOS_PROHIBIDOS = ("pg_", "dblink", "lo_")
+_FUNCIONES_PROHIBIDAS = frozenset([
+    "current_setting", "set_config", "nextval", "setval", "currval", "lastval",
+    "query_to_xml", "query_to_xml_and_xmlschema", "table_to_xml", "cursor_to_xml", "txid_current",
+])
+
+_TIPOS_COMPUESTOS = frozenset(["precision", "varying", "with", "without", "time", "zone"])
+_CAMPOS_INTERVALO = frozenset(["year", "month", "day", "hour", "minute", "second"])
+
+
+def _es_prosa(linea):
+    """
+    Línea que no puede continuar una consulta: un título markdown, o texto cuyas tres
+    primeras palabras (o una sola que termina en ':') no son palabras clave de SQL.
+    """
+    if linea.group("titulo"):
+        return True
+    resto = linea.group("resto").strip()
+    palabras = re.findall(r"[^\W\d]\w*", resto)
+    if not palabras or not resto.startswith(palabras[0]):
+        return False
+    claves = _RESERVADAS | _SENTENCIAS
+    if resto.endswith(":") and len(palabras) <= 2:
+        return all(p.lower() not in claves for p in palabras)
+    return len(palabras) >= 3 and all(p.lower() not in claves for p in palabras[:3])
+
+
+def _literal(valor):
+    return {"t": "lit", "v": str(valor), "clase": "num"}
+
+
+def _tokenize(texto):
+    """Tokens del texto; cualquier carácter ajeno a SQL invalida la consulta"""
+    tokens = []
+    pos = 0
+    while pos < len(texto):
+        coincidencia = _TOKEN.match(texto, pos)
+        if not coincidencia:
+            raise InvalidSQLError(f"Carácter no permitido {texto[pos]!r} (posición {pos})")
+        if coincidencia.lastgroup != "espacio":
+            valor = coincidencia.group()
+            if coincidencia.lastgroup == "palabra":
+                valor = valor.lower()
+            tokens.append(_Token(coincidencia.lastgroup, valor, pos))
+        pos = coincidencia.end()
+    tokens.append(_Token("fin", "", pos))
+    return tokens
+
+
+class _Parser:
+    """Descenso recursivo sobre el subconjunto de PostgreSQL que puede generar el modelo"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.i = 0
+
+    # ------------------- Utilidades -------------------
+
+    def ver(self, k=0):
+        return self.tokens[min(self.i + k, len(self.tokens) - 1)]
+
+    def es(self, *valores, k=0):
+        token = self.ver(k)
+        return token.tipo in ("palabra", "op") and token.valor in valores
+
+    def aceptar(self, *valores):
+        if self.es(*valores):
+            self.i += 1
+            return self.tokens[self.i - 1].valor
+        return None
+
+    def esperar(self, *valores):
+        valor = self.aceptar(*valores)
+        if valor is None:
+            self.error(f"se esperaba {' o '.join(v.upper() for v in valores)}")
+        return valor
+
+    def error(self, mensaje):
+        token = self.ver()
+        raise InvalidSQLError(f"{mensaje} cerca de {token.valor or 'fin de la consulta'!r} (posición {token.pos})")
+
+    def es_alias(self):
+        token = self.ver()
+        return token.tipo == "ident" or (token.tipo == "palabra" and token.valor not in _RESERVADAS)
+
+    def identificador(self):
+        if not self.es_alias():
+            self.error("se esperaba un identificador")
+        self.i += 1
+        return self.tokens[self.i - 1].valor
+
+    def etiqueta(self):
+        """Alias tras AS: se admite cualquier palabra, como en PostgreSQL"""
+        token = self.ver()
+        if token.tipo not in ("palabra", "ident"):
+            self.error("se esperaba un alias")
+        self.i += 1
+        return token.valor if token.tipo == "ident" or token.valor not in _RESERVADAS else f'"{token.valor}"'
+
+    def lista(self, regla):
+        elementos = [regla()]
+        while self.aceptar(","):
+            elementos.append(regla())
+        return elementos
+
+    def lista_expresiones(self):
+        return self.lista(self.expresion)
+
+    def lista_identificadores(self):
+        self.esperar("(")
+        identificadores = self.lista(self.identificador)
+        self.esperar(")")
+        return identificadores
+
+    # ------------------- Consultas -------------------
+
+    def sentencia(self):
+        consulta = self.consulta()
+        while self.aceptar(";"):
+            pass
+        if self.ver().tipo != "fin":
+            self.error("solo se permite una sentencia SELECT")
+        return consulta
+
+    def consulta(self):
+        nodo = {"t": "consulta", "with": [], "recursivo": False, "orden": [], "limite": None, "offset": None}
+        if self.aceptar("with"):
+            nodo["recursivo"] = bool(self.aceptar("recursive"))
+            while True:
+                nombre = self.identificador()
+                columnas = self.lista_identificadores() if self.es("(") else None
+                self.esperar("as")
+                self.esperar("(")
+                nodo["with"].append({"nombre": nombre, "columnas": columnas, "q": self.consulta()})
+                self.esperar(")")
+                if not self.aceptar(","):
+                    break
+        nodo["cuerpo"] = self.conjunto()
+        if self.aceptar("order"):
+            self.esperar("by")
+            nodo["orden"] = self.lista(self.item_orden)
+        while True:
+            if nodo["limite"] is None and self.aceptar("limit"):
+                nodo["limite"] = "ALL" if self.aceptar("all") else self.expresion()
+            elif nodo["offset"] is None and self.aceptar("offset"):
+                nodo["offset"] = self.expresion()
+                self.aceptar("row", "rows")
+            elif nodo["limite"] is None and self.aceptar("fetch"):
+                # FETCH FIRST n ROWS ONLY equivale a LIMIT n
+                self.esperar("first", "next")
+                nodo["limite"] = _literal(1) if self.es("row", "rows") else self.expresion()
+                self.esperar("row", "rows")
+                self.esperar("only")
+            else:
+                return nodo
+
+    def conjunto(self):
+        nodo = self.nucleo()
+        while self.es("union", "intersect", "except"):
+            operador = self.aceptar("union", "intersect", "except").upper()
+            modificador = self.aceptar("all", "distinct")
+            if modificador == "all":
+                operador += " ALL"
+            nodo = {"t": "compuesta", "izq": nodo, "op": operador, "der": self.nucleo()}
+        return nodo
+
+    def nucleo(self):
+        if self.aceptar("("):
+            consulta = self.consulta()
+            self.esperar(")")
+            return {"t": "subconsulta", "q": consulta}
+        self.esperar("select")
+        nodo = {"t": "select", "distinct": None, "desde": [], "where": None, "group": [], "having": None}
+        if self.aceptar("distinct"):
+            nodo["distinct"] = []
+            if self.aceptar("on"):
+                self.esperar("(")
+                nodo["distinct"] = self.lista_expresiones()
+                self.esperar(")")
+        else:
+            self.aceptar("all")
+        nodo["columnas"] = self.lista(self.item_select)
+        if self.aceptar("from"):
+            nodo["desde"] = self.lista(self.desde)
+        if self.aceptar("where"):
+            nodo["where"] = self.expresion()
+        if self.aceptar("group"):
+            self.esperar("by")
+            nodo["group"] = self.lista_expresiones()
+        if self.aceptar("having"):
+            nodo["having"] = self.expresion()
+        return nodo
+
+    def item_select(self):
+        if self.aceptar("*"):
+            return {"t": "estrella", "calif": None}
+        expresion = self.expresion()
+        alias = None
+        if self.aceptar("as"):
+            alias = self.etiqueta()
+        elif self.es_alias():
+            alias = self.identificador()
+        return {"t": "item", "expr": expresion, "alias": alias}
+
+    def item_orden(self):
+        item = {"expr": self.expresion(), "desc": self.aceptar("asc", "desc") == "desc", "nulos": None}
+        if self.aceptar("nulls"):
+            item["nulos"] = self.esperar("first", "last").upper()
+        return item
+
+    # ------------------- FROM -------------------
+
+    def desde(self):
+        item = self.desde_primario()
+        while True:
+            tipo = self.tipo_join()
+            if tipo is None:
+                return item
+            nodo = {"t": "join", "izq": item, "tipo": tipo, "der": self.desde_primario(), "on": None, "using": None}
+            if "CROSS" not in tipo and "NATURAL" not in tipo:
+                if self.aceptar("on"):
+                    nodo["on"] = self.expresion()
+                else:
+                    self.esperar("on", "using")
+                    nodo["using"] = self.lista_identificadores()
+            item = nodo
+
+    def tipo_join(self):
+        partes = ["NATURAL"] if self.aceptar("natural") else []
+        lado = self.aceptar("cross", "inner", "left", "right", "full")
+        if lado in ("cross", "left", "right", "full"):
+            partes.append(lado.upper())
+            self.aceptar("outer")
+        if self.aceptar("join"):
+            return " ".join(partes + ["JOIN"])
+        if partes or lado:
+            self.error("se esperaba JOIN")
+        return None
+
+    def desde_primario(self):
+        lateral = bool(self.aceptar("lateral"))
+        if self.aceptar("("):
+            inicio = self.i
+            ambiguo = self.es("(")
+            if ambiguo or self.es("select", "with"):
+                try:
+                    consulta = self.consulta()
+                    self.esperar(")")
+                    alias, columnas = self.alias_tabla()
+                    return {"t": "derivada", "q": consulta, "alias": alias, "columnas": columnas, "lateral": lateral}
+                except InvalidSQLError:
+                    if not ambiguo:
+                        raise
+                    # "((a JOIN b) JOIN c)": no era una subconsulta
+                    self.i = inicio
+            item = self.desde()
+            self.esperar(")")
+            return {"t": "agrupado", "item": item}
+
+        nombre = [self.identificador()]
+        while self.aceptar("."):
+            nombre.append(self.identificador())
+        if self.es("("):
+            funcion = self.funcion(".".join(nombre))
+            alias, columnas = self.alias_tabla()
+            return {"t": "funcion_desde", "f": funcion, "alias": alias, "columnas": columnas}
+        alias, columnas = self.alias_tabla()
+        return {"t": "tabla", "nombre": nombre, "alias": alias, "columnas": columnas}
+
+    def alias_tabla(self):
+        alias = None
+        if self.aceptar("as") or self.es_alias():
+            alias = self.identificador()
+        columnas = self.lista_identificadores() if alias and self.es("(") else None
+        return alias, columnas
+
+    # ------------------- Expresiones -------------------
+
+    def expresion(self):
+        nodo = self.conjuncion()
+        while self.aceptar("or"):
+            nodo = {"t": "bin", "op": "OR", "a": nodo, "b": self.conjuncion()}
+        return nodo
+
+    def conjuncion(self):
+        nodo = self.negacion()
+        while self.aceptar("and"):
+            nodo = {"t": "bin", "op": "AND", "a": nodo, "b": self.negacion()}
+        return nodo
+
+    def negacion(self):
+        if self.aceptar("not"):
+            return {"t": "un", "op": "NOT", "a": self.negacion()}
+        return self.predicado()
+
+    def predicado(self):
+        nodo = self.concatenacion()
+        while True:
+            operador = self.aceptar("=", "<>", "!=", "<", ">", "<=", ">=", "~", "~*", "!~", "!~*")
+            if operador:
+                operador = "<>" if operador == "!=" else operador
+                if self.es("any", "all", "some"):
+                    cuantificador = self.aceptar("any", "all", "some").upper()
+                    self.esperar("(")
+                    if self.es("select", "with"):
+                        derecha = {"t": "cuant", "op": cuantificador, "q": self.consulta(), "arg": None}
+                    else:
+                        derecha = {"t": "cuant", "op": cuantificador, "q": None, "arg": self.expresion()}
+                    self.esperar(")")
+                else:
+                    derecha = self.concatenacion()
+                nodo = {"t": "bin", "op": operador, "a": nodo, "b": derecha}
+                continue
+            if self.aceptar("is"):
+                negado = " NOT" if self.aceptar("not") else ""
+                if self.aceptar("distinct"):
+                    self.esperar("from")
+                    nodo = {"t": "bin", "op": f"IS{negado} DISTINCT FROM", "a": nodo, "b": self.concatenacion()}
+                else:
+                    valor = self.esperar("null", "true", "false", "unknown").upper()
+                    nodo = {"t": "post", "op": f"IS{negado} {valor}", "a": nodo}
+                continue
+            if self.es("isnull", "notnull"):
+                nodo = {"t": "post", "op": "IS NULL" if self.aceptar("isnull", "notnull") == "isnull" else "IS NOT NULL", "a": nodo}
+                continue
+
+            negado = ""
+            if self.es("not") and self.es("like", "ilike", "similar", "in", "between", k=1):
+                self.i += 1
+                negado = "NOT "
+            if self.es("like", "ilike"):
+                operador = negado + self.aceptar("like", "ilike").upper()
+                nodo = {"t": "bin", "op": operador, "a": nodo, "b": self.concatenacion()}
+                if self.aceptar("escape"):
+                    nodo = {"t": "bin", "op": "ESCAPE", "a": nodo, "b": self.concatenacion()}
+            elif self.aceptar("similar"):
+                self.esperar("to")
+                nodo = {"t": "bin", "op": f"{negado}SIMILAR TO", "a": nodo, "b": self.concatenacion()}
+            elif self.aceptar("in"):
+                self.esperar("(")
+                if self.es("select", "with"):
+                    nodo = {"t": "in", "a": nodo, "neg": negado, "q": self.consulta(), "lista": None}
+                else:
+                    nodo = {"t": "in", "a": nodo, "neg": negado, "q": None, "lista": self.lista_expresiones()}
+                self.esperar(")")
+            elif self.aceptar("between"):
+                simetrico = bool(self.aceptar("symmetric"))
+                desde = self.concatenacion()
+                self.esperar("and")
+                nodo = {"t": "between", "a": nodo, "neg": negado, "sym": simetrico, "b": desde, "c": self.concatenacion()}
+            else:
+                return nodo
+
+    def concatenacion(self):
+        nodo = self.aditiva()
+        while self.aceptar("||"):
+            nodo = {"t": "bin", "op": "||", "a": nodo, "b": self.aditiva()}
+        return nodo
+
+    def aditiva(self):
+        nodo = self.multiplicativa()
+        while self.es("+", "-"):
+            operador = self.aceptar("+", "-")
+            nodo = {"t": "bin", "op": operador, "a": nodo, "b": self.multiplicativa()}
+        return nodo
+
+    def multiplicativa(self):
+        nodo = self.unaria()
+        while self.es("*", "/", "%"):
+            operador = self.aceptar("*", "/", "%")
+            nodo = {"t": "bin", "op": operador, "a": nodo, "b": self.unaria()}
+        return nodo
+
+    def unaria(self):
+        if self.es("+", "-"):
+            return {"t": "un", "op": self.aceptar("+", "-"), "a": self.unaria()}
+        nodo = self.primaria()
+        while True:
+            if self.aceptar("::"):
+                nodo = {"t": "conversion", "a": nodo, "tipo": self.tipo()}
+            elif self.aceptar("["):
+                nodo = {"t": "indice", "a": nodo, "i": self.expresion()}
+                self.esperar("]")
+            else:
+                return nodo
+
+    def primaria(self):
+        token = self.ver()
+        if token.tipo in ("numero", "cadena"):
+            self.i += 1
+            return {"t": "lit", "v": token.valor, "clase": "num" if token.tipo == "numero" else "str"}
+        if self.aceptar("("):
+            if self.es("select", "with"):
+                consulta = self.consulta()
+                self.esperar(")")
+                return {"t": "subq", "q": consulta}
+            elementos = self.lista_expresiones()
+            self.esperar(")")
+            return {"t": "paren", "items": elementos}
+        if token.tipo not in ("palabra", "ident"):
+            self.error("expresión inválida")
+
+        valor = token.valor if token.tipo == "palabra" else None
+        siguiente_parentesis = self.es("(", k=1)
+        if valor in ("null", "true", "false"):
+            self.i += 1
+            return {"t": "kw", "v": valor.upper()}
+        if valor == "case":
+            return self.caso()
+        if valor == "exists" and siguiente_parentesis:
+            self.i += 2
+            consulta = self.consulta()
+            self.esperar(")")
+            return {"t": "exists", "q": consulta}
+        if valor == "cast" and siguiente_parentesis:
+            self.i += 2
+            expresion = self.expresion()
+            self.esperar("as")
+            tipo = self.tipo()
+            self.esperar(")")
+            return {"t": "cast", "a": expresion, "tipo": tipo}
+        if valor == "extract" and siguiente_parentesis:
+            self.i += 2
+            campo = self.etiqueta() if self.ver().tipo != "cadena" else self.primaria()["v"].strip("'")
+            self.esperar("from")
+            expresion = self.expresion()
+            self.esperar(")")
+            return {"t": "extract", "campo": campo.strip('"').upper(), "a": expresion}
+        if valor in ("date", "time", "timestamp", "interval") and self.ver(1).tipo == "cadena":
+            self.i += 1
+            literal = self.primaria()
+            campo = self.aceptar(*_CAMPOS_INTERVALO) if valor == "interval" else None
+            return {"t": "tipado", "tipo": valor.upper(), "v": literal, "campo": campo.upper() if campo else None}
+        if valor == "array" and self.es("[", k=1):
+            self.i += 2
+            elementos = [] if self.es("]") else self.lista_expresiones()
+            self.esperar("]")
+            return {"t": "array", "items": elementos}
+        if siguiente_parentesis and (valor not in _RESERVADAS or valor in ("left", "right")):
+            self.i += 1
+            return self.funcion(token.valor)
+
+        partes = [self.identificador()]
+        while self.aceptar("."):
+            if self.aceptar("*"):
+                return {"t": "estrella", "calif": partes}
+            partes.append(self.identificador())
+        if len(partes) > 1 and self.es("("):
+            return self.funcion(".".join(partes))
+        return {"t": "col", "partes": partes}
+
+    def caso(self):
+        self.esperar("case")
+        nodo = {"t": "case", "base": None if self.es("when") else self.expresion(), "whens": [], "else": None}
+        while self.aceptar("when"):
+            condicion = self.expresion()
+            self.esperar("then")
+            nodo["whens"].append((condicion, self.expresion()))
+        if not nodo["whens"]:
+            self.error("CASE sin WHEN")
+        if self.aceptar("else"):
+            nodo["else"] = self.expresion()
+        self.esperar("end")
+        return nodo
+
+    def funcion(self, nombre):
+        self.esperar("(")
+        nodo = {
+            "t": "func", "nombre": nombre, "distinct": False, "args": [], "partes": None,
+            "orden": [], "within": None, "filtro": None, "over": None,
+        }
+        if self.aceptar("*"):
+            nodo["args"] = "*"
+        elif nombre in _FUNCIONES_CON_PALABRAS:
+            nodo["partes"] = []
+            while not self.es(")"):
+                separador = self.aceptar(*_SEPARADORES_FUNCION)
+                if separador:
+                    nodo["partes"].append(separador.upper())
+                elif self.aceptar(","):
+                    nodo["partes"].append(",")
+                else:
+                    nodo["partes"].append(self.concatenacion())
+        elif not self.es(")"):
+            nodo["distinct"] = bool(self.aceptar("distinct"))
+            nodo["args"] = self.lista_expresiones()
+            if self.aceptar("order"):
+                self.esperar("by")
+                nodo["orden"] = self.lista(self.item_orden)
+        self.esperar(")")
+
+        if self.es("within") and self.es("group", k=1):
+            self.i += 2
+            self.esperar("(")
+            self.esperar("order")
+            self.esperar("by")
+            nodo["within"] = self.lista(self.item_orden)
+            self.esperar(")")
+        if self.es("filter") and self.es("(", k=1):
+            self.i += 2
+            self.esperar("where")
+            nodo["filtro"] = self.expresion()
+            self.esperar(")")
+        if self.aceptar("over"):
+            nodo["over"] = self.ventana() if self.es("(") else self.identificador()
+        return nodo
+
+    def ventana(self):
+        self.esperar("(")
+        nodo = {"particion": [], "orden": [], "marco": []}
+        if self.aceptar("partition"):
+            self.esperar("by")
+            nodo["particion"] = self.lista_expresiones()
+        if self.aceptar("order"):
+            self.esperar("by")
+            nodo["orden"] = self.lista(self.item_orden)
+        # Marco de la ventana (ROWS BETWEEN ... AND ...): se conserva tal cual
+        while not self.es(")"):
+            token = self.ver()
+            if token.tipo not in ("palabra", "numero", "cadena"):
+                self.error("marco de ventana inválido")
+            nodo["marco"].append(token.valor.upper() if token.tipo == "palabra" else token.valor)
+            self.i += 1
+        self.esperar(")")
+        return nodo
+
+    def tipo(self):
+        partes = [self.etiqueta()]
+        while self.es(*_TIPOS_COMPUESTOS):
+            partes.append(self.aceptar(*_TIPOS_COMPUESTOS))
+        nombre = " ".join(partes)
+        if self.aceptar("("):
+            argumentos = []
+            while True:
+                token = self.ver()
+                if token.tipo != "numero":
+                    self.error("se esperaba un número")
+                self.i += 1
+                argumentos.append(token.valor)
+                if not self.aceptar(","):
+                    break
+            self.esperar(")")
+            nombre += f"({', '.join(argumentos)})"
+        if self.aceptar("["):
+            self.esperar("]")
+            nombre += "[]"
+        return nombre
+
+
+class _Render:
+    """
+    Genera el SQL canónico desde el árbol: palabras clave en mayúsculas, identificadores en
+    minúsculas, alias de tabla t1..tn en orden de aparición y, con `parametrizar`, literales
+    reemplazados por "?". En la pasada canónica valida tablas y funciones.
+    """
+
+    def __init__(self, parametrizar=False, tablas_permitidas=None):
+        self.parametrizar = parametrizar
+        self.permitidas = tablas_permitidas
+        self.contador = 0
+        self.ambitos = []
+        self.ctes = []
+        self.tablas = set()
+
+    def consulta(self, nodo):
+        partes = []
+        # Cada CTE ve solo a las anteriores (y a sí misma con RECURSIVE); un nombre aún no
+        # definido se resuelve a la tabla real y pasa por la lista de tablas permitidas
+        visibles = set()
+        self.ctes.append(visibles)
+        if nodo["with"]:
+            ctes = []
+            for cte in nodo["with"]:
+                if nodo["recursivo"]:
+                    visibles.add(cte["nombre"])
+                ctes.append(f"{cte['nombre']}{self.columnas(cte['columnas'])} AS ({self.consulta(cte['q'])})")
+                visibles.add(cte["nombre"])
+            partes.append(f"WITH {'RECURSIVE ' if nodo['recursivo'] else ''}{', '.join(ctes)}")
+
+        cuerpo, ambito, salidas = self.conjunto(nodo["cuerpo"])
+        partes.append(cuerpo)
+        if nodo["orden"]:
+            # ORDER BY de una consulta simple ve los alias de su FROM
+            if ambito is not None:
+                self.ambitos.append(ambito)
+            orden = [self.item_orden(item) for item in nodo["orden"]]
+            if salidas is not None and not self.parametrizar:
+                # Regla de PostgreSQL que antes se aproximaba buscando "select distinct ... order by ... case"
+                for item in nodo["orden"]:
+                    posicion = item["expr"]["t"] == "lit" and item["expr"]["clase"] == "num"
+                    if not posicion and self.expr(item["expr"]) not in salidas:
+                        raise InvalidSQLError(
+                            "Con SELECT DISTINCT las expresiones de ORDER BY deben estar en la lista de selección"
+                        )
+            if ambito is not None:
+                self.ambitos.pop()
+            partes.append("ORDER BY " + ", ".join(orden))
+        if nodo["limite"] == "ALL":
+            partes.append("LIMIT ALL")
+        elif nodo["limite"] is not None:
+            partes.append(f"LIMIT {self.expr(nodo['limite'])}")
+        if nodo["offset"] is not None:
+            partes.append(f"OFFSET {self.expr(nodo['offset'])}")
+        self.ctes.pop()
+        return " ".join(partes)
+
+    def conjunto(self, nodo):
+        """Retorna (sql, ámbito de alias, salidas para validar DISTINCT/ORDER BY)"""
+        if nodo["t"] == "select":
+            return self.select(nodo)
+        if nodo["t"] == "subconsulta":
+            return f"({self.consulta(nodo['q'])})", None, None
+        izquierda = self.conjunto(nodo["izq"])[0]
+        derecha = self.conjunto(nodo["der"])[0]
+        return f"{izquierda} {nodo['op']} {derecha}", None, None
+
+    def select(self, nodo):
+        ambito = {}
+        self.ambitos.append(ambito)
+        # El FROM se procesa primero para conocer los alias que usa la lista de selección
+        desde = ", ".join(self.desde(item) for item in nodo["desde"])
+        columnas = []
+        salidas = set() if nodo["distinct"] == [] else None
+        for item in nodo["columnas"]:
+            if item["t"] == "estrella":
+                columnas.append("*")
+                salidas = None
+                continue
+            texto = self.expr(item["expr"])
+            columnas.append(f"{texto} AS {item['alias']}" if item["alias"] else texto)
+            if salidas is not None:
+                salidas.add(texto)
+                if item["alias"]:
+                    salidas.add(item["alias"])
+                if item["expr"]["t"] == "col":
+                    salidas.add(item["expr"]["partes"][-1])
+                if item["expr"]["t"] == "estrella":
+                    salidas = None
+
+        texto = "SELECT "
+        if nodo["distinct"] is not None:
+            texto += f"DISTINCT ON ({self.lista(nodo['distinct'])}) " if nodo["distinct"] else "DISTINCT "
+        texto += ", ".join(columnas)
+        if desde:
+            texto += f" FROM {desde}"
+        if nodo["where"] is not None:
+            texto += f" WHERE {self.expr(nodo['where'])}"
+        if nodo["group"]:
+            texto += f" GROUP BY {self.lista(nodo['group'])}"
+        if nodo["having"] is not None:
+            texto += f" HAVING {self.expr(nodo['having'])}"
+        self.ambitos.pop()
+        return texto, ambito, salidas
+
+    # ------------------- FROM -------------------
+
+    def desde(self, nodo):
+        tipo = nodo["t"]
+        if tipo == "tabla":
+            self.validar_tabla(nodo["nombre"])
+            alias = self.registrar(nodo["alias"], nodo["nombre"])
+            return f"{'.'.join(nodo['nombre'])} {alias}{self.columnas(nodo['columnas'])}"
+        if tipo == "derivada":
+            subconsulta = self.consulta(nodo["q"])
+            alias = self.registrar(nodo["alias"], None)
+            return f"{'LATERAL ' if nodo['lateral'] else ''}({subconsulta}) {alias}{self.columnas(nodo['columnas'])}"
+        if tipo == "funcion_desde":
+            # El alias de una función también nombra su columna: se conserva
+            funcion = self.funcion(nodo["f"])
+            return f"{funcion} {nodo['alias']}{self.columnas(nodo['columnas'])}" if nodo["alias"] else funcion
+        if tipo == "agrupado":
+            return f"({self.desde(nodo['item'])})"
+
+        texto = f"{self.desde(nodo['izq'])} {nodo['tipo']} {self.desde(nodo['der'])}"
+        if nodo["on"] is not None:
+            texto += f" ON {self.expr(nodo['on'])}"
+        elif nodo["using"]:
+            texto += f" USING ({', '.join(nodo['using'])})"
+        return texto
+
+    def registrar(self, alias, nombre):
+        self.contador += 1
+        canonico = f"t{self.contador}"
+        ambito = self.ambitos[-1]
+        if alias:
+            ambito[alias] = canonico
+        elif nombre:
+            ambito[nombre[-1]] = canonico
+            ambito[".".join(nombre)] = canonico
+        return canonico
+
+    def validar_tabla(self, nombre):
+        if self.permitidas is None:
+            return
+        if len(nombre) == 1 and any(nombre[0] in ctes for ctes in self.ctes):
+            return
+        esquema, tabla = nombre[:-1], nombre[-1]
+        if esquema not in ([], ["public"]) or ("*" not in self.permitidas and tabla not in self.permitidas):
+            raise InvalidSQLError(f"Tabla no permitida: {'.'.join(nombre)}")
+        self.tablas.add(tabla)
+
+    def columnas(self, columnas):
+        return f"({', '.join(columnas)})" if columnas else ""
+
+    # ------------------- Expresiones -------------------
+
+    def lista(self, nodos):
+        return ", ".join(self.expr(nodo) for nodo in nodos)
+
+    def columna(self, partes):
+        if len(partes) > 1:
+            calificador = ".".join(partes[:-1])
+            for ambito in reversed(self.ambitos):
+                if calificador in ambito:
+                    return f"{ambito[calificador]}.{partes[-1]}"
+        return ".".join(partes)
+
+    def item_orden(self, item):
+        texto = self.expr(item["expr"])
+        if item["desc"]:
+            texto += " DESC"
+        if item["nulos"]:
+            texto += f" NULLS {item['nulos']}"
+        return texto
+
+    def expr(self, nodo):
+        tipo = nodo["t"]
+        if tipo == "lit":
+            return "?" if self.parametrizar else nodo["v"]
+        if tipo == "kw":
+            return nodo["v"]
+        if tipo == "col":
+            return self.columna(nodo["partes"])
+        if tipo == "estrella":
+            return self.columna(nodo["calif"] + ["*"]) if nodo["calif"] else "*"
+        if tipo == "bin":
+            return f"{self.expr(nodo['a'])} {nodo['op']} {self.expr(nodo['b'])}"
+        if tipo == "un":
+            operando = self.expr(nodo["a"])
+            if nodo["op"] == "NOT":
+                return f"NOT {operando}"
+            # "- -1" no debe quedar como "--1" (comentario)
+            return f"{nodo['op']}{' ' if operando[0] in '+-' else ''}{operando}"
+        if tipo == "post":
+            return f"{self.expr(nodo['a'])} {nodo['op']}"
+        if tipo == "in":
+            if nodo["q"] is not None:
+                contenido = self.consulta(nodo["q"])
+            elif self.parametrizar and all(item["t"] == "lit" for item in nodo["lista"]):
+                # Listas de literales de distinto largo comparten forma
+                contenido = "?"
+            else:
+                contenido = self.lista(nodo["lista"])
+            return f"{self.expr(nodo['a'])} {nodo['neg']}IN ({contenido})"
+        if tipo == "between":
+            simetrico = "SYMMETRIC " if nodo["sym"] else ""
+            return f"{self.expr(nodo['a'])} {nodo['neg']}BETWEEN {simetrico}{self.expr(nodo['b'])} AND {self.expr(nodo['c'])}"
+        if tipo == "cuant":
+            contenido = self.consulta(nodo["q"]) if nodo["q"] is not None else self.expr(nodo["arg"])
+            return f"{nodo['op']} ({contenido})"
+        if tipo == "conversion":
+            return f"{self.expr(nodo['a'])}::{nodo['tipo']}"
+        if tipo == "indice":
+            return f"{self.expr(nodo['a'])}[{self.expr(nodo['i'])}]"
+        if tipo == "paren":
+            return f"({self.lista(nodo['items'])})"
+        if tipo == "subq":
+            return f"({self.consulta(nodo['q'])})"
+        if tipo == "exists":
+            return f"EXISTS ({self.consulta(nodo['q'])})"
+        if tipo == "case":
+            texto = "CASE" + (f" {self.expr(nodo['base'])}" if nodo["base"] is not None else "")
+            texto += "".join(f" WHEN {self.expr(c)} THEN {self.expr(r)}" for c, r in nodo["whens"])
+            if nodo["else"] is not None:
+                texto += f" ELSE {self.expr(nodo['else'])}"
+            return texto + " END"
+        if tipo == "cast":
+            return f"CAST({self.expr(nodo['a'])} AS {nodo['tipo']})"
+        if tipo == "extract":
+            return f"EXTRACT({nodo['campo']} FROM {self.expr(nodo['a'])})"
+        if tipo == "tipado":
+            return f"{nodo['tipo']} {self.expr(nodo['v'])}" + (f" {nodo['campo']}" if nodo["campo"] else "")
+        if tipo == "array":
+            return f"ARRAY[{self.lista(nodo['items'])}]"
+        return self.funcion(nodo)
+
+    def funcion(self, nodo):
+        nombre = nodo["nombre"]
+        if not self.parametrizar:
+            simple = nombre.split(".")[-1]
+            if simple.startswith(_PREFIJOS_PROHIBIDOS) or simple in _FUNCIONES_PROHIBIDAS or \
+                    nombre.split(".")[0].startswith("pg_"):
+                raise InvalidSQLError(f"Función no permitida: {nombre}")
+
+        if nodo["args"] == "*":
+            argumentos = "*"
+        elif nodo["partes"] is not None:
+            argumentos = " ".join(p if isinstance(p, str) else self.expr(p) for p in nodo["partes"]).replace(" ,", ",")
+        else:
+            argumentos = ("DISTINCT " if nodo["distinct"] else "") + self.lista(nodo["args"])
+            if nodo["orden"]:
+                argumentos += " ORDER BY " + ", ".join(self.item_orden(item) for item in nodo["orden"])
+        texto = f"{nombre}({argumentos})"
+
+        if nodo["within"]:
+            texto += f" WITHIN GROUP (ORDER BY {', '.join(self.item_orden(item) for item in nodo['within'])})"
+        if nodo["filtro"] is not None:
+            texto += f" FILTER (WHERE {self.expr(nodo['filtro'])})"
+        if isinstance(nodo["over"], str):
+            texto += f" OVER {nodo['over']}"
+        elif nodo["over"] is not None:
+            ventana = nodo["over"]
+            partes = []
+            if ventana["particion"]:
+                partes.append(f"PARTITION BY {self.lista(ventana['particion'])}")
+            if ventana["orden"]:
+                partes.append("ORDER BY " + ", ".join(self.item_orden(item) for item in ventana["orden"]))
+            partes.extend(ventana["marco"])
+            texto += f" OVER ({' '.join(partes)})"
+        return texto
+
+
+class SQLParser:
+    """
+    Analiza el SQL generado por el modelo con un tokenizador y un parser del subconjunto
+    de PostgreSQL permitido (un único SELECT, con CTE, JOIN, subconsultas, CASE y ventanas).
+    Rechaza cualquier otra sentencia, tablas fuera del esquema de RRHH y funciones de sistema,
+    fuerza un LIMIT máximo y genera una forma canónica con su huella para cachés y planes.
+    """
+
+    MAX_FILAS = int(os.getenv("SQL_MAX_ROWS", "100"))
+    TABLAS_PERMITIDAS = frozenset(
+        t.strip().lower()
+        for t in os.getenv("SQL_ALLOWED_TABLES", "persona,funcion,tiempo_contrato,contrato").split(",")
+        if t.strip()
+    )
+    TAMANO_CACHE = int(os.getenv("SQL_PARSE_CACHE_SIZE", "1024"))
+
+    _cache = OrderedDict()
+    _lock = threading.Lock()
+    _stats = {"parsed": 0, "cache_hits": 0, "rejected": 0}
+
+    @staticmethod
+    def parse(sql):
+        """ConsultaNormalizada de un SQL que debe ser exactamente una consulta SELECT"""
+        try:
+            return SQLParser._parse(sql)
+        except InvalidSQLError:
+            SQLParser._count("rejected")
+            raise
+
+    @staticmethod
+    def extract(texto):
+        """
+        Extrae la consulta de la respuesta del modelo: ignora el texto previo y el bloque
+        ```sql. El texto posterior solo se descarta si empieza en una línea nueva y es
+        explicación en prosa; cualquier otro resto que no se pueda analizar rechaza la
+        respuesta completa, nunca se ejecuta un prefijo de la consulta.
+        """
+        inicio = _INICIO.search(texto or "")
+        if not inicio:
+            SQLParser._count("rejected")
+            raise InvalidSQLError("La respuesta no contiene una consulta SELECT")
+        sql = texto[inicio.start():]
+        cierre = _CIERRE.search(sql)
+        if cierre:
+            sql = sql[:cierre.start()]
+        try:
+            return SQLParser._parse(sql)
+        except InvalidSQLError as error:
+            for linea in _LINEA.finditer(sql):
+                if not _es_prosa(linea):
+                    continue
+                try:
+                    return SQLParser._parse(sql[:linea.start()])
+                except InvalidSQLError:
+                    continue
+            SQLParser._count("rejected")
+            raise error
+
+    @staticmethod
+    def _parse(sql):
+        clave = sql
+        with SQLParser._lock:
+            resultado = SQLParser._cache.get(clave)
+            if resultado is not None:
+                SQLParser._cache.move_to_end(clave)
+                SQLParser._stats["cache_hits"] += 1
+                return resultado
+
+        try:
+            arbol = _Parser(_tokenize(sql)).sentencia()
+            limite = SQLParser._force_limit(arbol)
+            canonico = _Render(tablas_permitidas=SQLParser.TABLAS_PERMITIDAS)
+            sql_canonico = canonico.consulta(arbol)
+            forma = _Render(parametrizar=True).consulta(arbol)
+        except RecursionError:
+            raise InvalidSQLError("Consulta demasiado anidada")
+
+        resultado = ConsultaNormalizada(
+            sql_canonico, hashlib.sha256(forma.encode("utf-8")).hexdigest(), limite, tuple(sorted(canonico.tablas))
+        )
+        with SQLParser._lock:
+            SQLParser._stats["parsed"] += 1
+            # La forma canónica es un punto fijo: validarla después no vuelve a parsear
+            SQLParser._cache[clave] = resultado
+            SQLParser._cache[sql_canonico] = resultado
+            while len(SQLParser._cache) > SQLParser.TAMANO_CACHE:
+                SQLParser._cache.popitem(last=False)
+        return resultado
+
+    @staticmethod
+    def add_anti_joins(sql, exclusiones):
+        """
+        Agrega a cada referencia de las tablas indicadas un anti-join contra un conjunto de ids:
+        `exclusiones` es {tabla: (columna_id, ids)}. El filtro va siempre en el WHERE del SELECT
+        que usa la tabla. Si la tabla está del lado opcional de un LEFT/RIGHT/FULL JOIN se
+        conservan las filas sin pareja (IS NULL), pero se descartan las filas unidas a un id
+        excluido: filtrar en el ON haría pasar esas filas por "sin pareja" (por ejemplo, una
+        persona cuyos únicos contratos están excluidos aparecería como "sin contrato").
+        Retorna el SQL canónico resultante.
+        """
+        exclusiones = {tabla: (columna, ids) for tabla, (columna, ids) in exclusiones.items() if ids}
+        if not exclusiones:
+            return sql
+        arbol = _Parser(_tokenize(sql)).sentencia()
+
+        def predicado(tabla, opcional):
+            columna, ids = exclusiones[tabla["nombre"][-1]]
+            calificador = tabla["alias"] or tabla["nombre"][-1]
+            texto = f"{calificador}.{columna} NOT IN (SELECT unnest('{{{','.join(map(str, sorted(ids)))}}}'::int[]))"
+            if opcional:
+                texto = f"({calificador}.{columna} IS NULL OR {texto})"
+            return _Parser(_tokenize(texto)).expresion()
+
+        def agregar(condicion, predicados):
+            base = [] if condicion is None else [{"t": "paren", "items": [condicion]}]
+            nodos = base + predicados
+            resultado = nodos[0]
+            for nodo in nodos[1:]:
+                resultado = {"t": "bin", "op": "AND", "a": resultado, "b": nodo}
+            return resultado
+
+        def recorrer_desde(item, opcional, condiciones, ctes):
+            if item["t"] == "tabla":
+                if item["nombre"][-1] not in exclusiones or (len(item["nombre"]) == 1 and item["nombre"][0] in ctes):
+                    return
+                condiciones.append(predicado(item, opcional))
+            elif item["t"] == "agrupado":
+                recorrer_desde(item["item"], opcional, condiciones, ctes)
+            elif item["t"] == "join":
+                tipo = item["tipo"]
+                recorrer_desde(item["izq"], opcional or "RIGHT" in tipo or "FULL" in tipo, condiciones, ctes)
+                recorrer_desde(item["der"], opcional or "LEFT" in tipo or "FULL" in tipo, condiciones, ctes)
+
+        def recorrer(nodo, ctes):
+            """`ctes` son los nombres de CTE visibles en este nivel, con las reglas de _Render.consulta"""
+            if isinstance(nodo, dict):
+                if nodo.get("t") == "consulta" and nodo["with"]:
+                    visibles = set(ctes)
+                    for cte in nodo["with"]:
+                        if nodo["recursivo"]:
+                            visibles.add(cte["nombre"])
+                        recorrer(cte["q"], frozenset(visibles))
+                        visibles.add(cte["nombre"])
+                    ctes = frozenset(visibles)
+                    nodo = {clave: valor for clave, valor in nodo.items() if clave != "with"}
+                if nodo.get("t") == "select":
+                    condiciones = []
+                    for item in nodo["desde"]:
+                        recorrer_desde(item, False, condiciones, ctes)
+                    if condiciones:
+                        nodo["where"] = agregar(nodo["where"], condiciones)
+                for valor in list(nodo.values()):
+                    recorrer(valor, ctes)
+            elif isinstance(nodo, (list, tuple)):
+                for valor in nodo:
+                    recorrer(valor, ctes)
+
+        recorrer(arbol, frozenset())
+        return _Render(tablas_permitidas=SQLParser.TABLAS_PERMITIDAS).consulta(arbol)
+
+    @staticmethod
+    def with_limit(sql, tope):
+        """SQL canónico con el LIMIT externo reducido a `tope` (nunca lo aumenta)"""
+        arbol = _Parser(_tokenize(sql)).sentencia()
+        SQLParser._force_limit(arbol, tope)
+        return _Render(tablas_permitidas=SQLParser.TABLAS_PERMITIDAS).consulta(arbol)
+
+    @staticmethod
+    def _force_limit(arbol, tope=None):
+        """Aplica el tope de filas al LIMIT de la consulta externa y retorna el límite efectivo"""
+        tope = SQLParser.MAX_FILAS if tope is None else tope
+        actual = arbol["limite"]
+        if actual is None or actual == "ALL":
+            arbol["limite"] = _literal(tope)
+            return tope
+        if actual["t"] == "lit" and actual["v"].isdigit():
+            limite = min(int(actual["v"]), tope)
+            arbol["limite"] = _literal(limite)
+            return limite
+        arbol["limite"] = {
+            "t": "func", "nombre": "least", "distinct": False, "args": [actual, _literal(tope)], "partes": None,
+            "orden": [], "within": None, "filtro": None, "over": None,
+        }
+        return tope
+
+    @staticmethod
+    def stats():
+        """Consultas analizadas, aciertos de la caché de análisis y rechazos"""
+        with SQLParser._lock:
+            return {**SQLParser._stats, "cache_entries": len(SQLParser._cache), "max_rows": SQLParser.MAX_FILAS}
+
+    @staticmethod
+    def _count(campo):
+        with SQLParser._lock:
+            SQLParser._stats[campo] += 1
@@ -0,0 +1,24 @@
+from django.apps import apps
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+
+class UnmanagedTablesTestRunner(DiscoverRunner):
+    """
+    Las tablas de RRHH y del chat (managed = False) no las crea ninguna migración, y las
+    migraciones de los modelos propios ya apuntan a ellas (ej. datos fuente -> mensaje_chat).
+    La base de pruebas se arma desde los modelos actuales, incluidos los no administrados,
+    en vez de aplicar las migraciones.
+    """
+
+    def setup_databases(self, **kwargs):
+        no_administrados = [modelo for modelo in apps.get_models() if not modelo._meta.managed]
+        for modelo in no_administrados:
+            modelo._meta.managed = True
+        for alias in connections:
+            connections[alias].settings_dict["TEST"]["MIGRATE"] = False
+        try:
+            return super().setup_databases(**kwargs)
+        finally:
+            for modelo in no_administrados:
+                modelo._meta.managed = False
@@ -1,3 +1,1362 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from array import array
+from collections import OrderedDict, deque
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import anthropic
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, OperationalError
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import (
+    SesionChat, MensajeChat, Persona, Funcion, TiempoContrato, Contrato, EvaluacionConsulta, DatosFuenteMensaje,
+    ResultadoAlmacenado,
+)
+from .services import (
+    SQLParser, InvalidSQLError, ResultCacheService, LLMBackend, LLMGovernor, LLMOverloadedError, ChatService,
+    CoalescingService, HistoryService, AIService, ExclusionService, QueryGuard, QueryRejectedError,
+    ResultadoColumnar, SourceDataService, SessionCounters, SessionListService, MessagePageService,
+)
+from .services import columnar_result
+from .services.llm_backend import FakeLLMBackend, GovernedBackend
+
+
+SELECT_CONTRATOS = (
+    "SELECT c.id_contrato, p.nombre_completo FROM contrato c "
+    "JOIN persona p ON c.id_persona = p.id_persona"
+)
+
+
+class SQLParserParseTests(SimpleTestCase):
+    """SQLParser.parse: un único SELECT sobre las tablas permitidas"""
+
+    def test_acepta_select_con_join(self):
+        consulta = SQLParser.parse(SELECT_CONTRATOS + " WHERE c.honorario_total_bruto > 1000")
+        self.assertEqual(consulta.tablas, ("contrato", "persona"))
+
+    def test_fuerza_limit_sin_limit(self):
+        consulta = SQLParser.parse(SELECT_CONTRATOS)
+        self.assertEqual(consulta.limite, SQLParser.MAX_FILAS)
+        self.assertTrue(consulta.sql.rstrip(";").endswith(f"LIMIT {SQLParser.MAX_FILAS}"))
+
+    def test_reduce_limit_mayor_al_maximo(self):
+        consulta = SQLParser.parse(SELECT_CONTRATOS + f" LIMIT {SQLParser.MAX_FILAS * 10}")
+        self.assertEqual(consulta.limite, SQLParser.MAX_FILAS)
+
+    def test_conserva_limit_menor(self):
+        self.assertEqual(SQLParser.parse(SELECT_CONTRATOS + " LIMIT 5").limite, 5)
+
+    def test_forma_canonica_es_estable(self):
+        consulta = SQLParser.parse(SELECT_CONTRATOS + " LIMIT 5")
+        self.assertEqual(SQLParser.parse(consulta.sql).sql, consulta.sql)
+
+    def test_huella_ignora_literales(self):
+        a = SQLParser.parse("SELECT * FROM contrato WHERE id_contrato = 1")
+        b = SQLParser.parse("SELECT * FROM contrato WHERE id_contrato = 2")
+        self.assertEqual(a.huella, b.huella)
+        self.assertNotEqual(a.sql, b.sql)
+
+    def test_rechaza_varias_sentencias(self):
+        for sql in [
+            "SELECT * FROM persona; DELETE FROM persona",
+            "SELECT * FROM persona; SELECT * FROM contrato",
+            "SELECT * FROM persona;\nDROP TABLE persona",
+        ]:
+            with self.subTest(sql=sql), self.assertRaises(InvalidSQLError):
+                SQLParser.parse(sql)
+
+    def test_rechaza_sentencias_que_no_son_select(self):
+        for sql in ["DELETE FROM persona", "UPDATE persona SET nombre_completo = 'x'", "DROP TABLE persona"]:
+            with self.subTest(sql=sql), self.assertRaises(InvalidSQLError):
+                SQLParser.parse(sql)
+
+    def test_rechaza_funciones_de_sistema(self):
+        for sql in [
+            "SELECT pg_sleep(10)",
+            "SELECT pg_read_file('/etc/passwd')",
+            "SELECT * FROM persona WHERE id_persona = pg_backend_pid()",
+            "SELECT current_setting('is_superuser')",
+            "SELECT dblink_exec('x', 'DROP TABLE persona')",
+        ]:
+            with self.subTest(sql=sql), self.assertRaises(InvalidSQLError):
+                SQLParser.parse(sql)
+
+    def test_rechaza_tablas_no_permitidas(self):
+        for sql in [
+            "SELECT * FROM auth_user",
+            "SELECT * FROM pg_catalog.pg_tables",
+            "SELECT * FROM persona p JOIN mensaje_chat m ON m.id_sesion = p.id_persona",
+            "SELECT * FROM persona WHERE id_persona IN (SELECT id FROM authtoken_token)",
+        ]:
+            with self.subTest(sql=sql), self.assertRaises(InvalidSQLError):
+                SQLParser.parse(sql)
+
+    def test_cte_no_oculta_tabla_no_permitida(self):
+        for sql in [
+            "WITH auth_user AS (SELECT * FROM auth_user) SELECT * FROM auth_user",
+            "WITH mensaje_chat AS (SELECT * FROM mensaje_chat) SELECT * FROM mensaje_chat",
+            "WITH a AS (SELECT * FROM auth_user), auth_user AS (SELECT 1) SELECT * FROM a",
+            "SELECT * FROM (WITH auth_user AS (SELECT * FROM auth_user) SELECT * FROM auth_user) x",
+        ]:
+            with self.subTest(sql=sql), self.assertRaises(InvalidSQLError):
+                SQLParser.parse(sql)
+
+    def test_cte_ve_las_anteriores_y_a_si_misma_con_recursive(self):
+        consulta = SQLParser.parse(
+            "WITH p AS (SELECT * FROM persona), q AS (SELECT * FROM p) SELECT * FROM q"
+        )
+        self.assertEqual(consulta.tablas, ("persona",))
+        consulta = SQLParser.parse(
+            "WITH RECURSIVE r AS (SELECT 1 AS n UNION ALL SELECT n + 1 FROM r WHERE n < 3) SELECT * FROM r"
+        )
+        self.assertEqual(consulta.tablas, ())
+        with self.assertRaises(InvalidSQLError):
+            SQLParser.parse("WITH r AS (SELECT * FROM r) SELECT * FROM r")
+
+    def test_rechaza_operadores_desconocidos(self):
+        for sql in [
+            SELECT_CONTRATOS + " WHERE c.id_persona # 3 = 2",
+            SELECT_CONTRATOS + " WHERE c.x @> ARRAY[1]",
+            "SELECT * FROM tiempo_contrato t WHERE (t.fecha_inicio, t.fecha_termino) OVERLAPS (1, 2)",
+            SELECT_CONTRATOS + " FOR UPDATE",
+        ]:
+            with self.subTest(sql=sql), self.assertRaises(InvalidSQLError):
+                SQLParser.parse(sql)
+
+
+class SQLParserExtractTests(SimpleTestCase):
+    """SQLParser.extract: la consulta dentro de la respuesta del modelo"""
+
+    def test_ignora_texto_previo_y_bloque_markdown(self):
+        texto = f"Aquí está la consulta:\n```sql\n{SELECT_CONTRATOS}\nLIMIT 5;\n```\nDevuelve los contratos."
+        self.assertEqual(SQLParser.extract(texto).sql, SQLParser.parse(SELECT_CONTRATOS + " LIMIT 5").sql)
+
+    def test_descarta_explicacion_en_linea_nueva(self):
+        for explicacion in [
+            "Esta consulta obtiene los contratos con su persona.",
+            "Explicación:\n- une contrato con persona",
+            "## Explicación\nune contrato con persona",
+        ]:
+            with self.subTest(explicacion=explicacion):
+                consulta = SQLParser.extract(f"{SELECT_CONTRATOS}\nLIMIT 5\n{explicacion}")
+                self.assertEqual(consulta.limite, 5)
+
+    def test_no_trunca_en_operador_desconocido(self):
+        for sql in [
+            SELECT_CONTRATOS + " WHERE c.id_contrato > 0 AND c.x @> ARRAY[1]",
+            SELECT_CONTRATOS + " WHERE c.id_contrato > 0 AND c.id_persona # 3 = 2",
+            "SELECT * FROM tiempo_contrato t WHERE (t.fecha_inicio, t.fecha_termino) OVERLAPS (1, 2)",
+            SELECT_CONTRATOS + " FOR UPDATE",
+            SELECT_CONTRATOS + "\nFOR UPDATE",
+            SELECT_CONTRATOS + "\nWHERE c.x @> ARRAY[1]",
+        ]:
+            with self.subTest(sql=sql), self.assertRaises(InvalidSQLError):
+                SQLParser.extract(sql)
+
+    def test_no_trunca_en_texto_en_la_misma_linea(self):
+        with self.assertRaises(InvalidSQLError):
+            SQLParser.extract(SELECT_CONTRATOS + "; esta consulta obtiene los contratos")
+
+    def test_rechaza_otra_sentencia_despues(self):
+        for texto in [
+            "SELECT * FROM persona; DELETE FROM persona",
+            "SELECT * FROM persona;\nDELETE FROM persona",
+            "```sql\nSELECT * FROM persona;\nDROP TABLE persona;\n```",
+        ]:
+            with self.subTest(texto=texto), self.assertRaises(InvalidSQLError):
+                SQLParser.extract(texto)
+
+    def test_rechaza_respuesta_sin_select(self):
+        with self.assertRaises(InvalidSQLError):
+            SQLParser.extract("No puedo generar esa consulta.")
+
+    def test_fuerza_limit(self):
+        self.assertEqual(SQLParser.extract(f"```sql\n{SELECT_CONTRATOS}\n```").limite, SQLParser.MAX_FILAS)
+
+
+class SQLParserAntiJoinTests(SimpleTestCase):
+    """SQLParser.add_anti_joins: filtro de ids excluidos en cada referencia a la tabla"""
+
+    EXCLUSIONES = {"persona": ("id_persona", [2, 1])}
+    FILTRO = "id_persona NOT IN (SELECT unnest('{1,2}'::int[]))"
+
+    def test_filtra_la_tabla(self):
+        sql = SQLParser.add_anti_joins("SELECT * FROM persona", self.EXCLUSIONES)
+        self.assertEqual(sql, f"SELECT * FROM persona t1 WHERE t1.{self.FILTRO}")
+
+    def test_filtra_todas_las_referencias_incluidas_subconsultas(self):
+        sql = SQLParser.add_anti_joins(
+            "SELECT * FROM contrato c JOIN persona p ON p.id_persona = c.id_persona "
+            "WHERE c.id_persona IN (SELECT id_persona FROM persona)",
+            self.EXCLUSIONES,
+        )
+        self.assertIn(f"WHERE t3.{self.FILTRO}", sql)
+        self.assertIn(f"AND t2.{self.FILTRO}", sql)
+
+    def test_lado_opcional_de_outer_join_conserva_filas_sin_pareja(self):
+        for consulta, alias in [
+            ("SELECT * FROM contrato c LEFT JOIN persona p ON p.id_persona = c.id_persona", "t2"),
+            ("SELECT * FROM persona p RIGHT JOIN contrato c ON p.id_persona = c.id_persona", "t1"),
+            ("SELECT * FROM contrato c FULL JOIN persona p ON p.id_persona = c.id_persona", "t2"),
+            ("SELECT * FROM contrato c LEFT JOIN (persona p JOIN funcion f ON true) ON p.id_persona = c.id_persona", "t2"),
+        ]:
+            with self.subTest(consulta=consulta):
+                sql = SQLParser.add_anti_joins(consulta, self.EXCLUSIONES)
+                # En el WHERE y no en el ON: una fila unida a un id excluido no pasa como "sin pareja"
+                self.assertTrue(sql.endswith(f" WHERE ({alias}.id_persona IS NULL OR {alias}.{self.FILTRO})"), sql)
+                self.assertNotIn("NOT IN", sql.split(" WHERE ")[0])
+
+    def test_lado_preservado_de_outer_join_se_filtra_completo(self):
+        sql = SQLParser.add_anti_joins(
+            "SELECT * FROM persona p LEFT JOIN contrato c ON p.id_persona = c.id_persona", self.EXCLUSIONES
+        )
+        self.assertTrue(sql.endswith(f" WHERE t1.{self.FILTRO}"), sql)
+
+    def test_sin_ids_no_cambia_la_consulta(self):
+        sql = SQLParser.add_anti_joins("SELECT * FROM persona", {"persona": ("id_persona", [])})
+        self.assertEqual(sql, "SELECT * FROM persona")
+
+    def test_filtra_la_tabla_dentro_de_cte_con_su_mismo_nombre(self):
+        sql = SQLParser.add_anti_joins(
+            "WITH persona AS (SELECT * FROM persona) SELECT * FROM persona", self.EXCLUSIONES
+        )
+        self.assertEqual(
+            sql, f"WITH persona AS (SELECT * FROM persona t1 WHERE t1.{self.FILTRO}) SELECT * FROM persona t2"
+        )
+
+    def test_no_filtra_referencias_a_la_cte(self):
+        sql = SQLParser.add_anti_joins(
+            "WITH p AS (SELECT * FROM persona), persona AS (SELECT * FROM p) SELECT * FROM persona",
+            self.EXCLUSIONES,
+        )
+        self.assertEqual(sql.count("NOT IN"), 1)
+        self.assertIn(f"FROM persona t1 WHERE t1.{self.FILTRO})", sql)
+
+
+class ResultCacheServiceTests(TestCase):
+    """ResultCacheService: resultados por versión de datos y una sola ejecución por consulta en curso"""
+
+    def setUp(self):
+        cache.clear()
+        ResultCacheService._version.update(valor=None, leida_en=0.0)
+        self.ejecutor = mock.Mock(return_value=[{"id_persona": 1}])
+
+    def test_consultas_equivalentes_usan_la_cache(self):
+        ResultCacheService.get_or_execute("SELECT * FROM persona", self.ejecutor)
+        filas = ResultCacheService.get_or_execute("select *\n  from persona;", self.ejecutor)
+        self.assertEqual(filas, [{"id_persona": 1}])
+        self.assertEqual(self.ejecutor.call_count, 1)
+
+    def test_nueva_version_de_datos_invalida(self):
+        ResultCacheService.get_or_execute("SELECT * FROM persona", self.ejecutor)
+        version = ResultCacheService.data_version()
+        self.assertEqual(ResultCacheService.bump_data_version(), version + 1)
+        ResultCacheService.get_or_execute("SELECT * FROM persona", self.ejecutor)
+        self.assertEqual(self.ejecutor.call_count, 2)
+
+    def test_consultas_concurrentes_se_ejecutan_una_vez(self):
+        liberar = threading.Event()
+
+        def lento(sql):
+            liberar.wait(5)
+            return [{"id_persona": 1}]
+
+        ejecutor = mock.Mock(side_effect=lento)
+        resultados = []
+        # La versión queda leída en este hilo: los demás no consultan la base
+        ResultCacheService.data_version()
+        with mock.patch.object(ResultCacheService, "VERSION_REFRESCO", 3600):
+            hilos = [
+                threading.Thread(target=lambda: resultados.append(
+                    ResultCacheService.get_or_execute("SELECT * FROM persona", ejecutor)
+                ))
+                for _ in range(5)
+            ]
+            for hilo in hilos:
+                hilo.start()
+            while ejecutor.call_count == 0:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            liberar.set()
+            for hilo in hilos:
+                hilo.join(5)
+        self.assertEqual(ejecutor.call_count, 1)
+        self.assertEqual(resultados, [[{"id_persona": 1}]] * 5)
+
+    def test_si_el_lider_falla_el_seguidor_ejecuta(self):
+        en_curso = threading.Event()
+        fallar = threading.Event()
+
+        def falla(sql):
+            en_curso.set()
+            fallar.wait(5)
+            raise RuntimeError("error de la consulta")
+
+        errores = []
+
+        def lider():
+            try:
+                ResultCacheService.get_or_execute("SELECT * FROM persona", falla)
+            except RuntimeError as e:
+                errores.append(e)
+
+        ResultCacheService.data_version()
+        with mock.patch.object(ResultCacheService, "VERSION_REFRESCO", 3600):
+            hilo = threading.Thread(target=lider)
+            hilo.start()
+            en_curso.wait(5)
+            threading.Timer(0.1, fallar.set).start()
+            filas = ResultCacheService.get_or_execute("SELECT * FROM persona", self.ejecutor)
+            hilo.join(5)
+        self.assertEqual(len(errores), 1)
+        self.assertEqual(filas, [{"id_persona": 1}])
+        self.assertEqual(self.ejecutor.call_count, 1)
+
+
+def backend_falso(**variables):
+    """FakeLLMBackend sin latencia, con las variables FAKE_LLM_* indicadas"""
+    entorno = {"FAKE_LLM_LATENCY": "fixed:0", "FAKE_LLM_STREAM_CHUNK_MS": "0", "FAKE_LLM_SEED": "1", **variables}
+    with mock.patch.dict(os.environ, entorno):
+        return FakeLLMBackend()
+
+
+class FakeLLMBackendTests(SimpleTestCase):
+    """FakeLLMBackend: respuestas por reglas, streaming y errores simulados, sin red"""
+
+    PROMPT_SQL = 'Genera una consulta SQL para la pregunta en lenguaje natural: "¿cuántos contratos hay?"'
+
+    def mensajes(self, prompt):
+        return {"model": "claude-3-5-haiku-latest", "max_tokens": 1000, "messages": [{"role": "user", "content": prompt}]}
+
+    def test_genera_sql_por_regla(self):
+        respuesta = backend_falso().create(**self.mensajes(self.PROMPT_SQL))
+        self.assertIn("COUNT(c.id_contrato)", respuesta.content[0].text)
+        self.assertGreater(respuesta.usage.input_tokens, 0)
+        SQLParser.extract(respuesta.content[0].text)
+
+    def test_acreate_y_stream_entregan_el_mismo_texto(self):
+        backend = backend_falso()
+        texto = backend.create(**self.mensajes(self.PROMPT_SQL)).content[0].text
+        asincrono = asyncio.run(backend.acreate(**self.mensajes(self.PROMPT_SQL)))
+        fragmentos = list(backend.stream_text(**self.mensajes(self.PROMPT_SQL)))
+        self.assertEqual(asincrono.content[0].text, texto)
+        self.assertGreater(len(fragmentos), 1)
+        self.assertEqual("".join(fragmentos), texto)
+        self.assertEqual(backend.stats()["requests"], 3)
+
+    def test_respuesta_final_incluye_ids_de_los_resultados(self):
+        prompt = "Dada la siguiente pregunta\n2 filas (CSV):\nid_persona,nombre\n7,Ana\n9,Luis\n\nfin"
+        texto = backend_falso().create(**self.mensajes(prompt)).content[0].text
+        self.assertEqual(json.loads(texto[texto.index("{"):]), {"id_persona": [7, 9]})
+
+    def test_respuestas_fijas_desde_archivo(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False, encoding="utf-8") as archivo:
+            json.dump({"cu[aá]ntos contratos": "SELECT 1"}, archivo)
+        self.addCleanup(os.remove, archivo.name)
+        backend = backend_falso(FAKE_LLM_RESPONSES_FILE=archivo.name)
+        self.assertEqual(backend.create(**self.mensajes(self.PROMPT_SQL)).content[0].text, "SELECT 1")
+
+    def test_simula_errores_de_la_api(self):
+        backend = backend_falso(FAKE_LLM_RATE_LIMIT_RATE="1")
+        with self.assertRaises(anthropic.RateLimitError):
+            backend.create(**self.mensajes(self.PROMPT_SQL))
+        backend = backend_falso(FAKE_LLM_ERROR_RATE="1")
+        with self.assertRaises(anthropic.InternalServerError):
+            asyncio.run(backend.acreate(**self.mensajes(self.PROMPT_SQL)))
+        self.assertEqual(backend.stats()["errors"], 1)
+
+    def test_latencia_no_soportada(self):
+        with self.assertRaises(ValueError):
+            backend_falso(FAKE_LLM_LATENCY="constante:10")
+
+    def test_get_elige_el_backend_por_variable_de_entorno(self):
+        LLMBackend.reset()
+        self.addCleanup(LLMBackend.reset)
+        with mock.patch.dict(os.environ, {"LLM_BACKEND": "fake", "FAKE_LLM_LATENCY": "fixed:0"}):
+            backend = LLMBackend.get()
+        self.assertIsInstance(backend, GovernedBackend)
+        self.assertIsInstance(backend.backend, FakeLLMBackend)
+        self.assertIs(LLMBackend.get(), backend)
+
+    def test_backend_incompleto_falla_al_instanciarse(self):
+        class SinStream(LLMBackend):
+            def create(self, **kwargs):
+                return None
+
+            async def acreate(self, **kwargs):
+                return None
+
+        with self.assertRaises(TypeError):
+            SinStream()
+
+
+def esperar_hasta(condicion, plazo=2):
+    """Espera activa corta para pruebas con hilos"""
+    limite = time.monotonic() + plazo
+    while not condicion():
+        if time.monotonic() > limite:
+            raise AssertionError("La condición no se cumplió a tiempo")
+        time.sleep(0.01)
+
+
+def crear_sesion(usuario, **campos):
+    return SesionChat.objects.create(
+        usuario=usuario, fecha_inicio=campos.pop("fecha_inicio", timezone.now()), estado="activa",
+        nombre_sesion="Sesión nueva", **campos
+    )
+
+
+class LLMGovernorTests(SimpleTestCase):
+    """LLMGovernor: cupos global y por usuario, cola con plazo y rechazo por saturación"""
+
+    def setUp(self):
+        gob = LLMGovernor
+        estado = {
+            "_colas": OrderedDict(),
+            "_activos_usuario": {},
+            "_estado": {"activos": 0, "en_cola": 0, "tokens": gob.RAFAGA, "relleno": time.monotonic(), "duracion_media": 0.0},
+            "_metricas": {"admitted": 0, "rejected": 0, "timed_out": 0, "max_queue_depth": 0},
+            "_esperas": deque(maxlen=gob.MUESTRAS),
+            "HABILITADO": True, "MAX_CONCURRENCIA": 1, "MAX_POR_USUARIO": 1, "TASA": 0.0,
+            "ESPERA_MAXIMA": 2.0, "MAX_COLA": 200,
+        }
+        for nombre, valor in estado.items():
+            parche = mock.patch.object(gob, nombre, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def en_hilo(self, usuario):
+        """Pide un cupo desde otro hilo; retorna (hilo, resultado) con "admitido" o el error"""
+        resultado = {}
+
+        def pedir():
+            try:
+                LLMGovernor.acquire(usuario)
+                resultado["admitido"] = True
+            except LLMOverloadedError as e:
+                resultado["error"] = e
+
+        hilo = threading.Thread(target=pedir)
+        hilo.start()
+        return hilo, resultado
+
+    def test_slot_asocia_el_cupo_al_usuario_y_lo_libera(self):
+        with LLMGovernor.user(5), LLMGovernor.slot():
+            self.assertEqual(LLMGovernor._activos_usuario, {5: 1})
+        self.assertEqual(LLMGovernor._activos_usuario, {})
+        self.assertEqual(LLMGovernor.stats()["admitted"], 1)
+
+    def test_encola_al_llegar_al_maximo_y_admite_al_liberar(self):
+        LLMGovernor.acquire("a")
+        hilo, resultado = self.en_hilo("b")
+        esperar_hasta(lambda: LLMGovernor.stats()["queue_depth"] == 1)
+        self.assertEqual(resultado, {})
+        LLMGovernor.release("a", 0.1)
+        hilo.join(2)
+        self.assertEqual(resultado, {"admitido": True})
+        self.assertEqual(LLMGovernor.stats()["active"], 1)
+
+    def test_cupo_por_usuario_no_bloquea_a_otros(self):
+        LLMGovernor.MAX_CONCURRENCIA = 2
+        LLMGovernor.acquire("a")
+        hilo, resultado = self.en_hilo("a")
+        esperar_hasta(lambda: LLMGovernor.stats()["queue_depth"] == 1)
+        LLMGovernor.acquire("b")
+        self.assertEqual(LLMGovernor._activos_usuario, {"a": 1, "b": 1})
+        LLMGovernor.release("a", 0.1)
+        hilo.join(2)
+        self.assertEqual(resultado, {"admitido": True})
+
+    def test_rechaza_al_vencer_el_plazo(self):
+        LLMGovernor.ESPERA_MAXIMA = 0.1
+        LLMGovernor.acquire("a")
+        with self.assertRaises(LLMOverloadedError) as error:
+            LLMGovernor.acquire("b")
+        self.assertGreaterEqual(error.exception.retry_after, 1)
+        stats = LLMGovernor.stats()
+        self.assertEqual((stats["timed_out"], stats["queue_depth"]), (1, 0))
+
+    def test_rechaza_de_inmediato_si_la_espera_estimada_supera_el_plazo(self):
+        LLMGovernor._estado["duracion_media"] = 30.0
+        LLMGovernor.acquire("a")
+        hilo, resultado = self.en_hilo("b")
+        esperar_hasta(lambda: LLMGovernor.stats()["queue_depth"] == 1)
+        inicio = time.monotonic()
+        with self.assertRaises(LLMOverloadedError) as error:
+            LLMGovernor.acquire("c")
+        self.assertLess(time.monotonic() - inicio, 0.5)
+        self.assertEqual(error.exception.retry_after, 60)
+        self.assertEqual(LLMGovernor.stats()["rejected"], 1)
+        LLMGovernor.release("a", 0.1)
+        hilo.join(2)
+        self.assertEqual(resultado, {"admitido": True})
+
+    def test_espera_asincrona_y_cancelacion(self):
+        LLMGovernor.acquire("a")
+
+        async def escenario():
+            cancelada = asyncio.create_task(LLMGovernor.aacquire("b"))
+            await asyncio.sleep(0.05)
+            self.assertEqual(LLMGovernor.stats()["queue_depth"], 1)
+            cancelada.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await cancelada
+            self.assertEqual(LLMGovernor.stats()["queue_depth"], 0)
+
+            admitida = asyncio.create_task(LLMGovernor.aacquire("b"))
+            await asyncio.sleep(0.05)
+            LLMGovernor.release("a", 0.1)
+            await asyncio.wait_for(admitida, 1)
+
+        asyncio.run(escenario())
+        self.assertEqual(LLMGovernor._activos_usuario, {"b": 1})
+
+
+class LLMOverloadedResponseTests(TestCase):
+    """Las llamadas rechazadas por el gobernador responden 503 con Retry-After"""
+
+    def test_envio_de_mensaje_saturado_responde_503(self):
+        usuario = User.objects.create_user("saturado", password="x")
+        sesion = crear_sesion(usuario)
+        cliente = APIClient()
+        cliente.force_authenticate(usuario)
+        with mock.patch("chatbot.api.guardar_mensaje"), \
+                mock.patch.object(ChatService, "process_message", side_effect=LLMOverloadedError(4)):
+            respuesta = cliente.post(
+                reverse("api_send_message", args=[sesion.id_sesion]), {"message": "¿cuántos contratos hay?"},
+                format="json",
+            )
+        self.assertEqual(respuesta.status_code, 503)
+        self.assertEqual(respuesta["Retry-After"], "4")
+        self.assertEqual(respuesta.json()["retry_after"], 4)
+
+
+class CoalescenciaAislada:
+    """Vuelos y contadores de CoalescingService propios de cada prueba, solo dentro del proceso"""
+
+    def setUp(self):
+        super().setUp()
+        estado = {
+            "_vuelos": {}, "_stats": {"leaders": 0, "followers": 0, "remote_followers": 0, "fallbacks": 0},
+            "HABILITADO": True, "ENTRE_WORKERS": False, "ESPERA_MAXIMA": 2.0,
+        }
+        for nombre, valor in estado.items():
+            parche = mock.patch.object(CoalescingService, nombre, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def en_hilo(self, funcion, *args):
+        resultado = {}
+
+        def ejecutar():
+            try:
+                resultado["valor"] = funcion(*args)
+            except Exception as e:
+                resultado["error"] = e
+
+        hilo = threading.Thread(target=ejecutar)
+        hilo.start()
+        return hilo, resultado
+
+
+class CoalescingServiceTests(CoalescenciaAislada, SimpleTestCase):
+    """CoalescingService: un líder por clave, seguidores que reutilizan su resultado y respaldo si falla"""
+
+    def test_seguidores_reciben_el_resultado_del_lider(self):
+        liberar = threading.Event()
+        calcular_lider = mock.Mock(side_effect=lambda: liberar.wait(2) and {"filas": [1]})
+        calcular_seguidor = mock.Mock(return_value={"filas": [2]})
+        lider = self.en_hilo(CoalescingService.execute, "k", calcular_lider)
+        esperar_hasta(lambda: CoalescingService.stats()["leaders"] == 1)
+        seguidores = [self.en_hilo(CoalescingService.execute, "k", calcular_seguidor) for _ in range(3)]
+        esperar_hasta(lambda: CoalescingService.stats()["followers"] == 3)
+        liberar.set()
+        for hilo, _ in [lider, *seguidores]:
+            hilo.join(2)
+        self.assertEqual([r for _, r in [lider, *seguidores]], [{"valor": {"filas": [1]}}] * 4)
+        self.assertEqual((calcular_lider.call_count, calcular_seguidor.call_count), (1, 0))
+        self.assertEqual(CoalescingService.stats()["in_flight"], 0)
+
+    def test_si_el_lider_falla_el_seguidor_calcula(self):
+        liberar = threading.Event()
+
+        def falla():
+            liberar.wait(2)
+            raise RuntimeError("error del líder")
+
+        lider = self.en_hilo(CoalescingService.execute, "k", falla)
+        esperar_hasta(lambda: CoalescingService.stats()["leaders"] == 1)
+        seguidor = self.en_hilo(CoalescingService.execute, "k", lambda: {"filas": [2]})
+        esperar_hasta(lambda: CoalescingService.stats()["followers"] == 1)
+        liberar.set()
+        for hilo, _ in (lider, seguidor):
+            hilo.join(2)
+        self.assertIsInstance(lider[1]["error"], RuntimeError)
+        self.assertEqual(seguidor[1], {"valor": {"filas": [2]}})
+        self.assertEqual(CoalescingService.stats()["fallbacks"], 1)
+
+    def test_sin_clave_no_se_coalesce(self):
+        calcular = mock.Mock(return_value={"filas": []})
+        CoalescingService.execute(None, calcular)
+        CoalescingService.execute(None, calcular)
+        self.assertEqual(calcular.call_count, 2)
+        self.assertEqual(CoalescingService.stats()["leaders"], 0)
+
+    def test_seguidores_asincronos(self):
+        llamadas = []
+
+        async def calcular():
+            llamadas.append(1)
+            await asyncio.sleep(0.1)
+            return {"filas": [1]}
+
+        async def escenario():
+            return await asyncio.gather(*[CoalescingService.aexecute("k", calcular) for _ in range(20)])
+
+        self.assertEqual(asyncio.run(escenario()), [{"filas": [1]}] * 20)
+        self.assertEqual(len(llamadas), 1)
+
+
+class CoalescingKeyTests(TestCase):
+    """CoalescingService.key: misma clave para exclusiones equivalentes, ninguna si depende del historial"""
+
+    def setUp(self):
+        ResultCacheService._version.update(valor=None, leida_en=0.0)
+
+    def test_terminos_equivalentes_comparten_clave(self):
+        pregunta = "¿Cuántos contratos hay?"
+        clave = CoalescingService.key(pregunta, ["Valparaíso", "Ñuñoa"])
+        self.assertIsNotNone(clave)
+        self.assertEqual(CoalescingService.key("cuantos contratos hay", ["nunoa ", "VALPARAISO", "valparaiso"]), clave)
+        self.assertNotEqual(CoalescingService.key(pregunta, ["Santiago"]), clave)
+
+    def test_nueva_version_de_datos_cambia_la_clave(self):
+        clave = CoalescingService.key("¿Cuántos contratos hay?")
+        ResultCacheService.bump_data_version()
+        self.assertNotEqual(CoalescingService.key("¿Cuántos contratos hay?"), clave)
+
+    def test_pregunta_que_depende_del_historial_no_se_coalesce(self):
+        self.assertIsNone(CoalescingService.key("¿Y los mismos del mes anterior?"))
+
+
+class ChatServiceCoalescingTests(CoalescenciaAislada, SimpleTestCase):
+    """Las solicitudes coalescidas comparten las filas, pero cada una redacta su respuesta con su historial"""
+
+    def setUp(self):
+        super().setUp()
+        self.liberar = threading.Event()
+        self.compute_rows = mock.Mock(side_effect=lambda *args: self.liberar.wait(2) and {"valido": True, "filas": [{"x": 1}]})
+        parches = [
+            mock.patch.object(ChatService, "_get_excluded_terms", return_value=[]),
+            mock.patch.object(CoalescingService, "key", return_value="k"),
+            mock.patch.object(ChatService, "_compute_rows", self.compute_rows),
+            mock.patch.object(
+                HistoryService, "get_histories",
+                side_effect=lambda sesion: ([], [{"role": "user", "content": f"historial de {sesion}"}]),
+            ),
+            mock.patch.object(
+                AIService, "generate_final_response",
+                side_effect=lambda pregunta, filas, historial: (historial[-1]["content"], None, []),
+            ),
+            mock.patch.object(ChatService, "_save_result", side_effect=lambda sesion, resultado: resultado),
+        ]
+        for parche in parches:
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def test_seguidor_redacta_su_propia_respuesta(self):
+        usuario = mock.Mock(id=1)
+        lider = self.en_hilo(ChatService.process_message, "sesion 1", "¿Cuántos contratos hay?", usuario)
+        esperar_hasta(lambda: CoalescingService.stats()["leaders"] == 1)
+        seguidor = self.en_hilo(ChatService.process_message, "sesion 2", "¿Cuántos contratos hay?", usuario)
+        esperar_hasta(lambda: CoalescingService.stats()["followers"] == 1)
+        self.liberar.set()
+        for hilo, _ in (lider, seguidor):
+            hilo.join(2)
+        self.assertEqual(self.compute_rows.call_count, 1)
+        self.assertEqual(lider[1]["valor"]["respuesta"], "historial de sesion 1")
+        self.assertEqual(seguidor[1]["valor"]["respuesta"], "historial de sesion 2")
+        self.assertEqual(seguidor[1]["valor"]["filas"], [{"x": 1}])
+
+
+class SinAliasAnalitico:
+    """
+    Las lecturas de RRHH van a `default`: el alias analítico es otra conexión y no vería
+    las filas creadas dentro de la transacción de la prueba
+    """
+
+    def setUp(self):
+        super().setUp()
+        parche = mock.patch("chatbot.db_router.ALIAS_ANALITICO", "analytics_no_configurado")
+        parche.start()
+        self.addCleanup(parche.stop)
+
+
+class ExclusionServiceTests(SimpleTestCase):
+    """ExclusionService: firma de términos, anti-joins sobre el SQL y caché de conjuntos de ids"""
+
+    CONJUNTOS = {
+        "persona": frozenset({3}), "funcion": frozenset(), "tiempo_contrato": frozenset(), "contrato": frozenset({8, 9}),
+    }
+
+    def setUp(self):
+        cache.clear()
+        for parche in [
+            mock.patch.object(ExclusionService, "HABILITADO", True),
+            mock.patch.object(ExclusionService, "_memoria", OrderedDict()),
+            mock.patch.object(ResultCacheService, "data_version", return_value=1),
+        ]:
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def test_firma_normaliza_y_ordena(self):
+        self.assertEqual(ExclusionService.signature([" Valparaíso ", "ÑUÑOA", "valparaiso", ""]), ("nunoa", "valparaiso"))
+
+    def test_aplica_anti_joins_solo_a_tablas_con_ids(self):
+        with mock.patch.object(ExclusionService, "excluded_ids", return_value=self.CONJUNTOS):
+            sql = ExclusionService.apply(SELECT_CONTRATOS, ["Pérez"])
+        self.assertIn("t1.id_contrato NOT IN (SELECT unnest('{8,9}'::int[]))", sql)
+        self.assertIn("t2.id_persona NOT IN (SELECT unnest('{3}'::int[]))", sql)
+        self.assertNotIn("id_funcion", sql)
+
+    def test_sin_terminos_o_deshabilitado_no_cambia_la_consulta(self):
+        self.assertEqual(ExclusionService.apply(SELECT_CONTRATOS, []), SELECT_CONTRATOS)
+        with mock.patch.object(ExclusionService, "HABILITADO", False):
+            self.assertEqual(ExclusionService.apply(SELECT_CONTRATOS, ["Pérez"]), SELECT_CONTRATOS)
+            self.assertEqual(ExclusionService.prompt_terms(["Pérez"]), ["Pérez"])
+        self.assertEqual(ExclusionService.prompt_terms(["Pérez"]), [])
+
+    def test_terminos_equivalentes_se_calculan_una_vez(self):
+        with mock.patch.object(ExclusionService, "_compute", return_value=self.CONJUNTOS) as calcular:
+            ExclusionService.excluded_ids(["Pérez", "Soto"])
+            self.assertEqual(ExclusionService.excluded_ids(["soto", "PEREZ"]), self.CONJUNTOS)
+            # Desde la caché compartida (otro worker) se decodifican los arreglos comprimidos
+            ExclusionService._memoria.clear()
+            self.assertEqual(ExclusionService.excluded_ids(["perez", "soto"]), self.CONJUNTOS)
+        calcular.assert_called_once_with(("perez", "soto"))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "translate() y las expresiones regulares son de PostgreSQL")
+class ExclusionComputeTests(SinAliasAnalitico, TestCase):
+    """ExclusionService._compute: coincidencia por palabra completa, sin tildes ni mayúsculas, en la base"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.jose = Persona.objects.create(nombre_completo="JOSÉ PÉREZ")
+        cls.joselyn = Persona.objects.create(nombre_completo="Joselyn Soto")
+        funcion = Funcion.objects.create(grado_eus=1, descripcion_funcion="Docente", calificacion_profesional="Profesor")
+        cls.valparaiso = TiempoContrato.objects.create(
+            anho=2024, mes="Enero", fecha_inicio="2024-01-01", fecha_termino="2024-01-31", region="Región de Valparaíso"
+        )
+        cls.santiago = TiempoContrato.objects.create(
+            anho=2024, mes="Enero", fecha_inicio="2024-01-01", fecha_termino="2024-01-31", region="Metropolitana"
+        )
+        campos = {"funcion": funcion, "honorario_total_bruto": 1000, "tipo_pago": "", "viaticos": "",
+                  "observaciones": "", "enlace_funciones": ""}
+        cls.contrato_jose = Contrato.objects.create(persona=cls.jose, tiempo=cls.santiago, **campos)
+        cls.contrato_valparaiso = Contrato.objects.create(persona=cls.joselyn, tiempo=cls.valparaiso, **campos)
+        cls.contrato_libre = Contrato.objects.create(persona=cls.joselyn, tiempo=cls.santiago, **campos)
+
+    def test_coincide_palabra_completa_sin_tildes(self):
+        conjuntos = ExclusionService._compute(("jose",))
+        self.assertEqual(conjuntos["persona"], {self.jose.id_persona})
+        self.assertEqual(conjuntos["contrato"], {self.contrato_jose.id_contrato})
+
+    def test_frase_y_contratos_de_las_dimensiones_excluidas(self):
+        conjuntos = ExclusionService._compute(("region de valparaiso",))
+        self.assertEqual(conjuntos["tiempo_contrato"], {self.valparaiso.id_tiempo})
+        self.assertEqual(conjuntos["contrato"], {self.contrato_valparaiso.id_contrato})
+        self.assertEqual(conjuntos["persona"], frozenset())
+
+
+class CursorConPlan:
+    """Cursor simulado: responde EXPLAIN con los planes dados, en orden, y registra las sentencias"""
+
+    def __init__(self, *costos, filas_intermedias=10):
+        self.planes = [
+            json.dumps([{"Plan": {"Total Cost": costo, "Plan Rows": 10, "Plans": [{"Plan Rows": filas_intermedias}]}}])
+            for costo in costos
+        ]
+        self.sentencias = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, params=None):
+        self.sentencias.append(sql if params is None else (sql, params))
+        self.ultima = sql
+
+    def fetchone(self):
+        if self.ultima.startswith("EXPLAIN"):
+            return [self.planes.pop(0)]
+        return ["30s"]
+
+
+class QueryGuardTests(SimpleTestCase):
+    """QueryGuard: decisión por plan estimado, transacción de solo lectura y statement_timeout"""
+
+    def setUp(self):
+        for nombre, valor in {"MAX_COSTO": 1000.0, "MAX_FILAS_PLAN": 10000.0, "LIMITE_REESCRITURA": 20, "TIMEOUT_MS": 1234}.items():
+            parche = mock.patch.object(QueryGuard, nombre, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def test_acepta_plan_dentro_de_los_umbrales(self):
+        evaluacion = {}
+        self.assertEqual(QueryGuard._evaluate(CursorConPlan(500), SELECT_CONTRATOS, evaluacion), SELECT_CONTRATOS)
+        self.assertEqual((evaluacion["costo_estimado"], evaluacion["filas_intermedias"]), (500.0, 10.0))
+
+    def test_reescribe_con_limit_menor_si_solo_el_costo_excede(self):
+        evaluacion = {"decision": "aceptada"}
+        cursor = CursorConPlan(5000, 800)
+        sql = QueryGuard._evaluate(cursor, SQLParser.parse(SELECT_CONTRATOS).sql, evaluacion)
+        self.assertTrue(sql.endswith("LIMIT 20"))
+        self.assertEqual(evaluacion["decision"], "reescrita")
+        self.assertEqual(cursor.sentencias[-1], "EXPLAIN (FORMAT JSON) " + sql)
+
+    def test_rechaza_si_el_costo_sigue_excediendo(self):
+        with self.assertRaises(QueryRejectedError):
+            QueryGuard._evaluate(CursorConPlan(5000, 4000), SQLParser.parse(SELECT_CONTRATOS).sql, {})
+
+    def test_rechaza_por_filas_intermedias_sin_reescribir(self):
+        cursor = CursorConPlan(10, filas_intermedias=50000)
+        with self.assertRaises(QueryRejectedError) as error:
+            QueryGuard._evaluate(cursor, SELECT_CONTRATOS, {})
+        self.assertIn("filas intermedias", error.exception.motivo)
+        self.assertEqual(len(cursor.sentencias), 1)
+
+    def guardada(self, cursor, evaluacion, anidada=False, fetch=None):
+        conexion = mock.Mock(alias="analytics", in_atomic_block=anidada)
+        conexion.cursor.return_value = cursor
+        with mock.patch("chatbot.services.query_guard.transaction.atomic"), \
+                mock.patch.object(QueryGuard, "_fetch", side_effect=fetch, return_value=[{"x": 1}]):
+            return QueryGuard._guarded(conexion, SELECT_CONTRATOS, evaluacion)
+
+    def test_transaccion_de_solo_lectura_con_timeout_propio(self):
+        cursor = CursorConPlan(10)
+        evaluacion = {}
+        self.assertEqual(self.guardada(cursor, evaluacion), [{"x": 1}])
+        self.assertEqual(cursor.sentencias[0], "SET TRANSACTION READ ONLY")
+        self.assertIn(("SELECT set_config('statement_timeout', %s, true)", ["1234"]), cursor.sentencias)
+        self.assertIn("duracion_ms", evaluacion)
+
+    def test_dentro_de_otra_transaccion_restaura_el_timeout(self):
+        cursor = CursorConPlan(10)
+        self.guardada(cursor, {}, anidada=True)
+        self.assertNotIn("SET TRANSACTION READ ONLY", cursor.sentencias)
+        self.assertEqual(cursor.sentencias[-1], ("SELECT set_config('statement_timeout', %s, true)", ["30s"]))
+
+    def test_statement_timeout_se_informa_como_cancelada(self):
+        causa = Exception("canceling statement due to statement timeout")
+        causa.pgcode = "57014"
+        cancelada = OperationalError(str(causa))
+        cancelada.__cause__ = causa
+        evaluacion = {}
+        with self.assertRaises(QueryRejectedError):
+            self.guardada(CursorConPlan(10), evaluacion, fetch=cancelada)
+        self.assertEqual(evaluacion["decision_rechazo"], "cancelada")
+
+        with self.assertRaises(OperationalError):
+            self.guardada(CursorConPlan(10), {}, fetch=OperationalError("conexión perdida"))
+
+
+class QueryGuardExecuteTests(SinAliasAnalitico, TestCase):
+    """QueryGuard.execute sin evaluación de plan: resultado columnar con tope de filas"""
+
+    def test_retorna_resultado_columnar_truncado_al_tope(self):
+        with mock.patch.object(QueryGuard, "HABILITADO", False), mock.patch.object(QueryGuard, "TOPE_FILAS", 2):
+            resultado = QueryGuard.execute("SELECT 1 AS x UNION ALL SELECT 2 UNION ALL SELECT 3")
+        self.assertEqual(len(resultado), 2)
+        self.assertTrue(resultado.truncado)
+        self.assertEqual(resultado.columnas, ("x",))
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "EXPLAIN (FORMAT JSON) y SET TRANSACTION son de PostgreSQL")
+class QueryGuardPostgresTests(TestCase):
+    """QueryGuard.execute en el alias analítico real: solo lectura, timeout propio y decisión registrada"""
+
+    databases = {"default", "analytics"}
+
+    def test_ejecuta_en_transaccion_de_solo_lectura(self):
+        with mock.patch.object(QueryGuard, "TIMEOUT_MS", 1234):
+            resultado = QueryGuard.execute(
+                "SELECT current_setting('transaction_read_only') AS solo_lectura, "
+                "current_setting('statement_timeout') AS timeout"
+            )
+        self.assertEqual(resultado.rows(), [{"solo_lectura": "on", "timeout": "1234ms"}])
+        self.assertEqual(EvaluacionConsulta.objects.latest("id").decision, "aceptada")
+
+
+class CursorEnLotes:
+    """Cursor DB-API mínimo: entrega las filas con fetchmany y registra el tamaño de cada lote"""
+
+    def __init__(self, columnas, filas):
+        self.description = [(c,) for c in columnas]
+        self.filas = list(filas)
+        self.lotes = []
+
+    def fetchmany(self, tamano):
+        self.lotes.append(tamano)
+        lote, self.filas = self.filas[:tamano], self.filas[tamano:]
+        return lote
+
+
+class ResultadoColumnarTests(SimpleTestCase):
+    """ResultadoColumnar: lectura por lotes, columnas tipadas y formato binario comprimido"""
+
+    FILAS = [
+        {"id_contrato": i, "honorario": Decimal(f"{1000 + i}.50"), "nombre": f"Persona {i}", "inicio": None}
+        for i in range(200)
+    ]
+
+    def test_from_cursor_lee_en_lotes_y_trunca_al_tope(self):
+        cursor = CursorEnLotes(["a", "b"], [(i, str(i)) for i in range(10)])
+        resultado = ResultadoColumnar.from_cursor(cursor, tope=7, lote=3)
+        self.assertEqual(cursor.lotes, [3, 3, 2])
+        self.assertEqual(len(resultado), 7)
+        self.assertTrue(resultado.truncado)
+        self.assertEqual(resultado[6], {"a": 6, "b": "6"})
+
+    def test_from_cursor_sin_truncar(self):
+        cursor = CursorEnLotes(["a"], [(i,) for i in range(5)])
+        resultado = ResultadoColumnar.from_cursor(cursor, tope=5, lote=10)
+        self.assertFalse(resultado.truncado)
+        self.assertEqual(resultado.rows(), [{"a": i} for i in range(5)])
+
+        vacio = ResultadoColumnar.from_cursor(CursorEnLotes(["a"], []), tope=5)
+        self.assertEqual(vacio.columnas, ("a",))
+        self.assertFalse(vacio)
+
+    def test_columnas_tipadas_y_decimal(self):
+        resultado = ResultadoColumnar.from_rows([
+            {"entero": Decimal("3"), "real": Decimal("1.5"), "con_nulo": 1, "texto": "x"},
+            {"entero": Decimal("4"), "real": Decimal("2"), "con_nulo": None, "texto": "y"},
+        ])
+        self.assertEqual(resultado.column("entero"), array("q", [3, 4]))
+        self.assertEqual(resultado.column("real"), array("d", [1.5, 2.0]))
+        self.assertEqual(resultado.column("con_nulo"), [1, None])
+        self.assertEqual(resultado.column("texto"), ["x", "y"])
+
+    def test_se_comporta_como_lista_de_dicts(self):
+        resultado = ResultadoColumnar.from_rows([{"a": 1}, {"a": 2}, {"a": 3}])
+        self.assertEqual(resultado, [{"a": 1}, {"a": 2}, {"a": 3}])
+        self.assertEqual(resultado[1:], [{"a": 2}, {"a": 3}])
+        self.assertIs(ResultadoColumnar.of(resultado), resultado)
+
+    def test_to_json_igual_a_json_dumps(self):
+        resultado = ResultadoColumnar.from_rows(self.FILAS)
+        self.assertEqual(resultado.to_json(), json.dumps(resultado.rows()))
+        self.assertEqual(ResultadoColumnar.from_rows([]).to_json(), "[]")
+
+    def test_ida_y_vuelta_zlib_mas_pequeno_que_json(self):
+        resultado = ResultadoColumnar.from_rows(self.FILAS)
+        contenido = resultado.to_bytes("zlib")
+        self.assertEqual(contenido[3:4], b"z")
+        self.assertLess(len(contenido), len(resultado.to_json()) / 4)
+
+        leido = ResultadoColumnar.from_bytes(memoryview(contenido))
+        self.assertEqual(leido, resultado)
+        self.assertEqual(leido.column("honorario").typecode, "d")
+
+    @unittest.skipIf(columnar_result.zstandard is None, "zstandard no está instalado")
+    def test_ida_y_vuelta_zstd(self):
+        resultado = ResultadoColumnar.from_rows(self.FILAS)
+        contenido = resultado.to_bytes("zstd")
+        self.assertEqual(contenido[3:4], b"s")
+        self.assertEqual(ResultadoColumnar.from_bytes(contenido), resultado)
+
+    def test_zstd_sin_paquete_usa_zlib(self):
+        resultado = ResultadoColumnar.from_rows(self.FILAS)
+        with mock.patch.object(columnar_result, "zstandard", None):
+            contenido = resultado.to_bytes("zstd")
+        self.assertEqual(contenido[3:4], b"z")
+        self.assertEqual(ResultadoColumnar.from_bytes(contenido), resultado)
+
+    def test_payload_canonico_conserva_truncado(self):
+        a = ResultadoColumnar.from_rows(self.FILAS)
+        self.assertEqual(a.payload(), ResultadoColumnar.from_rows(list(self.FILAS)).payload())
+        truncado = ResultadoColumnar(a.columnas, a.datos, truncado=True)
+        self.assertTrue(ResultadoColumnar.from_bytes(truncado.to_bytes()).truncado)
+
+    def test_formato_desconocido(self):
+        contenido = ResultadoColumnar.from_rows(self.FILAS).to_bytes()
+        malos = [
+            b"XX" + contenido[2:],
+            contenido[:2] + bytes([99]) + contenido[3:],
+            contenido[:3] + b"q" + contenido[4:],
+        ]
+        for malo in malos:
+            with self.subTest(malo=malo[:4]), self.assertRaises(ValueError):
+                ResultadoColumnar.from_bytes(malo)
+
+
+class SourceDataPageTests(TestCase):
+    """SourceDataService.page y su endpoint: cursor opaco, proyección de columnas y validación"""
+
+    FILAS = [{"id_contrato": i, "nombre": f"Persona {i}"} for i in range(5)]
+
+    def setUp(self):
+        cache_lru = mock.patch.object(SourceDataService, "_cache", OrderedDict())
+        cache_lru.start()
+        self.addCleanup(cache_lru.stop)
+        self.usuario = User.objects.create_user("lector", password="x")
+        self.sesion = crear_sesion(self.usuario)
+        self.mensaje = SessionCounters.add_message(self.sesion, "ia", "Resultados")
+        SourceDataService.store(self.mensaje, self.FILAS)
+
+    def test_recorre_todas_las_paginas_con_el_cursor(self):
+        filas, cursor = [], None
+        while True:
+            pagina = SourceDataService.page(self.mensaje.id_mensaje, cursor=cursor, limite=2)
+            self.assertEqual(pagina["total"], 5)
+            filas.extend(pagina["rows"])
+            cursor = pagina["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(filas, [(f["id_contrato"], f["nombre"]) for f in self.FILAS])
+        self.assertEqual(pagina["rows"], [(4, "Persona 4")])
+
+    def test_proyeccion_de_columnas(self):
+        pagina = SourceDataService.page(self.mensaje.id_mensaje, limite=2, columnas=["nombre"])
+        self.assertEqual(pagina["columns"], ["nombre"])
+        self.assertEqual(pagina["rows"], [("Persona 0",), ("Persona 1",)])
+
+    def test_limite_acotado_al_maximo(self):
+        with mock.patch.object(SourceDataService, "LIMITE_MAXIMO", 3):
+            pagina = SourceDataService.page(self.mensaje.id_mensaje, limite=100)
+        self.assertEqual(len(pagina["rows"]), 3)
+        self.assertEqual(SourceDataService.decode_cursor(pagina["next_cursor"]), 3)
+
+    def test_parametros_invalidos(self):
+        for parametros in [
+            {"limite": "abc"}, {"limite": 0}, {"cursor": "no es un cursor"},
+            {"cursor": SourceDataService.encode_cursor(-1)}, {"columnas": ["sueldo"]},
+        ]:
+            with self.subTest(**parametros), self.assertRaises(ValueError):
+                SourceDataService.page(self.mensaje.id_mensaje, **parametros)
+
+    def test_mensaje_sin_datos_y_formato_anterior(self):
+        sin_datos = SessionCounters.add_message(self.sesion, "ia", "Sin resultados")
+        self.assertIsNone(SourceDataService.page(sin_datos.id_mensaje))
+
+        antiguo = SessionCounters.add_message(self.sesion, "ia", "Formato anterior")
+        DatosFuenteMensaje.objects.create(mensaje=antiguo, datos=json.dumps(self.FILAS[:2]))
+        self.assertEqual(SourceDataService.page(antiguo.id_mensaje)["rows"], [(0, "Persona 0"), (1, "Persona 1")])
+
+    def test_endpoint(self):
+        cliente = APIClient()
+        cliente.force_authenticate(self.usuario)
+        url = reverse("api_message_source_data", args=[self.mensaje.id_mensaje])
+
+        respuesta = cliente.get(url, {"limit": 2, "columns": "id_contrato"})
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()["rows"], [[0], [1]])
+        siguiente = cliente.get(url, {"limit": 2, "columns": "id_contrato", "cursor": respuesta.json()["next_cursor"]})
+        self.assertEqual(siguiente.json()["rows"], [[2], [3]])
+
+        self.assertEqual(cliente.get(url, {"columns": "sueldo"}).status_code, 400)
+        otro = APIClient()
+        otro.force_authenticate(User.objects.create_user("ajeno", password="x"))
+        self.assertEqual(otro.get(url).status_code, 404)
+
+
+class SourceDataReferenceTests(TestCase):
+    """Resultados almacenados una vez por contenido: conteo de referencias al guardar y al eliminar"""
+
+    FILAS = [{"id_persona": i, "nombre_completo": f"Persona {i}"} for i in range(20)]
+
+    def setUp(self):
+        self.usuario = User.objects.create_user("referencias", password="x")
+        self.sesion = crear_sesion(self.usuario)
+
+    def guardar(self, sesion, filas):
+        mensaje = SessionCounters.add_message(sesion, "ia", "Resultados")
+        return SourceDataService.store(mensaje, filas)
+
+    def test_intern_comparte_el_resultado_identico(self):
+        huella, nuevos = SourceDataService.intern(self.FILAS)
+        self.assertGreater(nuevos, 0)
+        self.assertEqual(SourceDataService.intern(ResultadoColumnar.from_rows(self.FILAS)), (huella, 0))
+        almacenado = ResultadoAlmacenado.objects.get(huella=huella)
+        self.assertEqual(almacenado.referencias, 2)
+        self.assertEqual(almacenado.tamano, nuevos)
+
+        otra, _ = SourceDataService.intern(self.FILAS[:10])
+        self.assertNotEqual(otra, huella)
+        self.assertEqual(ResultadoAlmacenado.objects.count(), 2)
+
+    def test_store_apunta_al_mismo_resultado(self):
+        a = self.guardar(self.sesion, self.FILAS)
+        b = self.guardar(self.sesion, list(self.FILAS))
+        self.assertEqual(a.resultado_id, b.resultado_id)
+        self.assertEqual(ResultadoAlmacenado.objects.get().referencias, 2)
+
+    def test_release_resta_las_referencias_de_los_mensajes(self):
+        self.guardar(self.sesion, self.FILAS)
+        self.guardar(self.sesion, self.FILAS)
+        otra_sesion = crear_sesion(self.usuario)
+        self.guardar(otra_sesion, self.FILAS)
+
+        SourceDataService.release(MensajeChat.objects.filter(sesion=self.sesion))
+        self.assertEqual(ResultadoAlmacenado.objects.get().referencias, 1)
+
+    def test_eliminar_sesion_libera_sus_referencias(self):
+        self.guardar(self.sesion, self.FILAS)
+        otra_sesion = crear_sesion(self.usuario)
+        self.guardar(otra_sesion, self.FILAS)
+
+        self.assertTrue(ChatService.delete_session(self.sesion.id_sesion, self.usuario))
+        self.assertFalse(SesionChat.objects.filter(id_sesion=self.sesion.id_sesion).exists())
+        self.assertEqual(DatosFuenteMensaje.objects.count(), 1)
+        self.assertEqual(ResultadoAlmacenado.objects.get().referencias, 1)
+
+        self.assertTrue(ChatService.delete_session(otra_sesion.id_sesion, self.usuario))
+        self.assertEqual(ResultadoAlmacenado.objects.get().referencias, 0)
+
+    def test_gc_elimina_solo_los_resultados_sin_referencias(self):
+        self.guardar(self.sesion, self.FILAS)
+        huerfano, _ = SourceDataService.intern(self.FILAS[:5])
+        ResultadoAlmacenado.objects.filter(huella=huerfano).update(referencias=0)
+
+        call_command("gc_source_results", stdout=io.StringIO())
+        self.assertEqual(list(ResultadoAlmacenado.objects.values_list("referencias", flat=True)), [1])
+
+    def test_gc_recount_corrige_conteos_desfasados(self):
+        datos = self.guardar(self.sesion, self.FILAS)
+        ResultadoAlmacenado.objects.update(referencias=0)
+
+        call_command("gc_source_results", "--recount", stdout=io.StringIO())
+        self.assertEqual(ResultadoAlmacenado.objects.get(huella=datos.resultado_id).referencias, 1)
+
+
+class SessionCountersTests(TestCase):
+    """SessionCounters: contadores de sesion_chat al insertar, totales y recálculo"""
+
+    def setUp(self):
+        self.usuario = User.objects.create_user("contador", password="x")
+        self.sesion = crear_sesion(self.usuario)
+
+    def contadores(self, sesion=None):
+        return SesionChat.objects.values(
+            "total_mensajes_usuario", "total_mensajes_ia", "total_bloqueadas", "ultima_actividad"
+        ).get(id_sesion=(sesion or self.sesion).id_sesion)
+
+    def test_add_message_incrementa_el_contador_del_emisor(self):
+        SessionCounters.add_message(self.sesion, "usuario", "¿Cuántos contratos hay?")
+        mensaje = SessionCounters.add_message(self.sesion, "ia", "Hay 3", {"tipo": "contrato", "ids": [1]})
+        SessionCounters.add_message(self.sesion, "ia", "Otra respuesta")
+
+        contadores = self.contadores()
+        self.assertEqual((contadores["total_mensajes_usuario"], contadores["total_mensajes_ia"]), (1, 2))
+        self.assertGreaterEqual(contadores["ultima_actividad"], mensaje.fecha)
+        self.assertEqual(MensajeChat.objects.get(id_mensaje=mensaje.id_mensaje).metadata["ids"], [1])
+
+    def test_pregunta_invalida_cuenta_mensaje_y_bloqueada(self):
+        ChatService._handle_invalid_question(self.sesion, "¿Quién ganó el partido?", "fuera de dominio")
+        contadores = self.contadores()
+        self.assertEqual((contadores["total_mensajes_ia"], contadores["total_bloqueadas"]), (1, 1))
+        self.assertTrue(SessionCounters.has_blocked(self.sesion.id_sesion))
+        self.assertFalse(ChatService.delete_session(self.sesion.id_sesion, self.usuario))
+
+    def test_has_blocked_consulta_la_tabla_y_no_el_contador(self):
+        SesionChat.objects.filter(id_sesion=self.sesion.id_sesion).update(total_bloqueadas=5)
+        self.assertFalse(SessionCounters.has_blocked(self.sesion.id_sesion))
+        self.assertTrue(ChatService.delete_session(self.sesion.id_sesion, self.usuario))
+
+    def test_totals(self):
+        SessionCounters.add_message(self.sesion, "usuario", "Hola")
+        SessionCounters.add_message(self.sesion, "ia", "Hola")
+        SessionCounters.add_blocked(self.sesion, "Fuera de tema", "fuera de dominio")
+        finalizada = crear_sesion(self.usuario)
+        SesionChat.objects.filter(id_sesion=finalizada.id_sesion).update(estado="finalizada")
+        SessionCounters.add_message(finalizada, "usuario", "Chao")
+
+        self.assertEqual(SessionCounters.totals(), {
+            "total_sesiones": 2, "sesiones_activas": 1, "total_mensajes": 3, "preguntas_bloqueadas": 1,
+        })
+
+    def test_backfill_recalcula_contadores_desfasados(self):
+        SessionCounters.add_message(self.sesion, "usuario", "Hola")
+        SessionCounters.add_message(self.sesion, "ia", "Hola")
+        SessionCounters.add_blocked(self.sesion, "Fuera de tema", "fuera de dominio")
+        ultima = MensajeChat.objects.filter(sesion=self.sesion).latest("fecha").fecha
+        vacia = crear_sesion(self.usuario)
+        SesionChat.objects.update(
+            total_mensajes_usuario=9, total_mensajes_ia=9, total_bloqueadas=9, ultima_actividad=None
+        )
+
+        call_command("backfill_session_counters", "--batch-size", "1", stdout=io.StringIO())
+        self.assertEqual(self.contadores(), {
+            "total_mensajes_usuario": 1, "total_mensajes_ia": 1, "total_bloqueadas": 1, "ultima_actividad": ultima,
+        })
+        self.assertEqual(self.contadores(vacia), {
+            "total_mensajes_usuario": 0, "total_mensajes_ia": 0, "total_bloqueadas": 0,
+            "ultima_actividad": vacia.fecha_inicio,
+        })
+
+    def test_backfill_respeta_el_rango(self):
+        fuera = crear_sesion(self.usuario)
+        SesionChat.objects.update(total_mensajes_ia=7)
+        self.assertEqual(SessionCounters.backfill(self.sesion.id_sesion, self.sesion.id_sesion), 1)
+        self.assertEqual(self.contadores()["total_mensajes_ia"], 0)
+        self.assertEqual(self.contadores(fuera)["total_mensajes_ia"], 7)
+
+
+class SessionListServiceTests(TestCase):
+    """SessionListService: páginas keyset por (fecha_inicio, id_sesion) y selección de campos"""
+
+    def setUp(self):
+        self.usuario = User.objects.create_user("sesiones", password="x")
+        ahora = timezone.now()
+        # Dos sesiones por instante: el desempate por id_sesion debe mantener el orden entre páginas
+        self.sesiones = [
+            crear_sesion(self.usuario, fecha_inicio=ahora - timedelta(minutes=i // 2)) for i in range(5)
+        ]
+        crear_sesion(User.objects.create_user("otro", password="x"))
+        self.esperadas = [
+            s.id_sesion for s in sorted(self.sesiones, key=lambda s: (s.fecha_inicio, s.id_sesion), reverse=True)
+        ]
+
+    def test_paginas_sin_repetir_ni_saltar(self):
+        ids, cursor, paginas = [], None, 0
+        while True:
+            pagina = SessionListService.page(self.usuario, cursor, 2)
+            paginas += 1
+            ids.extend(s["id"] for s in pagina["sessions"])
+            self.assertEqual(pagina["has_more"], pagina["next_cursor"] is not None)
+            cursor = pagina["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(ids, self.esperadas)
+        self.assertEqual(paginas, 3)
+        self.assertEqual(SessionListService.all(self.usuario, ("id",)), [{"id": i} for i in self.esperadas])
+
+    def test_ultima_pagina_exacta_no_tiene_mas(self):
+        pagina = SessionListService.page(self.usuario, limite=5)
+        self.assertEqual(len(pagina["sessions"]), 5)
+        self.assertFalse(pagina["has_more"])
+        self.assertIsNone(pagina["next_cursor"])
+
+    def test_campos(self):
+        self.assertEqual(SessionListService.parse_fields(""), SessionListService.CAMPOS_DEFECTO)
+        campos = SessionListService.parse_fields("id, total_mensajes, tiene_pregunta_bloqueada")
+        reciente = SesionChat.objects.get(id_sesion=self.esperadas[0])
+        SessionCounters.add_message(reciente, "usuario", "Hola")
+        SessionCounters.add_blocked(reciente, "Fuera de tema", "fuera de dominio")
+
+        sesion = SessionListService.page(self.usuario, limite=1, campos=campos)["sessions"][0]
+        self.assertEqual(sesion, {"id": reciente.id_sesion, "total_mensajes": 1, "tiene_pregunta_bloqueada": True})
+        with self.assertRaises(ValueError):
+            SessionListService.parse_fields("id,sueldo")
+
+    def test_parametros_invalidos(self):
+        for cursor, limite in [("no es un cursor", 2), (None, "abc"), (None, 0)]:
+            with self.subTest(cursor=cursor, limite=limite), self.assertRaises(ValueError):
+                SessionListService.page(self.usuario, cursor, limite)
+
+    def test_endpoint(self):
+        cliente = APIClient()
+        cliente.force_authenticate(self.usuario)
+        url = reverse("api_sessions_list")
+
+        self.assertEqual([s["id"] for s in cliente.get(url).json()], self.esperadas)
+        pagina = cliente.get(url, {"limit": 3, "fields": "id"}).json()
+        self.assertEqual(pagina["sessions"], [{"id": i} for i in self.esperadas[:3]])
+        siguiente = cliente.get(url, {"limit": 3, "fields": "id", "cursor": pagina["next_cursor"]}).json()
+        self.assertEqual([s["id"] for s in siguiente["sessions"]], self.esperadas[3:])
+        self.assertFalse(siguiente["has_more"])
+        self.assertEqual(cliente.get(url, {"fields": "sueldo"}).status_code, 400)
+
+
+class MessagePageServiceTests(TestCase):
+    """MessagePageService: últimos N mensajes, anclas before/after y marca de datos fuente"""
+
+    def setUp(self):
+        self.usuario = User.objects.create_user("mensajes", password="x")
+        self.sesion = crear_sesion(self.usuario)
+        inicio = timezone.now()
+        # Pares con la misma fecha: el orden dentro del par lo decide id_mensaje
+        self.ids = [
+            MensajeChat.objects.create(
+                sesion=self.sesion, tipo_emisor="usuario" if i % 2 == 0 else "ia",
+                contenido=f"Mensaje {i}", fecha=inicio + timedelta(seconds=i // 2),
+            ).id_mensaje
+            for i in range(7)
+        ]
+
+    def ids_de(self, pagina):
+        return [m.id_mensaje for m in pagina["messages"]]
+
+    def test_ultimos_mensajes_en_orden_cronologico(self):
+        pagina = MessagePageService.page(self.sesion, limite=3)
+        self.assertEqual(self.ids_de(pagina), self.ids[-3:])
+        self.assertTrue(pagina["has_more"])
+        self.assertEqual((pagina["oldest_id"], pagina["newest_id"]), (self.ids[4], self.ids[6]))
+
+    def test_before_retrocede_hasta_el_inicio(self):
+        pagina = MessagePageService.page(self.sesion, before=self.ids[4], limite=3)
+        self.assertEqual(self.ids_de(pagina), self.ids[1:4])
+        self.assertTrue(pagina["has_more"])
+
+        primera = MessagePageService.page(self.sesion, before=pagina["oldest_id"], limite=3)
+        self.assertEqual(self.ids_de(primera), self.ids[:1])
+        self.assertFalse(primera["has_more"])
+
+    def test_after_trae_solo_los_nuevos(self):
+        pagina = MessagePageService.page(self.sesion, after=self.ids[2], limite=3)
+        self.assertEqual(self.ids_de(pagina), self.ids[3:6])
+        self.assertTrue(pagina["has_more"])
+
+        sin_nuevos = MessagePageService.page(self.sesion, after=self.ids[-1])
+        self.assertEqual(sin_nuevos, {"messages": [], "has_more": False, "oldest_id": None, "newest_id": None})
+
+    def test_anclas_invalidas(self):
+        ajeno = SessionCounters.add_message(crear_sesion(self.usuario), "usuario", "Otra sesión")
+        for parametros in [
+            {"before": self.ids[3], "after": self.ids[1]}, {"before": ajeno.id_mensaje},
+            {"after": "abc"}, {"limite": 0},
+        ]:
+            with self.subTest(**parametros), self.assertRaises(ValueError):
+                MessagePageService.page(self.sesion, **parametros)
+
+    def test_marca_de_datos_fuente(self):
+        mensaje = MensajeChat.objects.get(id_mensaje=self.ids[-1])
+        SourceDataService.store(mensaje, [{"id_persona": 1}])
+
+        marcas = {m.id_mensaje: m.tiene_datos_fuente for m in MessagePageService.page(self.sesion, limite=2)["messages"]}
+        self.assertEqual(marcas, {self.ids[5]: False, self.ids[6]: True})
+        self.assertTrue(MessagePageService.serialize(MessagePageService.all(self.sesion)[-1])["has_source_data"])
+
+    def test_endpoint(self):
+        cliente = APIClient()
+        cliente.force_authenticate(self.usuario)
+        url = reverse("api_session_messages", args=[self.sesion.id_sesion])
+
+        pagina = cliente.get(url, {"limit": 2}).json()
+        self.assertEqual([m["id"] for m in pagina["messages"]], self.ids[-2:])
+        anteriores = cliente.get(url, {"before": pagina["oldest_id"], "limit": 2}).json()
+        self.assertEqual([m["id"] for m in anteriores["messages"]], self.ids[3:5])
+        self.assertEqual(cliente.get(url, {"before": 1, "after": 2}).status_code, 400)
+
+        detalle = cliente.get(reverse("api_session_detail", args=[self.sesion.id_sesion]), {"limit": 2}).json()
+        self.assertEqual(detalle["messages_page"], {
+            "has_more_before": True, "oldest_id": self.ids[5], "newest_id": self.ids[6],
+        })
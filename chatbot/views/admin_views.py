@@ -5,7 +5,8 @@ from django.db.models import Count
 from django.contrib.auth.models import User
 from datetime import timedelta
 
-from ..models import SesionChat, MensajeChat, PreguntaBloqueada, ContextoPrompt, TerminoExcluido
+from ..models import SesionChat, PreguntaBloqueada, ContextoPrompt, TerminoExcluido
+from ..services import SessionCounters
 
 
 @staff_member_required
@@ -47,10 +48,11 @@ def panel_admin(request):
     # Estadísticas generales
     total_usuarios = User.objects.count()
     usuarios_activos = User.objects.filter(last_login__gte=timezone.now() - timedelta(days=30)).count()
-    total_sesiones = SesionChat.objects.count()
-    sesiones_activas = SesionChat.objects.filter(estado='activa').count()
-    total_mensajes = MensajeChat.objects.count()
-    preguntas_bloqueadas = PreguntaBloqueada.objects.count()
+    totales = SessionCounters.totals()
+    total_sesiones = totales['total_sesiones']
+    sesiones_activas = totales['sesiones_activas']
+    total_mensajes = totales['total_mensajes']
+    preguntas_bloqueadas = totales['preguntas_bloqueadas']
     
     # Usuarios más activos (por número de sesiones)
     usuarios_activos_data = User.objects.annotate(
@@ -1,3 +1,5 @@
+from functools import wraps
+
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
@@ -7,11 +9,25 @@ from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 
 from ..models import Persona, Funcion, TiempoContrato, Contrato
+from ..services import AnalyticsDB, AnalyticsPoolTimeout
+
+
+def con_pool_analitico(vista):
+    """Ejecuta la vista con un cupo del pool analítico; 503 si no hay cupos disponibles"""
+    @wraps(vista)
+    def envoltura(request, *args, **kwargs):
+        try:
+            with AnalyticsDB.slot():
+                return vista(request, *args, **kwargs)
+        except AnalyticsPoolTimeout:
+            return JsonResponse({"error": "Servicio de datos ocupado, intenta nuevamente"}, status=503)
+    return envoltura
 
 
 @api_view(['GET'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
+@con_pool_analitico
 def detalle_contrato(request, id):
     """Obtiene detalles completos de un contrato con información relacionada"""
     contrato = get_object_or_404(Contrato, id_contrato=id)
@@ -65,6 +81,7 @@ def detalle_contrato(request, id):
 @api_view(['POST'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
+@con_pool_analitico
 def detalle_contratos_bulk(request):
     """Obtiene detalles de múltiples contratos en una sola llamada"""
     
@@ -134,6 +151,7 @@ def detalle_contratos_bulk(request):
 @api_view(['GET'])
 @authentication_classes([TokenAuthentication])
 @permission_classes([IsAuthenticated])
+@con_pool_analitico
 def detalle_generico(request, tipo, id):
     # Normalizar tipo (e.g., id_personas → persona)
     tipo_normalizado = tipo.replace("id_", "").rstrip("s")
@@ -4,8 +4,8 @@ from django.utils import timezone
 from django.contrib import messages
 import logging
 
-from ..models import SesionChat, MensajeChat, PreguntaBloqueada, ContextoPrompt, DatosFuenteMensaje
-from ..services import ChatService, ValidationService
+from ..models import SesionChat, ContextoPrompt
+from ..services import ChatService, ValidationService, LLMOverloadedError, MessagePageService
 from ..bot import guardar_mensaje
 
 
@@ -19,8 +19,7 @@ def chat_home(request):
 def chat_sesion(request, id):
     sesion = get_object_or_404(SesionChat, id_sesion=id, usuario=request.user)
     solo_lectura = sesion.estado == 'finalizada'
-    mensajes = MensajeChat.objects.filter(sesion=sesion).order_by('fecha')
-    bloqueadas = PreguntaBloqueada.objects.filter(sesion=sesion).exists()
+    bloqueadas = sesion.total_bloqueadas > 0
 
     if request.method == "POST" and not solo_lectura:
         pregunta = request.POST.get("pregunta", "").strip()
@@ -44,11 +43,13 @@ def chat_sesion(request, id):
             
             # Guardar datos en sesión para la vista
             if result.get("datos_fuente"):
-                request.session['datos_fuente'] = result["datos_fuente"]
+                request.session['datos_fuente_mensaje'] = result["message_id"]
             
             if result.get("ids_extra"):
                 request.session['detalles'] = result["ids_extra"]
             
+        except LLMOverloadedError as e:
+            messages.warning(request, f"El asistente está con alta demanda. Intenta nuevamente en {e.retry_after} segundos.")
         except Exception as e:
             logging.error(f"Error processing message in chat_sesion: {e}")
             messages.error(request, "Ocurrió un error procesando tu pregunta. Intenta nuevamente.")
@@ -57,22 +58,23 @@ def chat_sesion(request, id):
         
     contexto_activo = ContextoPrompt.objects.filter(activo=True).first()
     
-    datos_fuente = request.session.pop('datos_fuente', None)
-    
-    for msg in mensajes:
-        if msg.tipo_emisor == "ia":
-            try:
-                msg.datos_fuente = msg.datos_fuente #fuerza el acceso
-            except DatosFuenteMensaje.DoesNotExist:
-                msg.datos_fuente = None
+    # Los datos fuente se piden bajo demanda a /api/v1/messages/<id>/source-data/
+    datos_fuente_mensaje = request.session.pop('datos_fuente_mensaje', None)
+    # Solo los mensajes más recientes; ?antes=<id_mensaje> muestra los anteriores
+    try:
+        pagina = MessagePageService.page(sesion, before=request.GET.get('antes') or None)
+    except ValueError:
+        return redirect('chat_sesion', id=id)
 
     return render(request, 'chatbot/sesion.html', {
         'sesion': sesion,
-        'mensajes': mensajes,
+        'mensajes': pagina['messages'],
+        'hay_anteriores': pagina['has_more'],
+        'mensaje_mas_antiguo': pagina['oldest_id'],
         'bloqueadas': bloqueadas,
         'solo_lectura': solo_lectura,
         'contexto_activo': contexto_activo,
-        'datos_fuente': datos_fuente,
+        'datos_fuente_mensaje': datos_fuente_mensaje,
     })
 
 
@@ -2,6 +2,7 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 
 from ..models import TerminoExcluido
+from ..services import ExclusionService
 
 
 @login_required
@@ -12,6 +13,7 @@ def excluir_terminos(request):
             TerminoExcluido.objects.get_or_create(usuario=request.user, palabra=nuevo)
         eliminar = request.POST.getlist("eliminar")
         TerminoExcluido.objects.filter(usuario=request.user, palabra__in=eliminar).delete()
+        ExclusionService.refresh_user(request.user)
         return redirect('excluir_terminos')
 
     terminos = TerminoExcluido.objects.filter(usuario=request.user)
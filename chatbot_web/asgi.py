@@ -3,6 +3,11 @@ ASGI config for chatbot_web project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Las vistas asíncronas (p. ej. /api/v1/sessions/<id>/message/async/) solo liberan
+el proceso durante las llamadas a Claude cuando se sirven por ASGI:
+
+    uvicorn chatbot_web.asgi:application --workers 2
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
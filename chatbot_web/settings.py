@@ -10,8 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from dotenv import load_dotenv
+
+load_dotenv()
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -79,17 +84,51 @@ WSGI_APPLICATION = 'chatbot_web.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Conexiones persistentes por hilo (CONN_MAX_AGE) verificadas antes de reutilizarse.
+# bot.py usa los mismos datos para su pool psycopg2 (chatbot.services.pg_pool).
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'test',
-        'USER': 'FelipeAE',
-        'PASSWORD': 'Pipe1996',
-        'HOST': 'localhost',
-        'PORT': '5432',
+        'NAME': os.getenv('DB_NAME', 'test'),
+        'USER': os.getenv('DB_USER', 'FelipeAE'),
+        'PASSWORD': os.getenv('DB_PASSWORD', 'Pipe1996'),
+        'HOST': os.getenv('DB_HOST', 'localhost'),
+        'PORT': os.getenv('DB_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+        },
     }
 }
 
+# Consultas analíticas (SQL generado y detalle de contratos) en un alias propio, para que
+# los escaneos pesados no compitan con las escrituras del chat. Sin ANALYTICS_DB_HOST usa
+# la misma base con conexiones separadas; con él, una réplica de lectura.
+DATABASES['analytics'] = {
+    **DATABASES['default'],
+    'NAME': os.getenv('ANALYTICS_DB_NAME') or DATABASES['default']['NAME'],
+    'USER': os.getenv('ANALYTICS_DB_USER') or DATABASES['default']['USER'],
+    'PASSWORD': os.getenv('ANALYTICS_DB_PASSWORD') or DATABASES['default']['PASSWORD'],
+    'HOST': os.getenv('ANALYTICS_DB_HOST') or DATABASES['default']['HOST'],
+    'PORT': os.getenv('ANALYTICS_DB_PORT') or DATABASES['default']['PORT'],
+    'CONN_MAX_AGE': int(os.getenv('ANALYTICS_DB_CONN_MAX_AGE', '60')),
+    'CONN_HEALTH_CHECKS': True,
+    'OPTIONS': {
+        'connect_timeout': int(os.getenv('ANALYTICS_DB_CONNECT_TIMEOUT', '5')),
+        'options': (
+            '-c default_transaction_read_only=on '
+            f"-c statement_timeout={os.getenv('ANALYTICS_DB_STATEMENT_TIMEOUT_MS', '30000')}"
+        ),
+    },
+    'TEST': {'MIRROR': 'default'},
+}
+
+DATABASE_ROUTERS = ['chatbot.db_router.AnalyticsRouter']
+
+# Crea en la base de pruebas también las tablas no administradas por Django
+TEST_RUNNER = 'chatbot.test_runner.UnmanagedTablesTestRunner'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
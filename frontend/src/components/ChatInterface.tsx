@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useRef } from 'react';
-import { ChatMessage, SessionDetail, ContractDetail, chatAPI } from '../services/api';
+import { ChatMessage, SessionDetail, ContractDetail, SendMessageResponse, chatAPI } from '../services/api';
 import TypingIndicator from './TypingIndicator';
 import QuestionTemplates from './QuestionTemplates';
 import FavoritesPanel from './FavoritesPanel';
@@ -22,7 +22,10 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
   const [session, setSession] = useState<SessionDetail | null>(null);
   const [newMessage, setNewMessage] = useState('');
   const [loading, setLoading] = useState(false);
+  const [streamingText, setStreamingText] = useState('');
   const [loadingMessages, setLoadingMessages] = useState(false);
+  const [hasMoreBefore, setHasMoreBefore] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
   const [contractDetails, setContractDetails] = useState<ContractDetail[]>([]);
   const [showContractModal, setShowContractModal] = useState(false);
   
@@ -36,6 +39,8 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
   
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const inputRef = useRef<HTMLInputElement>(null);
+  // Al anteponer mensajes anteriores no se baja al final de la conversación
+  const skipScrollRef = useRef(false);
   
   // Hooks
   const { toggleFavorite, isFavorite } = useFavorites();
@@ -77,6 +82,10 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
   }, [sessionId]);
 
   useEffect(() => {
+    if (skipScrollRef.current) {
+      skipScrollRef.current = false;
+      return;
+    }
     scrollToBottom();
   }, [messages]);
 
@@ -88,6 +97,7 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
       const response = await chatAPI.getSession(sessionId);
       setSession(response.data);
       setMessages(response.data.messages);
+      setHasMoreBefore(response.data.messages_page.has_more_before);
     } catch (error) {
       console.error('Error loading session:', error);
     } finally {
@@ -95,6 +105,51 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
     }
   };
 
+  // Trae solo los mensajes posteriores al último ya guardado y reemplaza los optimistas (id negativo)
+  const loadNewMessages = async () => {
+    if (!sessionId) return;
+    
+    const newestId = messages.reduce((max, m) => (m.id > max ? m.id : max), 0);
+    if (!newestId) {
+      await loadSession();
+      return;
+    }
+    try {
+      const nuevos: ChatMessage[] = [];
+      let after = newestId;
+      let hasMore = true;
+      while (hasMore) {
+        const response = await chatAPI.getSessionMessages(sessionId, { after });
+        nuevos.push(...response.data.messages);
+        hasMore = response.data.has_more && response.data.newest_id !== null;
+        after = response.data.newest_id ?? after;
+        setSession((prev) => (prev ? { ...prev, session: response.data.session } : prev));
+      }
+      setMessages((prev) => [...prev.filter((m) => m.id > 0), ...nuevos]);
+    } catch (error) {
+      console.error('Error loading new messages:', error);
+      await loadSession();
+    }
+  };
+
+  const loadOlderMessages = async () => {
+    if (!sessionId || loadingOlder) return;
+    
+    const oldestId = messages.find((m) => m.id > 0)?.id;
+    if (!oldestId) return;
+    setLoadingOlder(true);
+    try {
+      const response = await chatAPI.getSessionMessages(sessionId, { before: oldestId });
+      skipScrollRef.current = true;
+      setMessages((prev) => [...response.data.messages, ...prev]);
+      setHasMoreBefore(response.data.has_more);
+    } catch (error) {
+      console.error('Error loading older messages:', error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   };
@@ -106,30 +161,51 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
     const messageText = newMessage;
     setNewMessage('');
 
+    // Mostrar la pregunta de inmediato mientras llega la respuesta
+    setMessages((prev) => [
+      ...prev,
+      { id: -Date.now(), sender: 'usuario', content: messageText, timestamp: new Date().toISOString(), has_source_data: false },
+    ]);
+
     try {
-      const response = await chatAPI.sendMessage(sessionId, messageText);
+      const outcome: { response: SendMessageResponse | null; error: string | null } = { response: null, error: null };
       
-      await loadSession();
+      await chatAPI.sendMessageStream(sessionId, messageText, (event, data) => {
+        if (event === 'token') {
+          setStreamingText((prev) => prev + data.text);
+        } else if (event === 'done') {
+          outcome.response = { success: true, message: 'Mensaje procesado exitosamente', ...data };
+        } else if (event === 'error') {
+          outcome.error = data.message;
+        }
+      });
+      
+      await loadNewMessages();
       onSessionUpdate?.();
       
-      if (response.data.response) {
+      if (outcome.error) {
+        alert(`Error: ${outcome.error}`);
+      }
+      
+      const response = outcome.response;
+      if (response?.response) {
         // Check if we have metadata with contract IDs
-        if (response.data.metadata && response.data.metadata.id_contrato) {
+        if (response.metadata && response.metadata.id_contrato) {
           console.log('=== CONTRACT METADATA FOUND ===');
-          console.log('Contract IDs from metadata:', response.data.metadata.id_contrato);
-          loadContractDetails(response.data.metadata.id_contrato);
+          console.log('Contract IDs from metadata:', response.metadata.id_contrato);
+          loadContractDetails(response.metadata.id_contrato);
         } else {
           // Fallback to parsing text (for old messages)
-          extractContractIds(response.data.response);
+          extractContractIds(response.response);
         }
       }
     } catch (error: any) {
       console.error('Error sending message:', error);
-      if (error.response?.data?.error) {
-        alert(`Error: ${error.response.data.error}`);
-      }
+      alert(`Error: ${error.message}`);
+      await loadNewMessages();
       setNewMessage(messageText);
     } finally {
+      setStreamingText('');
       setLoading(false);
     }
   };
@@ -263,11 +339,13 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
     console.log(added ? 'Added to favorites' : 'Removed from favorites');
   };
 
-  const handleExport = (format: ExportFormat) => {
-    if (!session) return;
+  const handleExport = async (format: ExportFormat) => {
+    if (!session || !sessionId) return;
     
     try {
-      exportConversation(session, format);
+      // La vista solo tiene las páginas cargadas; la exportación incluye la conversación completa
+      const response = await chatAPI.getSession(sessionId, { all: true });
+      exportConversation(response.data, format);
     } catch (error) {
       console.error('Error exporting conversation:', error);
       alert('Error exportando la conversación');
@@ -485,6 +563,17 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
           </div>
         ) : (
           <>
+            {hasMoreBefore && (
+              <div className="text-center mb-3">
+                <button 
+                  className="btn btn-sm btn-outline-secondary"
+                  onClick={loadOlderMessages}
+                  disabled={loadingOlder}
+                >
+                  {loadingOlder ? 'Cargando...' : '⬆️ Cargar mensajes anteriores'}
+                </button>
+              </div>
+            )}
             {messages.map((message) => (
               <div key={message.id} className="mb-3">
               <div className={`d-flex justify-content-${message.sender === 'usuario' ? 'end' : 'start'} mb-2`}>
@@ -540,8 +629,20 @@ const ChatInterface: React.FC<ChatInterfaceProps> = ({ sessionId, onSessionUpdat
             </div>
           ))}
           
+          {/* Respuesta en streaming */}
+          {loading && streamingText && (
+            <div className="mb-3">
+              <div className="d-flex justify-content-start mb-2">
+                <div className="bg-white border rounded p-2" style={{ maxWidth: '70%' }}>
+                  <div className="fw-medium mb-1 text-success">Respuesta:</div>
+                  <div style={{ whiteSpace: 'pre-wrap' }}>{formatMessage(streamingText)}</div>
+                </div>
+              </div>
+            </div>
+          )}
+          
           {/* Typing indicator */}
-          {loading && <TypingIndicator />}
+          {loading && !streamingText && <TypingIndicator />}
           </>
         )}
         <div ref={messagesEndRef} />
@@ -59,7 +59,7 @@ const ConversationSearch: React.FC<ConversationSearchProps> = ({
       // Search through all sessions
       for (const session of sessions) {
         try {
-          const sessionDetail = await chatAPI.getSession(session.id);
+          const sessionDetail = await chatAPI.getSession(session.id, { all: true });
           const messages = sessionDetail.data.messages;
           
           // Search in message content
@@ -51,8 +51,15 @@ export interface SessionDetail {
     finished_at?: string;
     readonly: boolean;
     has_blocked_questions: boolean;
+    message_count: number;
+    last_activity_at?: string;
   };
   messages: ChatMessage[];
+  messages_page: {
+    has_more_before: boolean;
+    oldest_id: number | null;
+    newest_id: number | null;
+  };
   context: {
     active_context?: string;
   };
@@ -71,6 +78,27 @@ export interface ChatMessage {
   };
 }
 
+export interface SessionsPage {
+  sessions: ChatSession[];
+  next_cursor: string | null;
+  has_more: boolean;
+}
+
+export interface MessagesPage {
+  messages: ChatMessage[];
+  has_more: boolean;
+  oldest_id: number | null;
+  newest_id: number | null;
+  session: SessionDetail['session'];
+}
+
+export interface SourceDataPage {
+  columns: string[];
+  rows: any[][];
+  total: number;
+  next_cursor: string | null;
+}
+
 export interface SendMessageResponse {
   success: boolean;
   message: string;
@@ -84,6 +112,8 @@ export interface SendMessageResponse {
   error?: string;
 }
 
+export type StreamEventHandler = (event: string, data: any) => void;
+
 export interface LoginResponse {
   token: string;
   user: {
@@ -212,16 +242,47 @@ export const chatAPI = {
   getSessions: () =>
     api.get<ChatSession[]>('/sessions/'),
   
+  getSessionsPage: (cursor?: string | null, limit?: number) =>
+    api.get<SessionsPage>('/sessions/', {
+      params: {
+        ...(cursor ? { cursor } : {}),
+        limit: limit ?? 20,
+      },
+    }),
+  
   createSession: () =>
     api.post<{success: boolean; session_id: number; message: string}>('/sessions/create/'),
   
-  getSession: (id: number) =>
-    api.get<SessionDetail>(`/sessions/${id}/`),
+  getSession: (id: number, options?: { all?: boolean; limit?: number }) =>
+    api.get<SessionDetail>(`/sessions/${id}/`, {
+      params: {
+        ...(options?.all ? { messages: 'all' } : {}),
+        ...(options?.limit ? { limit: options.limit } : {}),
+      },
+    }),
   
   getSessionDetail: (id: number) =>
     api.get<SessionDetail>(`/sessions/${id}/`),
   
-  // Messages are included in session detail, no separate endpoint needed
+  // Session detail includes the latest messages; older/newer ones are paged by message id
+  getSessionMessages: (id: number, options: { before?: number; after?: number; limit?: number } = {}) =>
+    api.get<MessagesPage>(`/sessions/${id}/messages/`, {
+      params: {
+        ...(options.before ? { before: options.before } : {}),
+        ...(options.after ? { after: options.after } : {}),
+        ...(options.limit ? { limit: options.limit } : {}),
+      },
+    }),
+  
+  // Source data is loaded on demand
+  getSourceData: (messageId: number, cursor?: string | null, columns?: string[], limit?: number) =>
+    api.get<SourceDataPage>(`/messages/${messageId}/source-data/`, {
+      params: {
+        ...(cursor ? { cursor } : {}),
+        ...(columns?.length ? { columns: columns.join(',') } : {}),
+        ...(limit ? { limit } : {}),
+      },
+    }),
   
   deleteSession: (id: number) =>
     api.delete<{success: boolean; message: string}>(`/sessions/${id}/delete/`),
@@ -232,6 +293,52 @@ export const chatAPI = {
   sendMessage: (sessionId: number, message: string) =>
     api.post<SendMessageResponse>(`/sessions/${sessionId}/message/`, { message }),
   
+  // Server-Sent Events: validated, sql_generated, rows_fetched, token, done | error
+  sendMessageStream: async (sessionId: number, message: string, onEvent: StreamEventHandler) => {
+    const token = localStorage.getItem('authToken');
+    const response = await fetch(`${API_BASE_URL}/sessions/${sessionId}/message/stream/`, {
+      method: 'POST',
+      credentials: 'include',
+      headers: {
+        'Content-Type': 'application/json',
+        Accept: 'text/event-stream',
+        ...(token ? { Authorization: `Token ${token}` } : {}),
+      },
+      body: JSON.stringify({ message }),
+    });
+    
+    if (!response.ok || !response.body) {
+      const data = await response.json().catch(() => ({}));
+      throw new Error(data.error || `HTTP ${response.status}`);
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      
+      let separator = buffer.indexOf('\n\n');
+      while (separator !== -1) {
+        const raw = buffer.slice(0, separator);
+        buffer = buffer.slice(separator + 2);
+        
+        let event = 'message';
+        let data = '';
+        raw.split('\n').forEach((line) => {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        });
+        onEvent(event, data ? JSON.parse(data) : {});
+        
+        separator = buffer.indexOf('\n\n');
+      }
+    }
+  },
+  
   getContractDetails: (contractId: number) =>
     api.get<ContractDetail>(`/contrato/${contractId}/`),
   